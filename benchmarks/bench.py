@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for parsing, building, and serialising JRD's.
+
+Each benchmark is run on small (a typical Mastodon account), medium, and huge
+JRD/XRD fixtures. The best time per call and the tracemalloc peak memory of a
+single call are recorded, and compared against a stored baseline.
+
+Usage:
+    python benchmarks/bench.py             # run and compare with baseline
+    python benchmarks/bench.py --save      # run and store a new baseline
+    python benchmarks/bench.py -k from_    # only run matching benchmarks
+
+The exit status is 1 if any benchmark regressed by more than the tolerance.
+Timings depend on the machine, so store a baseline on the machine you compare
+on.
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webfinger.objects.jrd import WebFingerJRD
+from webfinger.objects.link import WebFingerLink
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+"""Default baseline file."""
+
+SIZES = {"small": (2, 1, 4), "medium": (10, 10, 50), "huge": (100, 100, 5000)}
+"""Fixture sizes: (aliases, properties, links)."""
+
+
+def make_jrd(aliases, properties, links, host="mst3k.interlinked.me"):
+    """Build a realistic JRD mapping of the given size."""
+    rels = (("http://webfinger.net/rel/profile-page", "text/html"),
+            ("self", "application/activity+json"),
+            ("http://schemas.google.com/g/2010#updates-from",
+             "application/atom+xml"),
+            ("http://webfinger.net/rel/avatar", "image/png"))
+
+    jrd = {"subject": "acct:Elizafox@{}".format(host),
+           "aliases": ["https://{}/users/alias{}".format(host, i)
+                       for i in range(aliases)],
+           "properties": {"https://{}/ns/prop{}".format(host, i): "value"
+                          for i in range(properties)},
+           "links": []}
+
+    for i in range(links):
+        rel, type = rels[i % len(rels)]
+        jrd["links"].append({"rel": rel, "type": type,
+                             "href": "https://{}/link/{}".format(host, i)})
+
+    return jrd
+
+
+def make_benchmarks():
+    """Return a dict mapping benchmark names to functions."""
+    benchmarks = {}
+
+    for size, args in SIZES.items():
+        jrd = make_jrd(*args)
+        response = WebFingerJRD(jrd)
+        text = response.to_json()
+        xml = response.to_xml()
+        data = response.to_bytes()
+        links = jrd["links"]
+
+        benchmarks.update({
+            "from_json[{}]".format(size):
+                lambda text=text: WebFingerJRD.from_json(text),
+            "from_xml[{}]".format(size):
+                lambda xml=xml: WebFingerJRD.from_xml(xml),
+            "from_bytes[{}]".format(size):
+                lambda data=data: WebFingerJRD.from_bytes(data),
+            "link_init[{}]".format(size):
+                lambda links=links: [WebFingerLink(**x) for x in links],
+            "to_json[{}]".format(size): response.to_json,
+            "to_xml[{}]".format(size): response.to_xml,
+            "to_bytes[{}]".format(size): response.to_bytes,
+            "rel[{}]".format(size):
+                lambda response=response: response.rel("profile", "href"),
+            "first[{}]".format(size):
+                lambda response=response: response.first(
+                    rel="self", type="application/activity+json"),
+        })
+
+    return benchmarks
+
+
+def measure(func, repeat=5):
+    """Return (best seconds per call, tracemalloc peak bytes of one call)."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def compare(results, baseline, tolerance):
+    """Print results against the baseline, and return regressed names."""
+    regressed = []
+
+    print("{:<22} {:>12} {:>8} {:>12} {:>8}".format(
+        "benchmark", "time", "vs base", "peak mem", "vs base"))
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        time_ratio = mem_ratio = ""
+        if base:
+            time_change = result["time"] / base["time"] - 1
+            mem_change = result["peak"] / max(base["peak"], 1) - 1
+            time_ratio = "{:+.0%}".format(time_change)
+            mem_ratio = "{:+.0%}".format(mem_change)
+            if time_change > tolerance or mem_change > tolerance:
+                regressed.append(name)
+
+        print("{:<22} {:>10.2f}us {:>8} {:>10.1f}KiB {:>8}".format(
+            name, result["time"] * 1e6, time_ratio, result["peak"] / 1024,
+            mem_ratio))
+
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="baseline file (default %(default)s)")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before failing (default "
+                             "%(default)s)")
+    parser.add_argument("-k", dest="match", default="",
+                        help="only run benchmarks containing this string")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing repetitions (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, func in make_benchmarks().items():
+        if args.match in name:
+            time, peak = measure(func, args.repeat)
+            results[name] = {"time": time, "peak": peak}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressed = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    if regressed:
+        print("\nregressed:", ", ".join(regressed))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""A local stand-in WebFinger server for load tests and benchmarks.
+
+The server answers every /.well-known/webfinger request with a generated JRD
+(or XRD) for the requested resource. Latency, error rate, content type, and
+body size are configurable, so clients can be measured without the network.
+
+Point a client at it with e.g. WebFingerClient(scheme="http", port=port) and
+resources like "acct:user@127.0.0.1".
+
+FakeH2WebFingerServer is the same server speaking cleartext HTTP/2 (with
+"prior knowledge", as TLS would need certificates); it needs the h2 package.
+"""
+
+import asyncio
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webfinger.objects.jrd import WebFingerJRD
+
+
+_PLACEHOLDER = "acct:__resource__@example.com"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are written separately; without this, delayed ACKs
+    # add ~40ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.webfinger
+
+        latency = server.delay()
+        if latency:
+            time.sleep(latency)
+
+        status, body, content_type, headers = server.respond(self.path)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if server.content_length:
+            self.send_header("Content-Length", str(len(body)))
+        else:
+            # The body ends when the connection is closed
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up (e.g. cancelled hedged requests) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeWebFingerServer:
+    """A threaded local WebFinger server.
+
+    It can be used as a context manager, which starts and stops the server.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0,
+                 content_type="application/jrd+json", links=4, status=200,
+                 headers=None, seed=None, metrics=None, tail_rate=0.0,
+                 tail_latency=0.0, rate_limit=None, content_length=True,
+                 documents=None):
+        """Initialise the FakeWebFingerServer object.
+
+        args:
+        host - address to listen on (default 127.0.0.1)
+        port - port to listen on (default is any free port)
+        latency - seconds to wait before answering each request
+        tail_rate - fraction of requests answered tail_latency seconds later
+                    still, to simulate a latency tail (default 0)
+        tail_latency - extra seconds to wait for those requests
+        rate_limit - lookups allowed per second (in one second windows);
+                     further lookups are answered with 429, and all with
+                     RateLimit-* headers (default is no limit)
+        content_length - send Content-Length (default True); if False, the
+                         body is ended by closing the connection (HTTP/1.1
+                         only)
+        documents - dict mapping resources to the JRD's (dicts) to answer
+                    with; other resources get the generated JRD (which
+                    links to nothing but https://example.com)
+        error_rate - fraction of requests answered with 500 (default 0)
+        content_type - Content-Type to send; XML is sent if it contains "xml"
+        links - number of links in each JRD (controls the body size)
+        status - HTTP status for successful responses (default 200)
+        headers - extra headers to send with successful responses
+        seed - seed for the error and tail random number generator
+        metrics - MetricsCollector to record requests in, and to serve at
+                  /metrics
+        """
+        self.latency = latency
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.content_type = content_type
+        self.status = status
+        self.headers = headers or {}
+        self.random = random.Random(seed)
+        self.metrics = metrics
+        self._failures = []
+        self._delays = []
+        self.rate_limit = rate_limit
+        self.content_length = content_length
+        self._window = (0.0, 0)
+        self._lock = threading.Lock()
+
+        jrd = {"subject": _PLACEHOLDER,
+               "aliases": ["https://example.com/users/user"],
+               "links": [{"rel": "self", "type": "application/activity+json",
+                          "href": "https://example.com/users/user/{}".format(i)}
+                         for i in range(links)]}
+        response = WebFingerJRD(jrd)
+        if "xml" in content_type:
+            self.body = response.to_xml()
+        else:
+            self.body = response.to_json()
+
+        self.documents = {}
+        for resource, document in (documents or {}).items():
+            document = WebFingerJRD(document)
+            self.documents[resource] = (document.to_xml()
+                                        if "xml" in content_type
+                                        else document.to_json())
+
+        self.thread = None
+        self.listen(host, port)
+
+    def listen(self, host, port):
+        """Create the (not yet serving) server."""
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.webfinger = self
+        self.server_address = self.httpd.server_address
+
+    @property
+    def host(self):
+        """Address the server is listening on."""
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        """Port the server is listening on."""
+        return self.server_address[1]
+
+    def fail(self, count=1, status=503, headers=None):
+        """Answer the next count lookups with status (and headers)."""
+        with self._lock:
+            self._failures.extend([(status, headers or {})] * count)
+
+    def slow(self, count=1, latency=1.0):
+        """Answer the next count requests latency seconds later."""
+        with self._lock:
+            self._delays.extend([latency] * count)
+
+    def delay(self):
+        """Return seconds to wait before answering the next request."""
+        with self._lock:
+            latency = self.latency
+            if self._delays:
+                latency += self._delays.pop(0)
+
+            if self.tail_rate and self.random.random() < self.tail_rate:
+                latency += self.tail_latency
+
+        return latency
+
+    def rate_limited(self):
+        """Count a lookup against rate_limit.
+
+        Returns None if there is no limit, else (limited, headers), where
+        limited is True if the lookup is over the limit, and headers are the
+        RateLimit-* headers to send.
+        """
+        if self.rate_limit is None:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            end, count = self._window
+            if now >= end:
+                end, count = now + 1.0, 0
+
+            count += 1
+            self._window = end, count
+
+        remaining = self.rate_limit - count
+        return remaining < 0, {"RateLimit-Limit": str(self.rate_limit),
+                               "RateLimit-Remaining": str(max(0, remaining)),
+                               "RateLimit-Reset": "{:.3f}".format(end - now)}
+
+    def respond(self, path):
+        """Answer a GET request for path (after waiting for delay()).
+
+        Returns (status, body, content type, headers).
+        """
+        url = urlsplit(path)
+
+        if url.path == "/metrics" and self.metrics is not None:
+            body = self.metrics.exposition().encode("utf-8")
+            return 200, body, "text/plain; version=0.0.4", {}
+
+        if url.path != "/.well-known/webfinger":
+            return 404, b"not found", "text/plain", {}
+
+        resource = parse_qs(url.query).get("resource", [""])[0]
+        if not resource:
+            return 400, b"resource is required", "text/plain", {}
+
+        if self.metrics is not None:
+            self.metrics.started()
+
+        start = time.perf_counter()
+        with self._lock:
+            failure = self._failures.pop(0) if self._failures else None
+
+        limited = self.rate_limited()
+
+        if failure is not None:
+            response = failure[0], b"error", "text/plain", failure[1]
+        elif limited is not None and limited[0]:
+            response = 429, b"too many requests", "text/plain", limited[1]
+        elif self.error_rate and self.random.random() < self.error_rate:
+            response = 500, b"internal error", "text/plain", {}
+        else:
+            body = self.documents.get(resource)
+            if body is None:
+                body = self.body.replace(_PLACEHOLDER, resource)
+
+            body = body.encode("utf-8")
+            headers = self.headers
+            if limited is not None:
+                headers = dict(headers, **limited[1])
+
+            response = self.status, body, self.content_type, headers
+
+        if self.metrics is not None:
+            self.metrics.finished()
+            self.metrics.record(resource.split("@")[-1],
+                                "success" if response[0] == 200 else "error",
+                                time.perf_counter() - start)
+
+        return response
+
+    def serve_forever(self):
+        """Serve in this thread until stop() is called."""
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Start serving in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _H2Protocol(asyncio.Protocol):
+    def __init__(self, server):
+        import h2.config
+        import h2.connection
+
+        self.server = server
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(
+            client_side=False, header_encoding="utf-8"))
+        self.transport = None
+        # Response bodies waiting for flow control, by stream ID
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+        self.conn.initiate_connection()
+        transport.write(self.conn.data_to_send())
+
+    def connection_lost(self, exc):
+        self.pending.clear()
+
+    def data_received(self, data):
+        import h2.events
+        import h2.exceptions
+
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                headers = dict(event.headers)
+                asyncio.ensure_future(self.respond(event.stream_id,
+                                                   headers[":path"]))
+            elif isinstance(event, h2.events.WindowUpdated):
+                self.flush()
+            elif isinstance(event, h2.events.StreamReset):
+                self.pending.pop(event.stream_id, None)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id, path):
+        server = self.server
+        latency = server.delay()
+        if latency:
+            # Requests on a connection are answered concurrently
+            await asyncio.sleep(latency)
+
+        if self.transport.is_closing():
+            return
+
+        status, body, content_type, headers = server.respond(path)
+        self.conn.send_headers(stream_id, [
+            (":status", str(status)),
+            ("content-type", content_type),
+            ("content-length", str(len(body))),
+        ] + [(k.lower(), v) for k, v in headers.items()])
+        self.pending[stream_id] = body
+        self.flush()
+
+    def flush(self):
+        for stream_id, body in list(self.pending.items()):
+            while body:
+                size = min(self.conn.local_flow_control_window(stream_id),
+                           self.conn.max_outbound_frame_size, len(body))
+                if size <= 0:
+                    break
+
+                self.conn.send_data(stream_id, body[:size])
+                body = body[size:]
+
+            if body:
+                self.pending[stream_id] = body
+            else:
+                self.conn.end_stream(stream_id)
+                del self.pending[stream_id]
+
+        self.transport.write(self.conn.data_to_send())
+
+
+class FakeH2WebFingerServer(FakeWebFingerServer):
+    """A local WebFinger server speaking cleartext HTTP/2.
+
+    Clients must use HTTP/2 with prior knowledge, e.g. the httpx client with
+    http1=False. All requests are served from one event loop thread, and
+    requests on a connection are answered concurrently.
+
+    connections is the number of connections accepted so far.
+    """
+
+    def listen(self, host, port):
+        self.connections = 0
+        self.loop = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.server_address = self.sock.getsockname()
+
+    def serve_forever(self):
+        self.loop = loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(loop.create_server(
+            lambda: _H2Protocol(self), sock=self.sock))
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+    def start(self):
+        super().start()
+        while self.loop is None or not self.loop.is_running():
+            time.sleep(0.001)
+
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+        if self.thread is not None:
+            self.thread.join()
+
+        self.sock.close()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""End-to-end load harness for the WebFinger clients.
+
+A FakeWebFingerServer is started in a separate process (so its CPU time isn't
+counted against the client), and the clients are pointed at it. For each mode,
+lookups per second, p50/p99 latency, and client CPU time per lookup are
+reported.
+
+Modes:
+    sync      one requests client, one lookup at a time
+    threaded  one requests client per thread
+    shared    one requests client shared by all threads (as finger() does)
+    paced     shared, with a RateLimiter adapting to the server's rate limit
+    async     one aiohttp client, with bounded concurrency
+    inline    async, but always parsing on the event loop
+    process   async, parsing large responses in a process pool
+    hedged    async, hedging lookups slower than the p95 (see --tail-rate)
+    httpx     one httpx client shared by all threads, over HTTP/1.1
+    h2        one httpx client shared by all threads, over HTTP/2
+    h2async   one async httpx client, over HTTP/2, with bounded concurrency
+
+The HTTP/2 modes use a FakeH2WebFingerServer (cleartext HTTP/2), and
+multiplex all lookups over one connection.
+
+The server can enforce a rate limit with --server-rate, answering lookups
+over it with 429 (counted as errors), and add a latency tail with --tail-rate
+and --tail-latency, which hedging is meant to cut. The paced and hedged modes
+also report the 429s they got and the hedges they sent (and won).
+
+The asynchronous modes also report the event loop lag: how late a task
+waking up every millisecond is, which is how long other coroutines are
+stalled (e.g. by parsing). Use --links to make responses large.
+
+Usage:
+    python benchmarks/load.py --mode all -n 2000 -c 32 --latency 0.005
+    python benchmarks/load.py --mode shared -c 1,4,16,64   # sweep threads
+    python benchmarks/load.py --mode async,hedged --latency 0.005 \
+        --tail-rate 0.02 --tail-latency 0.1
+    python benchmarks/load.py --mode shared,paced --server-rate 200
+    python benchmarks/load.py --mode async,inline,process --links 2000
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakeserver import FakeWebFingerServer, FakeH2WebFingerServer
+from webfinger.exceptions import WebFingerException
+
+
+def _serve(conn, options, http2):
+    cls = FakeH2WebFingerServer if http2 else FakeWebFingerServer
+    server = cls(**options)
+    conn.send(server.port)
+    server.serve_forever()
+
+
+def start_server(options, http2=False):
+    """Start a FakeWebFingerServer in a subprocess; return (process, port).
+
+    If http2 is true, a FakeH2WebFingerServer is started instead.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve,
+                                      args=(child, options, http2),
+                                      daemon=True)
+    process.start()
+    return process, parent.recv()
+
+
+class Result:
+    """Latencies and errors collected during a run."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.latencies = []
+        self.errors = 0
+        self.note = None
+        self.lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+    def report(self, concurrency, wall, cpu):
+        count = len(self.latencies)
+        latencies = sorted(self.latencies)
+        quantiles = statistics.quantiles(latencies, n=100) if count > 1 \
+            else latencies * 99
+        print("{:<9} {:>4} {:>8} {:>7} {:>10.1f} {:>9.2f}ms {:>9.2f}ms "
+              "{:>9.0f}us".format(self.mode, concurrency, count, self.errors,
+                                  count / wall, quantiles[49] * 1e3,
+                                  quantiles[98] * 1e3, cpu / count * 1e6))
+        if self.note:
+            print("{:<9} {}".format("", self.note))
+
+
+def resources(count):
+    return ["acct:user{}@127.0.0.1".format(i) for i in range(count)]
+
+
+def run_sync(port, count, concurrency):
+    from webfinger.client.requests import WebFingerClient
+
+    result = Result("sync")
+    client = WebFingerClient(scheme="http", port=port)
+    for resource in resources(count):
+        start = time.perf_counter()
+        try:
+            client.finger(resource)
+            ok = True
+        except WebFingerException:
+            ok = False
+        result.record(time.perf_counter() - start, ok)
+
+    client.close()
+    return result
+
+
+def run_threaded(port, count, concurrency):
+    from webfinger.client.requests import WebFingerClient
+
+    result = Result("threaded")
+    local = threading.local()
+    clients = []
+
+    def lookup(resource):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = WebFingerClient(scheme="http", port=port)
+            clients.append(client)
+
+        start = time.perf_counter()
+        try:
+            client.finger(resource)
+            ok = True
+        except WebFingerException:
+            ok = False
+        result.record(time.perf_counter() - start, ok)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(lookup, resources(count)))
+
+    for client in clients:
+        client.close()
+
+    return result
+
+
+def run_shared(port, count, concurrency, mode="shared", client=None):
+    if client is None:
+        from webfinger.client.requests import WebFingerClient
+
+        client = WebFingerClient(scheme="http", port=port)
+
+    result = Result(mode)
+
+    def lookup(resource):
+        start = time.perf_counter()
+        try:
+            client.finger(resource)
+            ok = True
+        except WebFingerException:
+            ok = False
+        result.record(time.perf_counter() - start, ok)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(lookup, resources(count)))
+
+    client.close()
+    return result
+
+
+def run_paced(port, count, concurrency):
+    from webfinger.client.ratelimit import RateLimiter
+    from webfinger.client.requests import WebFingerClient
+
+    # Far above any server limit; the server's RateLimit-* headers set it
+    limiter = RateLimiter(rate=10000, burst=concurrency)
+    client = WebFingerClient(scheme="http", port=port, rate_limit=limiter)
+    result = run_shared(port, count, concurrency, "paced", client)
+    state = limiter.state("127.0.0.1")
+    result.note = "429s {limited}, waited {waited:.1f}s".format(**state)
+    return result
+
+
+def run_httpx(port, count, concurrency):
+    import httpx
+
+    from webfinger.client.httpx import WebFingerClient
+
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    client = WebFingerClient(scheme="http", port=port, http2=False,
+                             limits=limits)
+    return run_shared(port, count, concurrency, "httpx", client)
+
+
+def run_h2(port, count, concurrency):
+    from webfinger.client.httpx import WebFingerClient
+
+    client = WebFingerClient(scheme="http", port=port, http1=False)
+    return run_shared(port, count, concurrency, "h2", client)
+
+
+async def monitor_lag(lags, interval=0.001):
+    """Record how late the event loop wakes this task up, until cancelled."""
+    import asyncio
+
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def run_async(port, count, concurrency, mode="async", create_client=None,
+              **kwargs):
+    import asyncio
+
+    if create_client is None:
+        from webfinger.client.aiohttp import WebFingerClient
+
+        def create_client():
+            return WebFingerClient(scheme="http", port=port,
+                                   limit=concurrency, **kwargs)
+
+    result = Result(mode)
+    lags = []
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        monitor = asyncio.ensure_future(monitor_lag(lags))
+
+        async with create_client() as client:
+            async def lookup(resource):
+                async with semaphore:
+                    start = time.perf_counter()
+                    try:
+                        await client.finger(resource)
+                        ok = True
+                    except WebFingerException:
+                        ok = False
+                    result.record(time.perf_counter() - start, ok)
+
+            await asyncio.gather(*(lookup(r) for r in resources(count)))
+
+        monitor.cancel()
+
+    asyncio.run(main())
+    if len(lags) > 1:
+        lags.sort()
+        result.note = "loop lag p99 {:.2f}ms, max {:.2f}ms".format(
+            statistics.quantiles(lags, n=100, method="inclusive")[98] * 1e3,
+            lags[-1] * 1e3)
+
+    return result
+
+
+def run_inline(port, count, concurrency):
+    return run_async(port, count, concurrency, "inline",
+                     parse_threshold=None)
+
+
+def run_process(port, count, concurrency):
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor() as executor:
+        return run_async(port, count, concurrency, "process",
+                         executor=executor)
+
+
+def run_hedged(port, count, concurrency):
+    from webfinger.client.aiohttp import WebFingerClient
+    from webfinger.client.hedge import HedgePolicy
+
+    hedge = HedgePolicy()
+
+    def create_client():
+        return WebFingerClient(scheme="http", port=port, limit=concurrency,
+                               hedge=hedge)
+
+    result = run_async(port, count, concurrency, "hedged", create_client)
+    result.note = "hedged {hedged}, won {won}, skipped {skipped}; {}".format(
+        result.note, **hedge.stats())
+    return result
+
+
+def run_h2async(port, count, concurrency):
+    from webfinger.client.httpx import AsyncWebFingerClient
+
+    def create_client():
+        return AsyncWebFingerClient(scheme="http", port=port, http1=False)
+
+    return run_async(port, count, concurrency, "h2async", create_client)
+
+
+MODES = {"sync": run_sync, "threaded": run_threaded, "shared": run_shared,
+         "paced": run_paced, "async": run_async, "inline": run_inline,
+         "process": run_process, "hedged": run_hedged,
+         "httpx": run_httpx, "h2": run_h2, "h2async": run_h2async}
+
+HTTP2_MODES = {"h2", "h2async"}
+"""Modes run against the HTTP/2 server."""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--mode", default="all",
+                        help="comma-separated modes, or all (one of: "
+                             "{})".format(", ".join(MODES)))
+    parser.add_argument("-n", dest="count", type=int, default=1000,
+                        help="lookups per mode (default %(default)s)")
+    parser.add_argument("-c", dest="concurrency", default="16",
+                        help="threads/tasks, or a comma-separated list of "
+                             "them to sweep (default %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="server latency in seconds")
+    parser.add_argument("--tail-rate", type=float, default=0.0,
+                        help="fraction of requests answered --tail-latency "
+                             "later")
+    parser.add_argument("--tail-latency", type=float, default=0.0,
+                        help="extra latency of the tail, in seconds")
+    parser.add_argument("--server-rate", type=int, default=None,
+                        help="lookups per second the server allows")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests that fail with 500")
+    parser.add_argument("--content-type", default="application/jrd+json")
+    parser.add_argument("--links", type=int, default=4,
+                        help="links per JRD (controls the body size)")
+    args = parser.parse_args(argv)
+
+    options = {"latency": args.latency, "tail_rate": args.tail_rate,
+               "tail_latency": args.tail_latency,
+               "rate_limit": args.server_rate,
+               "error_rate": args.error_rate,
+               "content_type": args.content_type, "links": args.links}
+    modes = list(MODES) if args.mode == "all" else args.mode.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("unknown mode: {}".format(mode))
+
+    servers = {}
+
+    print("{:<9} {:>4} {:>8} {:>7} {:>10} {:>11} {:>11} {:>11}".format(
+        "mode", "c", "lookups", "errors", "lookups/s", "p50", "p99",
+        "cpu/lookup"))
+
+    try:
+        for mode in modes:
+            http2 = mode in HTTP2_MODES
+            if http2 not in servers:
+                servers[http2] = start_server(options, http2)
+
+            port = servers[http2][1]
+            for concurrency in map(int, args.concurrency.split(",")):
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                try:
+                    result = MODES[mode](port, args.count, concurrency)
+                except ImportError as e:
+                    print("{:<9} skipped: {}".format(mode, e))
+                    break
+
+                result.report(concurrency, time.perf_counter() - wall,
+                              time.process_time() - cpu)
+    finally:
+        for process, _ in servers.values():
+            process.terminate()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,48 @@
 #!/usr/bin/env python3
 
 
+import asyncio
+import contextlib
+import io
+import json
+import os
+import pickle
+import pstats
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import MappingProxyType
 from webfinger import (finger, WebFingerClient, WebFingerJRD,
-    WebFingerJRDError)
+    WebFingerJRDError, WebFingerBinaryError, WebFingerHTTPError,
+    WebFingerNetworkError, WebFingerTimeoutError,
+    WebFingerResponseTooLargeError)
+from benchmarks.fakeserver import FakeWebFingerServer
+from webfinger import cli, profiling
+from webfinger.client.hedge import HedgePolicy
+from webfinger.client.ratelimit import RateLimiter, parse_rate_limit
+from webfinger.client.retry import RetryPolicy, parse_retry_after
+from webfinger.crawler import Crawler, neighbours
+from webfinger.metrics import MetricsCollector
+from webfinger.objects import batch as batch_module
+from webfinger.objects.batch import JRDBatch, numpy, pyarrow
+from webfinger.objects.intern import InternTable
+from webfinger.objects.link import WebFingerLink
+
+
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
+else:
+    from benchmarks.fakeserver import FakeH2WebFingerServer
+    from webfinger.client.httpx import WebFingerClient as \
+        WebFingerHTTPXClient, AsyncWebFingerClient as AsyncWebFingerHTTPXClient
 
 
 try:
@@ -11,7 +50,6 @@ try:
 except ImportError:
     aiohttp = None
 else:
-    import asyncio
     from webfinger.client.aiohttp import WebFingerClient as WebFingerAioHTTPClient
 
 
@@ -24,6 +62,547 @@ class TestHostParsing(unittest.TestCase):
         self.assertEqual(host, "mst3k.interlinked.me")
 
 
+class TestURLBuilding(unittest.TestCase):
+    def test_default(self):
+        client = WebFingerClient()
+        self.assertEqual(client.build_url("mst3k.interlinked.me"),
+            "https://mst3k.interlinked.me/.well-known/webfinger")
+
+    def test_scheme_port(self):
+        client = WebFingerClient(scheme="http", port=8080)
+        self.assertEqual(client.build_url("127.0.0.1"),
+            "http://127.0.0.1:8080/.well-known/webfinger")
+
+
+class TestLocalServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+        self.client = WebFingerClient(scheme="http", port=self.server.port)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_subject(self):
+        wf = self.client.finger("acct:Elizafox@127.0.0.1")
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+
+    def test_xml(self):
+        self.server.content_type = "application/xrd+xml"
+        self.server.body = WebFingerJRD.from_json(self.server.body).to_xml()
+        wf = self.client.finger("acct:Elizafox@127.0.0.1")
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+        self.assertEqual(len(wf.links), 4)
+
+    def test_http_error(self):
+        self.server.error_rate = 1
+        self.assertRaises(WebFingerHTTPError, self.client.finger,
+                          "acct:Elizafox@127.0.0.1")
+
+    def test_redirect(self):
+        self.server.fail(1, 301, {"Location": "/.well-known/webfinger?"
+                                              "resource=acct:moved@127.0.0.1"})
+        wf = self.client.finger("acct:Elizafox@127.0.0.1")
+        self.assertEqual(wf.subject, "acct:moved@127.0.0.1")
+
+    def test_arguments_not_modified(self):
+        params = {"x": "y"}
+        headers = {"X-Test": "1"}
+        self.client.finger("acct:Elizafox@127.0.0.1", rel="self",
+                           params=params, headers=headers)
+        self.assertEqual(params, {"x": "y"})
+        self.assertEqual(headers, {"X-Test": "1"})
+
+    def test_threads(self):
+        errors = []
+
+        def lookups(thread):
+            try:
+                for i in range(20):
+                    resource = "acct:user{}-{}@127.0.0.1".format(thread, i)
+                    wf = self.client.finger(resource,
+                                            rel="self" if i % 2 else None)
+                    if wf.subject != resource:
+                        errors.append((resource, wf.subject))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=lookups, args=(i,))
+                   for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        # One session per thread, all sharing the client's connection pool
+        sessions = list(self.client._sessions)
+        self.assertLessEqual(len(sessions), 16)
+        for session in sessions:
+            self.assertIs(session.get_adapter("http://127.0.0.1"),
+                          self.client.adapter)
+
+    def lookups(self, client, count=2):
+        for _ in range(count):
+            client.finger("acct:Elizafox@127.0.0.1")
+
+        return client.pool_stats()["127.0.0.1"]
+
+    def test_pool_stats(self):
+        stats = self.lookups(self.client, 3)
+        self.assertEqual(stats, {"opened": 1, "reused": 2, "evicted": 0})
+
+    def test_no_keepalive(self):
+        client = WebFingerClient(scheme="http", port=self.server.port,
+                                 keepalive=False)
+        stats = self.lookups(client)
+        client.close()
+        self.assertEqual(stats, {"opened": 2, "reused": 0, "evicted": 0})
+
+    def test_idle_timeout(self):
+        client = WebFingerClient(scheme="http", port=self.server.port,
+                                 idle_timeout=0)
+        stats = self.lookups(client)
+        client.close()
+        self.assertEqual(stats, {"opened": 2, "reused": 0, "evicted": 1})
+
+    def test_pool_options(self):
+        client = WebFingerClient(pool_connections=2, pool_size=3,
+                                 pool_block=True)
+        client.thread_session()
+        self.assertEqual(client.adapter._pool_connections, 2)
+        self.assertEqual(client.adapter._pool_maxsize, 3)
+        self.assertTrue(client.adapter._pool_block)
+        client.close()
+
+
+class TestLookupEvents(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+        self.client = WebFingerClient(scheme="http", port=self.server.port)
+        self.events = []
+        self.client.add_listener(self.events.append)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_phases(self):
+        self.client.finger("acct:Elizafox@127.0.0.1")
+        self.client.finger("acct:Elizafox@127.0.0.1")
+
+        event, event2 = self.events
+        self.assertEqual(event.host, "127.0.0.1")
+        self.assertEqual(event.status, 200)
+        self.assertEqual(event.content_type, "application/jrd+json")
+        self.assertGreater(event.bytes, 0)
+        self.assertIsNone(event.error)
+        self.assertEqual(list(event.phases),
+                         ["connect", "ttfb", "download", "parse"])
+        self.assertLessEqual(sum(event.phases.values()), event.duration)
+
+        # The connection was reused
+        self.assertNotIn("connect", event2.phases)
+
+    def test_error(self):
+        self.server.error_rate = 1
+        self.assertRaises(WebFingerHTTPError, self.client.finger,
+                          "acct:Elizafox@127.0.0.1")
+        self.assertEqual(self.events[0].status, 500)
+        self.assertIsInstance(self.events[0].error, WebFingerHTTPError)
+
+    def test_remove_listener(self):
+        self.client.remove_listener(self.events.append)
+        self.client.finger("acct:Elizafox@127.0.0.1")
+        self.assertEqual(self.events, [])
+
+    def test_listener_error(self):
+        def listener(event):
+            raise ValueError
+
+        self.client.add_listener(listener)
+        with self.assertLogs("webfinger.client", "ERROR"):
+            self.client.finger("acct:Elizafox@127.0.0.1")
+        self.assertEqual(len(self.events), 1)
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+        self.events = []
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        client = WebFingerClient(scheme="http", port=self.server.port,
+                                 retry=RetryPolicy(backoff=0.01, **kwargs))
+        client.add_listener(self.events.append)
+        self.addCleanup(client.close)
+        return client
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT",
+                                           now=1445412460), 20)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"),
+                         0)
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_delay(self):
+        policy = RetryPolicy(retries=3, backoff=1, max_backoff=3,
+                             random=lambda: 0.999)
+        error = WebFingerHTTPError(status=503, headers={})
+        self.assertAlmostEqual(policy.delay(error, 0), 0.999)
+        self.assertAlmostEqual(policy.delay(error, 2), 2.997)
+        self.assertIsNone(policy.delay(error, 3))
+        self.assertIsNone(policy.delay(WebFingerHTTPError(status=404), 0))
+        self.assertIsNone(policy.delay(WebFingerJRDError(), 0))
+        self.assertAlmostEqual(policy.delay(WebFingerNetworkError(), 1),
+                               1.998)
+
+    def test_delay_retry_after(self):
+        policy = RetryPolicy(max_retry_after=10)
+        error = WebFingerHTTPError(status=429, headers={"Retry-After": "5"})
+        self.assertEqual(policy.delay(error, 0), 5)
+        error.headers["Retry-After"] = "11"
+        self.assertIsNone(policy.delay(error, 0))
+        self.assertIsNone(policy.delay(WebFingerHTTPError(
+            status=429, headers={"Retry-After": "5"}), 0,
+            time.monotonic() + 1))
+
+    def test_retries(self):
+        self.server.fail(2, 503)
+        wf = self.client().finger("acct:Elizafox@127.0.0.1")
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+        self.assertEqual(self.events[0].attempts, 3)
+
+    def test_backoff_phase(self):
+        self.server.fail(1, 503, {"Retry-After": "1"})
+        self.client().finger("acct:Elizafox@127.0.0.1")
+        event = self.events[0]
+        self.assertEqual(event.attempts, 2)
+        self.assertGreaterEqual(event.phases["backoff"], 0.9)
+        self.assertLess(event.phases["ttfb"], 0.5)
+
+    def test_retries_exhausted(self):
+        self.server.fail(3, 503, {"Retry-After": "0"})
+        with self.assertRaises(WebFingerHTTPError) as cm:
+            self.client().finger("acct:Elizafox@127.0.0.1")
+
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(self.events[0].attempts, 3)
+
+    def test_not_retried(self):
+        self.server.fail(1, 404)
+        self.assertRaises(WebFingerHTTPError, self.client().finger,
+                          "acct:Elizafox@127.0.0.1")
+        self.assertEqual(self.events[0].attempts, 1)
+
+    def test_deadline(self):
+        self.server.latency = 0.5
+        start = time.monotonic()
+        self.assertRaises(WebFingerNetworkError,
+                          self.client(deadline=0.2).finger,
+                          "acct:Elizafox@127.0.0.1")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+    def test_aiohttp(self):
+        async def lookup(**kwargs):
+            async with WebFingerAioHTTPClient(
+                    scheme="http", port=self.server.port,
+                    retry=RetryPolicy(backoff=0.01, **kwargs)) as client:
+                return await client.finger("acct:Elizafox@127.0.0.1")
+
+        self.server.fail(2, 502)
+        wf = asyncio.run(lookup())
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+
+        self.server.latency = 0.5
+        self.assertRaises(WebFingerTimeoutError, asyncio.run,
+                          lookup(deadline=0.2))
+
+    @unittest.skipIf(httpx is None, "httpx or h2 is not importable")
+    def test_httpx(self):
+        self.server.fail(2, 500)
+        with WebFingerHTTPXClient(scheme="http", port=self.server.port,
+                                  retry=RetryPolicy(backoff=0.01)) as client:
+            wf = client.finger("acct:Elizafox@127.0.0.1")
+
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+        self.events = []
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, limiter):
+        client = WebFingerClient(scheme="http", port=self.server.port,
+                                 rate_limit=limiter)
+        client.add_listener(self.events.append)
+        self.addCleanup(client.close)
+        return client
+
+    def test_parse_rate_limit(self):
+        self.assertEqual(parse_rate_limit({}), (None, None, None))
+        self.assertEqual(parse_rate_limit({"RateLimit-Limit": "100, 100;w=60",
+                                           "RateLimit-Remaining": "7",
+                                           "RateLimit-Reset": "30"}),
+                         (100, 7, 30))
+        # Mastodon
+        self.assertEqual(parse_rate_limit(
+            {"X-RateLimit-Limit": "300", "X-RateLimit-Remaining": "0",
+             "X-RateLimit-Reset": "2015-10-21T07:28:00.000Z"},
+            now=1445412460), (300, 0, 20))
+        self.assertEqual(parse_rate_limit({"RateLimit-Remaining": "many",
+                                           "RateLimit-Reset": "1445412480"},
+                                          now=1445412460), (None, None, 20))
+
+    def test_bucket(self):
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertEqual(limiter.take("example.com"), 0)
+        self.assertEqual(limiter.take("example.com"), 0)
+        self.assertAlmostEqual(limiter.take("example.com"), 0.1, 2)
+        self.assertAlmostEqual(limiter.take("example.com"), 0.1, 2)
+        self.assertEqual(limiter.take("example.org"), 0)
+        self.assertEqual(limiter.state("example.com")["requests"], 2)
+        self.assertIsNone(limiter.state("example.net"))
+
+        self.assertAlmostEqual(limiter.acquire("example.com"), 0.1, 2)
+        self.assertAlmostEqual(limiter.state("example.com")["waited"], 0.1,
+                               2)
+
+    def test_429(self):
+        limiter = RateLimiter(rate=10)
+        limiter.update("example.com", 429, {"Retry-After": "2"})
+        state = limiter.state("example.com")
+        self.assertEqual(state["rate"], 5)
+        self.assertEqual(state["limited"], 1)
+        self.assertAlmostEqual(state["blocked_for"], 2, 1)
+        self.assertAlmostEqual(limiter.take("example.com"), 2, 1)
+        self.assertRaises(WebFingerTimeoutError, limiter.acquire,
+                          "example.com", 0.5)
+
+        limiter.update("example.com", 200, {})
+        self.assertEqual(limiter.state("example.com")["rate"], 6)
+
+    def test_remaining(self):
+        limiter = RateLimiter(rate=10)
+        limiter.update("example.com", 200, {"RateLimit-Limit": "100",
+                                            "RateLimit-Remaining": "5",
+                                            "RateLimit-Reset": "10"})
+        state = limiter.state("example.com")
+        self.assertEqual(state["rate"], 0.5)
+        self.assertEqual(state["limit"], 100)
+        self.assertEqual(state["remaining"], 5)
+        self.assertLess(state["tokens"], 5.1)
+
+        limiter.update("example.com", 200, {"RateLimit-Remaining": "0",
+                                            "RateLimit-Reset": "10"})
+        self.assertAlmostEqual(limiter.take("example.com"), 10, 1)
+
+    def test_max_hosts(self):
+        limiter = RateLimiter(max_hosts=2)
+        for host in ("a.example", "b.example", "a.example", "c.example"):
+            limiter.take(host)
+
+        self.assertEqual(set(limiter.state()), {"a.example", "c.example"})
+
+    def test_client(self):
+        client = self.client(RateLimiter(rate=20, burst=1))
+        start = time.monotonic()
+        for i in range(5):
+            client.finger("acct:user{}@127.0.0.1".format(i))
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        self.assertNotIn("ratelimit", self.events[0].phases)
+        self.assertIn("ratelimit", self.events[1].phases)
+
+    def test_threads(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        client = self.client(limiter)
+        start = time.monotonic()
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(client.finger,
+                              ["acct:user{}@127.0.0.1".format(i)
+                               for i in range(16)]))
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+        self.assertEqual(limiter.state("127.0.0.1")["requests"], 16)
+
+    def test_server_limit(self):
+        limiter = RateLimiter()
+        client = self.client(limiter)
+        self.server.fail(1, 429, {"RateLimit-Remaining": "0",
+                                  "RateLimit-Reset": "0.3"})
+        self.assertRaises(WebFingerHTTPError, client.finger,
+                          "acct:Elizafox@127.0.0.1")
+        self.assertEqual(limiter.state("127.0.0.1")["limited"], 1)
+
+        start = time.monotonic()
+        client.finger("acct:Elizafox@127.0.0.1")
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+    def test_aiohttp(self):
+        limiter = RateLimiter(rate=20, burst=1)
+
+        async def lookups():
+            async with WebFingerAioHTTPClient(
+                    scheme="http", port=self.server.port,
+                    rate_limit=limiter) as client:
+                await asyncio.gather(*(
+                    client.finger("acct:user{}@127.0.0.1".format(i))
+                    for i in range(4)))
+
+        start = time.monotonic()
+        asyncio.run(lookups())
+        self.assertGreaterEqual(time.monotonic() - start, 0.14)
+        self.assertEqual(limiter.state("127.0.0.1")["requests"], 4)
+
+
+class TestResponseSize(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer(links=100).start()
+        self.size = len(self.server.body.replace(
+            "acct:__resource__@example.com", "acct:Elizafox@127.0.0.1"))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def lookup(self, cls=WebFingerClient, limit=1000):
+        client = cls(scheme="http", port=self.server.port,
+                     max_response_bytes=limit)
+        if asyncio.iscoroutinefunction(client.finger):
+            async def lookup():
+                try:
+                    return await client.finger("acct:Elizafox@127.0.0.1")
+                finally:
+                    await client.close()
+
+            return asyncio.run(lookup())
+
+        try:
+            return client.finger("acct:Elizafox@127.0.0.1")
+        finally:
+            client.close()
+
+    def check(self, cls=WebFingerClient):
+        self.assertEqual(len(self.lookup(cls, self.size).links), 100)
+
+        with self.assertRaises(WebFingerResponseTooLargeError) as cm:
+            self.lookup(cls)
+
+        self.assertEqual(cm.exception.size, self.size)
+        self.assertEqual(cm.exception.limit, 1000)
+
+        self.server.content_length = False
+        self.assertEqual(len(self.lookup(cls, self.size).links), 100)
+        with self.assertRaises(WebFingerResponseTooLargeError) as cm:
+            self.lookup(cls)
+
+        self.assertIsNone(cm.exception.size)
+
+        self.server.fail(1, 404)
+        self.assertRaises(WebFingerHTTPError, self.lookup, cls)
+
+    def test_requests(self):
+        self.check()
+
+    def test_events(self):
+        client = WebFingerClient(scheme="http", port=self.server.port,
+                                 max_response_bytes=self.size)
+        events = []
+        client.add_listener(events.append)
+        client.finger("acct:Elizafox@127.0.0.1")
+        client.close()
+        self.assertEqual(events[0].bytes, self.size)
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+    def test_aiohttp(self):
+        self.check(WebFingerAioHTTPClient)
+
+    @unittest.skipIf(httpx is None, "httpx or h2 is not importable")
+    def test_httpx(self):
+        self.check(WebFingerHTTPXClient)
+        self.server.content_length = True
+        self.check(AsyncWebFingerHTTPXClient)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+        self.client = WebFingerClient(scheme="http", port=self.server.port)
+        self.metrics = MetricsCollector()
+        self.client.add_listener(self.metrics)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_client(self):
+        self.client.finger("acct:Elizafox@127.0.0.1")
+        self.server.error_rate = 1
+        self.assertRaises(WebFingerHTTPError, self.client.finger,
+                          "acct:Elizafox@127.0.0.1")
+
+        text = self.metrics.exposition()
+        self.assertIn('webfinger_lookups_total{host="127.0.0.1",'
+                      'outcome="success"} 1', text)
+        self.assertIn('webfinger_lookups_total{host="127.0.0.1",'
+                      'outcome="WebFingerHTTPError"} 1', text)
+        self.assertIn('webfinger_lookup_duration_seconds_count'
+                      '{host="127.0.0.1"} 2', text)
+        self.assertIn('webfinger_response_size_bytes_bucket'
+                      '{host="127.0.0.1",le="+Inf"} 2', text)
+        self.assertIn("webfinger_inflight_requests 0", text)
+
+    def test_threads(self):
+        def record():
+            for i in range(1000):
+                self.metrics.record("example.com", "success", 0.01, 100)
+
+        threads = [threading.Thread(target=record) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        lookups, latency, size, inflight = self.metrics.collect()
+        self.assertEqual(lookups[("example.com", "success")], 8000)
+        self.assertEqual(sum(latency["example.com"][:-1]), 8000)
+
+    def test_max_hosts(self):
+        metrics = MetricsCollector(max_hosts=1)
+        metrics.record("example.com")
+        metrics.record("example.org")
+        lookups = metrics.collect()[0]
+        self.assertEqual(set(lookups), {("example.com", "success"),
+                                        ("other", "success")})
+
+    def test_openmetrics(self):
+        self.metrics.set_cache_size(3)
+        text = self.metrics.exposition(openmetrics=True)
+        self.assertIn("# TYPE webfinger_lookups counter", text)
+        self.assertIn("webfinger_cache_size 3", text)
+        self.assertTrue(text.endswith("# EOF\n"))
+
+    def test_server(self):
+        self.server.metrics = MetricsCollector()
+        self.client.finger("acct:Elizafox@127.0.0.1")
+        text = self.client.thread_session().get(
+            "http://127.0.0.1:{}/metrics".format(self.server.port)).text
+        self.assertIn('webfinger_lookups_total{host="127.0.0.1",'
+                      'outcome="success"} 1', text)
+
+
 class TestWebFingerRequest(unittest.TestCase):
     def setUp(self):
         self.client = WebFingerClient()
@@ -56,6 +635,31 @@ class TestWebFingerResponse(unittest.TestCase):
     def test_subject(self):
         self.assertEqual(self.response.subject, "acct:Elizafox@mst3k.interlinked.me")
 
+    def test_caller_dict_unchanged(self):
+        links = [{"rel": "self", "href": "https://example.com/users/user"}]
+        properties = {"http://example.com/nil": None}
+        aliases = ["https://example.com/@user"]
+        jrd = {"subject": "acct:user@example.com", "links": links,
+               "properties": properties, "aliases": aliases}
+        response = WebFingerJRD(jrd)
+        response.add_alias("https://example.com/users/user")
+        self.assertIs(jrd["links"], links)
+        self.assertIs(jrd["properties"], properties)
+        self.assertEqual(aliases, ["https://example.com/@user"])
+        self.assertEqual(response.jrd["aliases"],
+                         ["https://example.com/@user",
+                          "https://example.com/users/user"])
+
+    def test_read_only_mapping(self):
+        jrd = MappingProxyType({"subject": "acct:user@example.com",
+                                "properties": {"http://example.com/p": "v"},
+                                "links": [{"rel": "self",
+                                           "href": "https://example.com/u"}]})
+        response = WebFingerJRD(jrd)
+        self.assertEqual(response.properties, {"http://example.com/p": "v"})
+        self.assertEqual(response.first(rel="self").href,
+                         "https://example.com/u")
+
     def test_rel_longname(self):
         rel = self.response.rel("http://webfinger.net/rel/profile-page", "href")
         self.assertEqual(rel, ["https://mst3k.interlinked.me/@Elizafox"])
@@ -67,6 +671,67 @@ class TestWebFingerResponse(unittest.TestCase):
     def test_invalid_rel(self):
         self.assertEqual(self.response.rel(""), None)
 
+    def test_find(self):
+        links = self.response.find(rel="self", type="application/activity+json")
+        self.assertEqual([x.href for x in links],
+                         ["https://mst3k.interlinked.me/users/Elizafox"])
+        self.assertEqual(self.response.find(rel="self", type="text/html"), ())
+        self.assertEqual(len(self.response.find(type="text/html")), 1)
+        self.assertEqual(self.response.find(), ())
+
+    def test_find_href(self):
+        links = self.response.find(
+            href="https://mst3k.interlinked.me/@Elizafox")
+        self.assertEqual(len(links), 1)
+        self.assertEqual(self.response.find(
+            rel="salmon", href="https://mst3k.interlinked.me/@Elizafox"), ())
+
+    def test_first(self):
+        link = self.response.first(rel="profile")
+        self.assertEqual(link.href, "https://mst3k.interlinked.me/@Elizafox")
+        self.assertIsNone(self.response.first(rel="http://invalid.example"))
+
+    def test_add_link_index(self):
+        self.response.add_link("http://example.com/rel", type="text/plain",
+                               href="https://example.com")
+        self.assertEqual(self.response.rel("http://example.com/rel", "href"),
+                         ["https://example.com"])
+        self.assertEqual(self.response.first(type="text/plain").href,
+                         "https://example.com")
+
+    def test_modify_link_index(self):
+        link = self.response.first(rel="profile")
+        link["type"] = "text/plain"
+        self.assertEqual(self.response.find(rel="profile", type="text/html"),
+                         ())
+        self.assertIs(self.response.first(type="text/plain"), link)
+
+        link["href"] = "https://example.com"
+        self.assertIsNone(self.response.first(
+            href="https://mst3k.interlinked.me/@Elizafox"))
+        self.assertIs(self.response.first(href="https://example.com"), link)
+
+        link["rel"] = "http://example.com/rel"
+        self.assertIsNone(self.response.first(rel="profile"))
+        self.assertNotIn("profile", self.response.link_rels)
+        self.assertEqual(self.response.rel("http://example.com/rel", "href"),
+                         ["https://example.com"])
+
+        del link["type"]
+        self.assertIsNone(self.response.first(type="text/plain"))
+        self.assertEqual(self.response.find(href="https://example.com"),
+                         (link,))
+
+    def test_link_repr(self):
+        link = WebFingerLink("self", href="https://example.com")
+        self.assertEqual(repr(link), "WebFingerLink({'rel': 'self', "
+                                     "'href': 'https://example.com'})")
+
+    def test_frozen_find(self):
+        frozen = self.response.freeze()
+        self.assertEqual(frozen.first(rel="salmon").href,
+                         "https://mst3k.interlinked.me/api/salmon/1")
+
     def test_link_rels_dict(self):
         self.assertEqual(self.response.link_rels["profile"],
                          [{"href": "https://mst3k.interlinked.me/@Elizafox",
@@ -147,6 +812,19 @@ class TestWebFingerBuild(unittest.TestCase):
         self.builder.add_property("http://uri.example", None)
         self.assertIn("http://uri.example", self.builder.jrd["properties"])
 
+    def test_add_link_shared(self):
+        link = self.builder.links[-1]
+        link["href"] = "https://mst3k.interlinked.me/@Elizafox"
+        self.assertEqual(json.loads(self.builder.to_json())["links"][-1]["href"],
+                         "https://mst3k.interlinked.me/@Elizafox")
+
+    def test_add_link_caller_list(self):
+        links = []
+        builder = WebFingerJRD({"subject": "acct:user@example.com",
+                                "links": links})
+        builder.add_link("profile", href="https://example.com/@user")
+        self.assertEqual(links, [])
+
 
 class TestWebFingerJSON(unittest.TestCase):
     def setUp(self):
@@ -268,19 +946,971 @@ class TestWebFingerXML(unittest.TestCase):
         self.assertEqual(self.response.aliases, self.response2.aliases)
 
 
+class TestWebFingerValidator(unittest.TestCase):
+    def setUp(self):
+        self.jrd = {"subject": "acct:Elizafox@mst3k.interlinked.me",
+                    "aliases": ["https://mst3k.interlinked.me/@Elizafox"],
+                    "properties": {"http://example.com/prop": "value",
+                                   "http://example.com/nil": None},
+                    "links": [{"rel": "self",
+                               "type": "application/activity+json",
+                               "href": "https://mst3k.interlinked.me/users/Elizafox",
+                               "properties": {"http://example.com/p": None}},
+                              {"rel": "http://webfinger.net/rel/profile-page",
+                               "href": "invalid"}]}
+
+    def test_error_path(self):
+        with self.assertRaises(WebFingerJRDError) as cm:
+            WebFingerJRD(self.jrd)
+        self.assertEqual(cm.exception.args[1], "links[1].href")
+
+    def test_property_error_path(self):
+        self.jrd["links"][1]["href"] = "https://mst3k.interlinked.me/@Elizafox"
+        self.jrd["properties"]["http://example.com/bad"] = 4
+        with self.assertRaises(WebFingerJRDError) as cm:
+            WebFingerJRD(self.jrd)
+        self.assertEqual(cm.exception.args[1],
+                         "properties['http://example.com/bad']")
+
+    def test_missing_subject(self):
+        del self.jrd["subject"]
+        self.assertRaises(WebFingerJRDError, WebFingerJRD, self.jrd)
+
+    def test_missing_rel(self):
+        del self.jrd["links"][0]["rel"]
+        with self.assertRaises(WebFingerJRDError) as cm:
+            WebFingerJRD(self.jrd)
+        self.assertEqual(cm.exception.args[1], "links[0].rel")
+
+    def test_not_mapping(self):
+        self.assertRaises(WebFingerJRDError, WebFingerJRD, [])
+
+    def test_link_properties(self):
+        link = WebFingerLink("self", properties={"http://example.com": "x",
+                                                 "http://example.org": None})
+        self.assertEqual(link.properties["http://example.com"], "x")
+
+    def test_trusted(self):
+        response = WebFingerJRD(self.jrd, trusted=True)
+        self.assertEqual(response.links[1].href, "invalid")
+        self.assertEqual(response.rel("profile", "href"), ["invalid"])
+
+
+class TestWebFingerFrozen(unittest.TestCase):
+    def setUp(self):
+        jrd = {"subject": "acct:Elizafox@mst3k.interlinked.me",
+               "aliases": ["https://mst3k.interlinked.me/@Elizafox"],
+               "links": [{"href": "https://mst3k.interlinked.me/@Elizafox",
+                          "rel": "http://webfinger.net/rel/profile-page",
+                          "type": "text/html",
+                          "titles": {"Profile": "en"}},
+                         {"href": "https://mst3k.interlinked.me/users/Elizafox",
+                          "rel": "self",
+                          "type": "application/activity+json"}]}
+        self.response = WebFingerJRD(jrd)
+        self.frozen = self.response.freeze()
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.frozen.subject = "acct:test@example.com"
+        with self.assertRaises(TypeError):
+            self.frozen.links[0]["href"] = "https://example.com"
+        with self.assertRaises(TypeError):
+            self.frozen.links[0]["titles"]["Profile"] = "de"
+        self.assertIsInstance(self.frozen.aliases, tuple)
+
+    def test_hashable(self):
+        self.assertEqual(self.frozen, self.response.freeze())
+        self.assertEqual(hash(self.frozen), hash(self.response.freeze()))
+        self.assertEqual(len({self.frozen, self.response.freeze()}), 1)
+
+    def test_rel(self):
+        self.assertEqual(self.frozen.rel("profile", "href"),
+                         ["https://mst3k.interlinked.me/@Elizafox"])
+
+    def test_to_json(self):
+        self.assertEqual(WebFingerJRD.from_json(self.frozen.to_json()).jrd,
+                         self.response.jrd)
+
+    def test_thaw_shares_links(self):
+        thawed = self.frozen.thaw()
+        self.assertIs(thawed.links[0], self.frozen.links[0])
+
+        thawed.add_alias("https://example.com/alias")
+        thawed.add_link("profile", href="https://example.com/profile")
+        self.assertEqual(len(self.frozen.aliases), 1)
+        self.assertEqual(len(self.frozen.links), 2)
+
+        refrozen = thawed.freeze()
+        self.assertIs(refrozen.links[1], self.frozen.links[1])
+        self.assertNotEqual(refrozen, self.frozen)
+
+    def test_thaw_link(self):
+        link = self.frozen.links[0].thaw()
+        link["href"] = "https://example.com"
+        self.assertEqual(self.frozen.links[0].href,
+                         "https://mst3k.interlinked.me/@Elizafox")
+
+    def test_thaw_jrd_link(self):
+        thawed = self.frozen.thaw()
+        link = thawed.thaw_link(0)
+        self.assertIs(thawed.thaw_link(0), link)
+        link["href"] = "https://example.com"
+
+        self.assertEqual(json.loads(thawed.to_json())["links"][0]["href"],
+                         "https://example.com")
+        self.assertEqual(
+            WebFingerJRD.from_bytes(thawed.to_bytes()).links[0].href,
+            "https://example.com")
+        self.assertEqual(thawed.find(href="https://example.com"), (link,))
+        self.assertEqual(thawed.find(
+            href="https://mst3k.interlinked.me/@Elizafox"), ())
+        self.assertEqual(thawed.rel("profile", "href"),
+                         ["https://example.com"])
+        self.assertEqual(self.frozen.links[0].href,
+                         "https://mst3k.interlinked.me/@Elizafox")
+
+        thawed.replace_link(0, self.frozen.links[0])
+        self.assertEqual(thawed.to_json(), self.frozen.thaw().to_json())
+        self.assertEqual(thawed.find(href="https://example.com"), ())
+        link["href"] = "https://example.com/other"
+        self.assertEqual(thawed.find(href="https://example.com/other"), ())
+
+
+class TestWebFingerBinary(unittest.TestCase):
+    def setUp(self):
+        jrd = {"subject": "acct:Elizafox@mst3k.interlinked.me",
+               "aliases": ["https://mst3k.interlinked.me/@Elizafox"],
+               "properties": {"http://example.com/nil": None},
+               "links": [{"href": "https://mst3k.interlinked.me/@Elizafox",
+                          "rel": "http://webfinger.net/rel/profile-page",
+                          "type": "text/html",
+                          "titles": {"Profile": "en"}},
+                         {"href": "https://mst3k.interlinked.me/users/Elizafox",
+                          "rel": "self",
+                          "type": "application/activity+json"}]}
+        self.response = WebFingerJRD(jrd)
+
+    def test_roundtrip(self):
+        response = WebFingerJRD.from_bytes(self.response.to_bytes())
+        self.assertEqual(response.jrd, self.response.jrd)
+        self.assertEqual(response.first(rel="self").href,
+                         "https://mst3k.interlinked.me/users/Elizafox")
+
+    def test_frozen_roundtrip(self):
+        data = self.response.freeze().to_bytes()
+        self.assertEqual(data, self.response.to_bytes())
+
+    def test_version_mismatch(self):
+        data = self.response.to_bytes()
+        data = data[:4] + bytes((data[4] + 1,)) + data[5:]
+        self.assertRaises(WebFingerBinaryError, WebFingerJRD.from_bytes, data)
+
+    def test_python_mismatch(self):
+        data = self.response.to_bytes()
+        data = data[:6] + bytes((data[6] + 1,)) + data[7:]
+        with self.assertRaises(WebFingerBinaryError) as cm:
+            WebFingerJRD.from_bytes(data)
+
+        self.assertIn("Python", str(cm.exception))
+
+    def test_invalid(self):
+        self.assertRaises(WebFingerBinaryError, WebFingerJRD.from_bytes,
+                          b"{}")
+        with self.assertRaises(WebFingerBinaryError) as cm:
+            WebFingerJRD.from_bytes(b"WFJR")
+
+        self.assertIn("truncated", str(cm.exception))
+        self.assertRaises(WebFingerBinaryError, WebFingerJRD.from_bytes,
+                          self.response.to_bytes()[:20])
+
+    def test_pickle(self):
+        response = pickle.loads(pickle.dumps(self.response))
+        self.assertEqual(response.jrd, self.response.jrd)
+        self.assertEqual(response.links, self.response.links)
+
+    def test_pickle_frozen(self):
+        frozen = self.response.freeze()
+        self.assertEqual(pickle.loads(pickle.dumps(frozen)), frozen)
+        self.assertEqual(pickle.loads(pickle.dumps(frozen.links[0])),
+                         frozen.links[0])
+
+    def test_pickle_link(self):
+        link = pickle.loads(pickle.dumps(self.response.links[0]))
+        self.assertEqual(link, self.response.links[0])
+
+
+class TestWebFingerIntern(unittest.TestCase):
+    def setUp(self):
+        self.jrd = \
+            '{"subject": "acct:Elizafox@mst3k.interlinked.me",' \
+            ' "links": [{"rel": "http://ostatus.org/schema/1.0/subscribe",' \
+            '            "template": "https://mst3k.interlinked.me/authorize_follow?acct={uri}"},' \
+            '           {"rel": "self", "type": "application/activity+json",' \
+            '            "href": "https://mst3k.interlinked.me/users/Elizafox",' \
+            '            "properties": {"http://example.com/prop": null}}]}'
+
+    def test_strings_shared(self):
+        response = WebFingerJRD.from_json(self.jrd)
+        response2 = WebFingerJRD.from_json(self.jrd)
+        self.assertIs(response.links[1].type, response2.links[1].type)
+        self.assertIs(response.links[1].rel, response2.links[1].rel)
+        key, = response.links[1].properties
+        key2, = response2.links[1].properties
+        self.assertIs(key, key2)
+
+    def test_links_shared_with_jrd(self):
+        response = WebFingerJRD.from_json(self.jrd)
+        response.links[1]["href"] = "https://example.com"
+        self.assertEqual(response.jrd["links"][1]["href"],
+                         "https://example.com")
+
+    def test_flyweight(self):
+        frozen = WebFingerJRD.from_json(self.jrd).freeze(flyweight=True)
+        frozen2 = WebFingerJRD.from_json(self.jrd).freeze(flyweight=True)
+        self.assertIs(frozen.links[0], frozen2.links[0])
+
+        frozen3 = WebFingerJRD.from_json(self.jrd).freeze()
+        self.assertIsNot(frozen.links[0], frozen3.links[0])
+
+    def test_bounded(self):
+        table = InternTable(("a",), maxsize=2)
+        self.assertEqual(table.intern("b"), "b")
+        table.intern("c")
+        self.assertEqual(len(table), 2)
+        self.assertNotIn("c", table)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.jrd = WebFingerJRD(
+            {"subject": "acct:Elizafox@mst3k.interlinked.me",
+             "links": [{"rel": "self", "type": "application/activity+json",
+                        "href": "https://mst3k.interlinked.me/users/Elizafox"}]})
+
+    def test_disabled(self):
+        self.assertIsNone(profiling.active)
+        self.assertIs(profiling.stage("parse"), profiling.stage("index"))
+
+    def test_stages(self):
+        with profiling.profile() as profiler:
+            WebFingerJRD.from_json(self.jrd.to_json())
+            WebFingerJRD.from_xml(self.jrd.to_xml())
+            WebFingerJRD.from_bytes(self.jrd.to_bytes())
+
+        self.assertIsNone(profiling.active)
+        self.assertEqual(profiler.stats["parse"][0], 3)
+        self.assertEqual(profiler.stats["serialize"][0], 3)
+        self.assertEqual(profiler.stats["validate"][0], 2)
+        self.assertEqual(profiler.stats["index"][0], 3)
+        self.assertIn("serialize", profiler.report())
+
+    def test_sampling(self):
+        with profiling.profile(sample_rate=0.5, seed=1) as profiler:
+            for _ in range(100):
+                self.jrd.to_json()
+
+        self.assertTrue(0 < profiler.stats["serialize"][0] < 100)
+
+    def test_pstats(self):
+        with profiling.profile(pstats_rate=1.0) as profiler:
+            WebFingerJRD.from_json(self.jrd.to_json())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "webfinger.pstats")
+            self.assertTrue(profiler.dump_stats(path))
+            stats = pstats.Stats(path)
+            self.assertTrue(any(func[2] == "loads" for func in stats.stats))
+
+    def test_no_pstats(self):
+        with profiling.profile() as profiler:
+            self.jrd.to_json()
+
+        self.assertFalse(profiler.dump_stats(os.devnull))
+
+    def test_invalid_environment(self):
+        env = dict(os.environ, WEBFINGER_PROFILE="1O%")
+        result = subprocess.run(
+            [sys.executable, "-c", "import webfinger.profiling as p\n"
+             "print(p.active)"], env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.strip(), "None")
+        self.assertIn("not profiling", result.stderr)
+
+
+class TestImportTime(unittest.TestCase):
+    # Generous, as this is about not importing the client stack (~100ms)
+    BUDGET = 0.05
+
+    def run_python(self, *args):
+        return subprocess.run([sys.executable] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def imported(self, statement):
+        result = self.run_python("-c", statement + "\nimport sys\n"
+                                 "print('\\n'.join(sys.modules))")
+        return set(result.stdout.split())
+
+    def test_import_time(self):
+        result = self.run_python("-X", "importtime", "-c", "import webfinger")
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and \
+                    line.rsplit("|", 1)[1].strip() == "webfinger":
+                cumulative = int(line.split("|")[1]) / 1e6
+                break
+        else:
+            self.fail("webfinger not in -X importtime output")
+
+        self.assertLess(cumulative, self.BUDGET)
+
+    def test_package(self):
+        modules = self.imported("import webfinger")
+        self.assertIn("webfinger", modules)
+        for module in ("requests", "aiohttp", "defusedxml",
+                       "webfinger.client", "webfinger.objects.jrd"):
+            self.assertNotIn(module, modules)
+
+    def test_jrd(self):
+        modules = self.imported("from webfinger import WebFingerJRD")
+        self.assertIn("webfinger.objects.jrd", modules)
+        self.assertNotIn("requests", modules)
+        self.assertNotIn("defusedxml", modules)
+
+    def test_lazy_exports(self):
+        import webfinger
+        self.assertIs(webfinger.WebFingerClient, WebFingerClient)
+        self.assertIn("WebFingerJRD", dir(webfinger))
+        with self.assertRaises(AttributeError):
+            webfinger.NoSuchThing
+
+
+class TestJRDBatch(unittest.TestCase):
+    backend = "python"
+
+    def setUp(self):
+        self.jrds = []
+        for i, host in enumerate(("mst3k.interlinked.me", "example.com",
+                                  "mst3k.interlinked.me")):
+            user = "user{}".format(i)
+            self.jrds.append(json.dumps(
+                {"subject": "acct:{}@{}".format(user, host),
+                 "links": [{"rel": "http://webfinger.net/rel/profile-page",
+                            "type": "text/html",
+                            "href": "https://{}/@{}".format(host, user)},
+                           {"rel": "self",
+                            "type": "application/activity+json",
+                            "href": "https://{}/users/{}".format(host, user)},
+                           {"rel": "http://ostatus.org/schema/1.0/subscribe",
+                            "template": "https://{}/follow?uri={{uri}}".format(
+                                host)}]}))
+        self.batch = JRDBatch.from_json(self.jrds, backend=self.backend)
+
+    def test_rows(self):
+        self.assertEqual(len(self.batch), 9)
+        self.assertEqual(next(iter(self.batch.rows())),
+                         ("acct:user0@mst3k.interlinked.me",
+                          "http://webfinger.net/rel/profile-page", "text/html",
+                          "https://mst3k.interlinked.me/@user0"))
+
+    def test_from_jrds(self):
+        batch = JRDBatch.from_jrds(
+            (WebFingerJRD.from_json(x) for x in self.jrds),
+            backend=self.backend)
+        self.assertEqual(list(batch.rows()), list(self.batch.rows()))
+
+    def test_filter(self):
+        batch = self.batch.filter(rel="self", type="application/activity+json")
+        self.assertEqual(batch.column("href"),
+                         ["https://mst3k.interlinked.me/users/user0",
+                          "https://example.com/users/user1",
+                          "https://mst3k.interlinked.me/users/user2"])
+        self.assertEqual(len(self.batch.filter(rel="profile")), 3)
+        self.assertEqual(len(self.batch.filter(type="text/html")), 3)
+        self.assertEqual(len(self.batch.filter(rel="self",
+                                               type="text/html")), 0)
+        self.assertEqual(len(self.batch.filter(rel="http://invalid")), 0)
+
+    def test_group_by_host(self):
+        groups = self.batch.group_by_host()
+        self.assertEqual(sorted(groups), ["example.com", "mst3k.interlinked.me"])
+        self.assertEqual(len(groups["mst3k.interlinked.me"]), 6)
+        self.assertEqual(set(groups["example.com"].column("subject")),
+                         {"acct:user1@example.com"})
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not importable")
+    def test_parquet(self):
+        buf = io.BytesIO()
+        self.batch.to_parquet(buf)
+        buf.seek(0)
+        table = pyarrow.parquet.read_table(buf)
+        self.assertEqual(table.column("type").to_pylist(),
+                         self.batch.column("type"))
+
+    def test_without_pyarrow(self):
+        self.addCleanup(setattr, batch_module, "pyarrow",
+                        batch_module.pyarrow)
+        batch_module.pyarrow = None
+        self.assertRaises(ImportError, self.batch.to_arrow)
+        self.assertRaises(ImportError, self.batch.to_parquet, io.BytesIO())
+
+
+@unittest.skipIf(numpy is None, "numpy is not importable")
+class TestJRDBatchNumPy(TestJRDBatch):
+    backend = "numpy"
+
+
 @unittest.skipIf(aiohttp is None, "aiohttp is not importable")
 class TestAioHTTPClient(unittest.TestCase):
     def setUp(self):
         self.client = WebFingerAioHTTPClient()
-        self.loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
 
     def tearDown(self):
         self.loop.run_until_complete(self.client.close())
+        self.loop.close()
 
     def test_subject(self):
         wf = self.loop.run_until_complete(self.client.finger("acct:Elizafox@mst3k.interlinked.me"))
         self.assertEqual(wf.subject, "acct:Elizafox@mst3k.interlinked.me")
 
 
+@unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+class TestAioHTTPLocalServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        return WebFingerAioHTTPClient(scheme="http", port=self.server.port,
+                                      **kwargs)
+
+    def test_subject(self):
+        async def lookup():
+            async with self.client() as client:
+                return await client.finger("acct:Elizafox@127.0.0.1")
+
+        wf = asyncio.run(lookup())
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+
+    def test_redirect(self):
+        async def lookup():
+            async with self.client() as client:
+                return await client.finger("acct:Elizafox@127.0.0.1")
+
+        self.server.fail(1, 301, {"Location": "/.well-known/webfinger?"
+                                              "resource=acct:moved@127.0.0.1"})
+        wf = asyncio.run(lookup())
+        self.assertEqual(wf.subject, "acct:moved@127.0.0.1")
+
+    def test_context_manager_closes(self):
+        async def lookup():
+            async with self.client() as client:
+                await client.finger("acct:Elizafox@127.0.0.1")
+
+            return client
+
+        client = asyncio.run(lookup())
+        self.assertTrue(client.session.closed)
+
+    def test_connector(self):
+        async def connector():
+            async with self.client(limit=5, limit_per_host=2, dns_ttl=60,
+                                   keepalive_timeout=None) as client:
+                return client.session.connector
+
+        connector = asyncio.run(connector())
+        self.assertEqual(connector.limit, 5)
+        self.assertEqual(connector.limit_per_host, 2)
+        self.assertTrue(connector.force_close)
+
+    def test_connection_reuse(self):
+        events = []
+
+        async def lookups():
+            async with self.client() as client:
+                client.add_listener(events.append)
+                for i in range(5):
+                    await client.finger("acct:user{}@127.0.0.1".format(i))
+
+        asyncio.run(lookups())
+        connected = [e for e in events if "connect" in e.phases]
+        self.assertEqual(len(connected), 1)
+        self.assertEqual([e.error for e in events], [None] * 5)
+
+    def test_timeout(self):
+        self.server.latency = 0.5
+
+        async def lookup():
+            async with self.client(timeout=0.1) as client:
+                await client.finger("acct:Elizafox@127.0.0.1")
+
+        self.assertRaises(WebFingerNetworkError, asyncio.run, lookup())
+
+    def parse(self, **kwargs):
+        async def lookup():
+            async with self.client(**kwargs) as client:
+                wf = await client.finger("acct:Elizafox@127.0.0.1")
+                return wf, client
+
+        return asyncio.run(lookup())
+
+    def test_parse_executor(self):
+        class Executor(ThreadPoolExecutor):
+            submitted = 0
+
+            def submit(self, *args, **kwargs):
+                self.submitted += 1
+                return super().submit(*args, **kwargs)
+
+        with Executor(1) as executor:
+            wf, client = self.parse(parse_threshold=0, executor=executor)
+            self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+            self.assertEqual(executor.submitted, 1)
+
+            self.parse(parse_threshold=None, executor=executor)
+            self.parse(parse_threshold=len(self.server.body) + 100,
+                       executor=executor)
+            self.assertEqual(executor.submitted, 1)
+
+    def test_parse_own_executor(self):
+        wf, client = self.parse(parse_threshold=0)
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+        self.assertIsNone(client._executor)
+
+    def test_parse_process_pool(self):
+        self.server.stop()
+        self.server = FakeWebFingerServer(
+            content_type="application/xrd+xml").start()
+
+        with ProcessPoolExecutor(1) as executor:
+            wf, client = self.parse(parse_threshold=0, executor=executor)
+
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+        self.assertEqual(len(wf.links), 4)
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWebFingerServer().start()
+        self.dir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.dir.name, "resources.txt")
+        self.output = os.path.join(self.dir.name, "results.jsonl")
+
+    def tearDown(self):
+        self.server.stop()
+        self.dir.cleanup()
+
+    def run_cli(self, resources, *args):
+        with open(self.input, "w") as f:
+            f.write("\n".join(resources) + "\n")
+
+        argv = [self.input, "-o", self.output, "--scheme", "http", "--port",
+                str(self.server.port), "--retries", "0"] + list(args)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(cli.main(argv), 0)
+
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_lookups(self):
+        self.server.fail(status=404)
+        results = self.run_cli(["acct:a@127.0.0.1", "", "# comment",
+                                "acct:b@127.0.0.1", "acct:b@127.0.0.1"],
+                               "-c", "1")
+        self.assertEqual([r["resource"] for r in results],
+                         ["acct:a@127.0.0.1", "acct:b@127.0.0.1",
+                          "acct:b@127.0.0.1"])
+
+        failed, ok, cached = results
+        self.assertFalse(failed["ok"])
+        self.assertEqual(failed["status"], 404)
+        self.assertEqual(failed["error"], "WebFingerHTTPError")
+        self.assertTrue(ok["ok"])
+        self.assertEqual(ok["status"], 200)
+        self.assertEqual(ok["cache"], "miss")
+        self.assertEqual(ok["jrd"]["subject"], "acct:b@127.0.0.1")
+        self.assertGreater(ok["duration"], 0)
+        self.assertEqual(cached["cache"], "hit")
+        self.assertEqual(cached["jrd"], ok["jrd"])
+
+    def test_resume(self):
+        with open(self.output, "w") as f:
+            f.write(json.dumps({"resource": "acct:a@127.0.0.1"}) + "\n")
+            # Cut off by an interrupted run
+            f.write('{"resource": "acct:b@127.0.0.1", "ok"')
+
+        resources = ["acct:{}@127.0.0.1".format(c) for c in "abc"]
+        results = self.run_cli(resources, "--resume")
+        self.assertEqual(sorted(r["resource"] for r in results), resources)
+        self.assertNotIn("ok", results[0])
+
+    def test_retry_failed(self):
+        with open(self.output, "w") as f:
+            f.write(json.dumps({"resource": "acct:a@127.0.0.1",
+                                "ok": False}) + "\n")
+            f.write(json.dumps({"resource": "acct:b@127.0.0.1",
+                                "ok": True}) + "\n")
+
+        resources = ["acct:a@127.0.0.1", "acct:b@127.0.0.1"]
+        self.assertEqual(len(self.run_cli(resources, "--resume")), 2)
+        results = self.run_cli(resources, "--resume", "--retry-failed")
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[-1]["resource"], "acct:a@127.0.0.1")
+        self.assertTrue(results[-1]["ok"])
+
+    def test_uncached_duplicates(self):
+        # Concurrent lookups of one resource each get their own event
+        results = self.run_cli(["acct:a@127.0.0.1"] * 8, "--cache-size", "0")
+        self.assertEqual([(r["status"], r["attempts"]) for r in results],
+                         [(200, 1)] * 8)
+
+    def test_stdin(self):
+        result = subprocess.run(
+            [sys.executable, "-m", "webfinger", "--scheme", "http", "--port",
+             str(self.server.port)], input=b"acct:a@127.0.0.1\n",
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(json.loads(result.stdout)["resource"],
+                         "acct:a@127.0.0.1")
+        self.assertIn(b"1 lookups (1 ok", result.stderr)
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+class TestCrawler(unittest.TestCase):
+    def setUp(self):
+        def jrd(name, *links, aliases=()):
+            return {"subject": "acct:{}@127.0.0.1".format(name),
+                    "aliases": list(aliases),
+                    "links": [{"rel": "http://webfinger.net/rel/profile-page",
+                               "href": "acct:{}@127.0.0.1".format(link)}
+                              for link in links]}
+
+        self.server = FakeWebFingerServer(documents={
+            "acct:a@127.0.0.1": jrd("a", "b", "c"),
+            "acct:b@127.0.0.1": jrd("b", "a", aliases=[
+                "acct:d@127.0.0.1", "https://127.0.0.1/users/b"]),
+            "acct:c@127.0.0.1": jrd("c", "d"),
+            "acct:d@127.0.0.1": jrd("d", "e"),
+        }).start()
+        self.dir = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.dir.name, "crawl.jsonl")
+
+    def tearDown(self):
+        self.server.stop()
+        self.dir.cleanup()
+
+    def crawl(self, stop=None, **kwargs):
+        async def crawl():
+            async with WebFingerAioHTTPClient(scheme="http",
+                                              port=self.server.port) as client:
+                crawler = Crawler(client, concurrency=4, **kwargs)
+                results = []
+                crawl = crawler.crawl(["acct:a@127.0.0.1"])
+                async for result in crawl:
+                    results.append(result)
+                    if len(results) == stop:
+                        break
+
+                await crawl.aclose()
+                return crawler, results
+
+        return asyncio.run(crawl())
+
+    def test_neighbours(self):
+        jrd = WebFingerJRD({
+            "subject": "acct:b@127.0.0.1",
+            "aliases": ["acct:d@127.0.0.1", "https://127.0.0.1/users/b"],
+            "links": [{"rel": "self", "href": "acct:a@127.0.0.1"},
+                      {"rel": "self", "href": "acct:d@127.0.0.1"},
+                      {"rel": "self", "href": "acct:b@127.0.0.1"}]})
+        self.assertEqual(neighbours(jrd),
+                         ["acct:d@127.0.0.1", "acct:a@127.0.0.1"])
+        self.assertEqual(len(neighbours(jrd, ("acct", "https"))), 3)
+
+    def test_crawl(self):
+        crawler, results = self.crawl()
+        depths = {r.resource: r.depth for r in results}
+        self.assertEqual(depths, {"acct:a@127.0.0.1": 0,
+                                  "acct:b@127.0.0.1": 1,
+                                  "acct:c@127.0.0.1": 1,
+                                  "acct:d@127.0.0.1": 2})
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(results[0].found, 2)
+        self.assertEqual((crawler.queued, crawler.visited), (4, 4))
+        # The client is left alone; the crawler paces lookups itself
+        self.assertIsNone(crawler.client.rate_limit)
+        self.assertEqual(crawler.rate_limit.state("127.0.0.1")["requests"], 4)
+
+        crawler, results = self.crawl(max_depth=1, max_resources=2)
+        self.assertEqual([r.resource for r in results],
+                         ["acct:a@127.0.0.1", "acct:b@127.0.0.1"])
+
+    def test_resume(self):
+        crawler, first = self.crawl(stop=2, checkpoint=self.checkpoint,
+                                    max_depth=3)
+        # The second result wasn't done with when the crawl stopped
+        self.assertEqual(crawler.visited, 1)
+
+        with open(self.checkpoint, "a") as f:
+            f.write('{"visited": "acct:')
+
+        crawler, rest = self.crawl(checkpoint=self.checkpoint, max_depth=3)
+        resources = [r.resource for r in first[:1] + rest]
+        self.assertEqual(sorted(resources),
+                         ["acct:{}@127.0.0.1".format(c) for c in "abcde"])
+        self.assertEqual((crawler.queued, crawler.visited), (5, 5))
+
+
+class TestHedge(unittest.TestCase):
+    @staticmethod
+    def sleeper(*delays):
+        # Coroutine function sleeping for each of delays in turn
+        delays = list(delays)
+
+        async def attempt():
+            delay = delays.pop(0)
+            await asyncio.sleep(delay)
+            return delay
+
+        return attempt
+
+    def test_delay(self):
+        policy = HedgePolicy(percentile=0.9, min_samples=5, min_delay=0.01)
+        for i in range(4):
+            policy.record("example.com", i / 100)
+
+        self.assertIsNone(policy.delay("example.com"))
+        self.assertIsNone(policy.delay("example.org"))
+
+        for i in range(4, 10):
+            policy.record("example.com", i / 100)
+
+        self.assertEqual(policy.delay("example.com"), 0.09)
+        policy.record("example.org", 0.0)
+        policy.latencies["example.org"] *= 5
+        self.assertEqual(policy.delay("example.org"), 0.01)
+
+    def test_window(self):
+        policy = HedgePolicy(window=3, min_samples=1, percentile=0)
+        for i in range(5):
+            policy.record("example.com", i)
+
+        self.assertEqual(policy.delay("example.com"), 2)
+
+    def test_hedged(self):
+        policy = HedgePolicy(min_samples=1)
+        policy.record("example.com", 0.01)
+
+        start = time.monotonic()
+        result = asyncio.run(policy.run("example.com",
+                                        self.sleeper(1.0, 0.0)))
+        self.assertEqual(result, 0.0)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(policy.stats(), {"lookups": 1, "hedged": 1,
+                                          "won": 1, "skipped": 0,
+                                          "tokens": 9.0})
+
+    def test_first_wins(self):
+        policy = HedgePolicy(min_samples=1)
+        policy.record("example.com", 0.01)
+
+        result = asyncio.run(policy.run("example.com",
+                                        self.sleeper(0.05, 1.0)))
+        self.assertEqual(result, 0.05)
+        self.assertEqual(policy.hedged, 1)
+        self.assertEqual(policy.won, 0)
+
+    def test_not_hedged(self):
+        policy = HedgePolicy(min_samples=1)
+        policy.record("example.com", 0.5)
+
+        result = asyncio.run(policy.run("example.com", self.sleeper(0.01)))
+        self.assertEqual(result, 0.01)
+        self.assertEqual(policy.hedged, 0)
+        self.assertEqual(len(policy.latencies["example.com"]), 2)
+
+    def test_error(self):
+        async def fail():
+            raise WebFingerHTTPError(status=404)
+
+        # A failed hedge doesn't fail the lookup
+        policy = HedgePolicy(min_samples=1)
+        policy.record("example.com", 0.01)
+        result = asyncio.run(policy.run("example.com", self.sleeper(0.2),
+                                        fail))
+        self.assertEqual(result, 0.2)
+        self.assertEqual(policy.won, 0)
+
+        async def slow_fail():
+            await asyncio.sleep(0.05)
+            raise WebFingerHTTPError(status=503)
+
+        # If both fail, the first request's error is raised
+        with self.assertRaises(WebFingerHTTPError) as cm:
+            asyncio.run(policy.run("example.com", slow_fail, fail))
+
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(len(policy.latencies["example.com"]), 2)
+
+    def test_first_fails(self):
+        async def attempt():
+            await asyncio.sleep(0.05)
+            raise WebFingerHTTPError(status=503)
+
+        policy = HedgePolicy(min_samples=1)
+        policy.record("example.com", 0.01)
+        # The first request fails after the hedge is sent, and before the
+        # hedge finishes
+        result = asyncio.run(policy.run("example.com", attempt,
+                                        self.sleeper(0.2)))
+        self.assertEqual(result, 0.2)
+        self.assertEqual(policy.won, 1)
+
+    def test_budget(self):
+        policy = HedgePolicy(percentile=0, min_samples=1, budget=0.5,
+                             burst=1)
+        policy.record("example.com", 0.0)
+
+        async def lookups():
+            for i in range(4):
+                await policy.run("example.com", self.sleeper(0.01, 0.0))
+
+        asyncio.run(lookups())
+        # The first spends the burst; then every other lookup can hedge
+        self.assertEqual(policy.hedged, 2)
+        self.assertEqual(policy.skipped, 2)
+
+    @unittest.skipIf(aiohttp is None, "aiohttp is not importable")
+    def test_aiohttp(self):
+        events = []
+        policy = HedgePolicy(min_samples=5)
+
+        with FakeWebFingerServer() as server:
+            async def lookups():
+                async with WebFingerAioHTTPClient(
+                        scheme="http", port=server.port,
+                        hedge=policy) as client:
+                    client.add_listener(events.append)
+                    for i in range(5):
+                        await client.finger("acct:Elizafox@127.0.0.1")
+
+                    server.slow(1, 1.0)
+                    start = time.monotonic()
+                    wf = await client.finger("acct:Elizafox@127.0.0.1")
+                    return wf, time.monotonic() - start
+
+            wf, duration = asyncio.run(lookups())
+
+        self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+        self.assertLess(duration, 0.5)
+        self.assertEqual(policy.won, 1)
+        self.assertEqual([e.hedged for e in events], [False] * 5 + [True])
+
+
+@unittest.skipIf(httpx is None, "httpx or h2 is not importable")
+class TestHTTPXClient(unittest.TestCase):
+    def test_http1(self):
+        with FakeWebFingerServer() as server, \
+                WebFingerHTTPXClient(scheme="http", port=server.port) as client:
+            wf = client.finger("acct:Elizafox@127.0.0.1")
+            self.assertEqual(wf.subject, "acct:Elizafox@127.0.0.1")
+
+            server.error_rate = 1
+            self.assertRaises(WebFingerHTTPError, client.finger,
+                              "acct:Elizafox@127.0.0.1")
+
+    def test_redirect(self):
+        location = {"Location": "/.well-known/webfinger?"
+                                "resource=acct:moved@127.0.0.1"}
+        with FakeWebFingerServer() as server:
+            # Both the plain and the streamed (listened to) requests
+            for listen in (False, True):
+                with WebFingerHTTPXClient(scheme="http",
+                                          port=server.port) as client:
+                    if listen:
+                        client.add_listener(lambda event: None)
+
+                    server.fail(1, 301, location)
+                    wf = client.finger("acct:Elizafox@127.0.0.1")
+                    self.assertEqual(wf.subject, "acct:moved@127.0.0.1")
+
+            async def lookup():
+                async with AsyncWebFingerHTTPXClient(
+                        scheme="http", port=server.port) as client:
+                    return await client.finger("acct:Elizafox@127.0.0.1")
+
+            server.fail(1, 301, location)
+            wf = asyncio.run(lookup())
+            self.assertEqual(wf.subject, "acct:moved@127.0.0.1")
+
+    def test_client_timeout(self):
+        with FakeWebFingerServer(latency=1.0) as server:
+            # Our timeout is None; the httpx client's must still apply
+            for listen in (False, True):
+                with WebFingerHTTPXClient(
+                        scheme="http", port=server.port,
+                        client=httpx.Client(timeout=0.2)) as client:
+                    if listen:
+                        client.add_listener(lambda event: None)
+
+                    start = time.monotonic()
+                    self.assertRaises(WebFingerNetworkError, client.finger,
+                                      "acct:Elizafox@127.0.0.1")
+                    self.assertLess(time.monotonic() - start, 0.9)
+
+            async def lookup():
+                async with AsyncWebFingerHTTPXClient(
+                        scheme="http", port=server.port,
+                        client=httpx.AsyncClient(timeout=0.2)) as client:
+                    await client.finger("acct:Elizafox@127.0.0.1")
+
+            self.assertRaises(WebFingerNetworkError, asyncio.run, lookup())
+
+    def test_multiplexed_threads(self):
+        with FakeH2WebFingerServer(latency=0.05) as server, \
+                WebFingerHTTPXClient(scheme="http", port=server.port,
+                                     http1=False) as client:
+            events = []
+            client.add_listener(events.append)
+
+            def lookup(i):
+                resource = "acct:user{}@127.0.0.1".format(i)
+                return resource, client.finger(resource).subject
+
+            with ThreadPoolExecutor(16) as executor:
+                results = list(executor.map(lookup, range(32)))
+
+            self.assertEqual(server.connections, 1)
+
+        for resource, subject in results:
+            self.assertEqual(resource, subject)
+
+        self.assertEqual(len(events), 32)
+        self.assertEqual(len([e for e in events if "connect" in e.phases]), 1)
+        self.assertTrue(all(e.status == 200 for e in events))
+
+    def test_multiplexed_async(self):
+        async def lookups(port):
+            async with AsyncWebFingerHTTPXClient(scheme="http", port=port,
+                                                 http1=False) as client:
+                return await asyncio.gather(*(
+                    client.finger("acct:user{}@127.0.0.1".format(i))
+                    for i in range(32)))
+
+        with FakeH2WebFingerServer(latency=0.05) as server:
+            results = asyncio.run(lookups(server.port))
+            self.assertEqual(server.connections, 1)
+
+        self.assertEqual(results[5].subject, "acct:user5@127.0.0.1")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -12,7 +12,8 @@ In this module, the following are exposed:
     - BaseWebFingerClient (from webfinger.client)
     - WebFingerClient (from webfinger.client.requests  for backwards
       compatibility)
-    - The WebFingerJRD object (from webfinger.objects.jrd)
+    - The WebFingerJRD and FrozenWebFingerJRD objects (from
+      webfinger.objects.jrd)
     - Exceptions (from webfinger.exceptions)
     - A simple helper for basic finger requests (the finger function)
 """
@@ -21,20 +22,54 @@ In this module, the following are exposed:
 __version__ = "3.0.0.dev3"
 
 
-from webfinger.client import BaseWebFingerClient
-from webfinger.client.requests import WebFingerClient
-from webfinger.objects.jrd import WebFingerJRD
+import importlib
+import threading
+
 from webfinger.exceptions import *
 
 
-_client = WebFingerClient()
+# Everything else is imported on first use (PEP 562), so that importing the
+# package (e.g. only for WebFingerJRD) doesn't pull in the HTTP client stack.
+_LAZY = {
+    "BaseWebFingerClient": "webfinger.client",
+    "WebFingerClient": "webfinger.client.requests",
+    "WebFingerJRD": "webfinger.objects.jrd",
+    "FrozenWebFingerJRD": "webfinger.objects.jrd",
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
 
 
 def finger(resource, rel=None):
     """Invoke finger without creating a WebFingerClient instance.
 
+    The client used is created on the first call.
+
     args:
     resource - resource to look up
     rel - relation to request from the server
     """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from webfinger.client.requests import WebFingerClient
+                _client = WebFingerClient()
+
     return _client.finger(resource, rel=rel)
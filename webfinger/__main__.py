@@ -0,0 +1,8 @@
+"""Bulk WebFinger lookups; see webfinger.cli."""
+
+import sys
+
+from webfinger.cli import main
+
+
+sys.exit(main())
@@ -0,0 +1,332 @@
+"""Command line bulk WebFinger lookups.
+
+Resources are read from a file (or stdin), one per line; blank lines and lines
+starting with # are skipped. They are looked up concurrently with the aiohttp
+client, and a JSON line is written for each, as soon as it is done:
+
+    {"resource": "acct:user@example.com", "ok": true, "status": 200,
+     "host": "example.com", "duration": 0.0421, "attempts": 1,
+     "cache": "miss", "jrd": {...}}
+
+Failed lookups have "ok": false, and "error" (the exception class) and
+"message" instead of "jrd". Lines are written in the order lookups finish.
+
+With --resume, resources already in the output file are skipped, and new
+lines are appended to it; so an interrupted run can be restarted with the same
+command. With --retry-failed as well, resources whose lookups failed are looked
+up again (their new lines come after the old ones). Repeated resources are
+looked up once, and answered from a cache.
+
+Usage:
+    python -m webfinger resources.txt -o results.jsonl -c 64 --rate 5
+    python -m webfinger resources.txt -o results.jsonl --resume
+    python -m webfinger resources.txt -o results.jsonl --resume --retry-failed
+"""
+
+import argparse
+import asyncio
+import collections
+import contextvars
+import itertools
+import json
+import os
+import sys
+import time
+
+from webfinger.utils import json_default, read_json_lines
+
+
+READ_LINES = 1024
+"""Lines of input read at a time."""
+
+# Events of the lookup running in the current task
+_events = contextvars.ContextVar("events", default=None)
+
+
+def read_done(path, retry_failed=False):
+    """Return the resources already in an output file, for resuming.
+
+    If retry_failed is True, resources whose last result is a failure are not
+    included. A partly written last line (from an interrupted run) is cut
+    off, so that new lines can be appended after it.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return set()
+
+    for result in read_json_lines(path):
+        if isinstance(result, dict) and "resource" in result:
+            done[result["resource"]] = result.get("ok", True)
+
+    return {resource for resource, ok in done.items()
+            if ok or not retry_failed}
+
+
+class _Cache:
+    """LRU cache of lookup results, which also merges concurrent lookups."""
+
+    def __init__(self, size):
+        self.size = size
+        self.futures = collections.OrderedDict()
+
+    def get(self, key):
+        future = self.futures.get(key)
+        if future is not None:
+            self.futures.move_to_end(key)
+
+        return future
+
+    def add(self, key, future):
+        if self.size <= 0:
+            return
+
+        self.futures[key] = future
+        if len(self.futures) > self.size:
+            self.futures.popitem(last=False)
+
+
+class BulkLookup:
+    """Concurrent lookups of many resources, written out as JSON lines."""
+
+    def __init__(self, client, output, concurrency=32, rel=None,
+                 cache_size=10000, skip=()):
+        """Initialise the BulkLookup object.
+
+        args:
+        client - asynchronous WebFinger client to use
+        output - text file to write JSON lines to
+        concurrency - lookups to run at once (default 32)
+        rel - relation to request
+        cache_size - results to keep for repeated resources (default 10000)
+        skip - resources not to look up (e.g. those already done)
+        """
+        self.client = client
+        self.output = output
+        self.concurrency = concurrency
+        self.rel = rel
+        self.skip = skip
+        self.cache = _Cache(cache_size)
+        self.counts = collections.Counter()
+        client.add_listener(self._event)
+
+    def _event(self, event):
+        # Listeners are called in the task doing the lookup
+        events = _events.get()
+        if events is not None:
+            events.append(event)
+
+    async def lookup(self, resource):
+        """Look up resource; return its result as a dict."""
+        future = self.cache.get(resource)
+        if future is not None:
+            result = dict(await asyncio.shield(future))
+            result["cache"] = "hit"
+            result["duration"] = 0.0
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self.cache.add(resource, future)
+
+        events = []
+        _events.set(events)
+        start = time.perf_counter()
+        error = jrd = None
+        try:
+            jrd = await self.client.finger(resource, rel=self.rel)
+        except Exception as e:
+            error = e
+
+        duration = time.perf_counter() - start
+        event = events[-1] if events else None
+        status = getattr(error, "status", None)
+        if status is None and event is not None:
+            status = event.status
+
+        result = {"resource": resource, "ok": error is None,
+                  "status": status,
+                  "host": event.host if event is not None else None,
+                  "attempts": event.attempts if event is not None else None,
+                  "duration": round(duration, 6), "cache": "miss"}
+        if error is None:
+            result["jrd"] = jrd.jrd
+        else:
+            result["error"] = type(error).__name__
+            result["message"] = str(error)
+
+        future.set_result(result)
+        return result
+
+    def write(self, result):
+        """Write a result as a JSON line."""
+        self.output.write(json.dumps(result, default=json_default) + "\n")
+        self.output.flush()
+        self.counts["ok" if result["ok"] else "error"] += 1
+        if result["cache"] == "hit":
+            self.counts["cached"] += 1
+
+    async def worker(self, queue):
+        while True:
+            resource = await queue.get()
+            if resource is None:
+                return
+
+            self.write(await self.lookup(resource))
+
+    async def run(self, lines):
+        """Look up the resources in lines (an iterable of lines)."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.concurrency * 2)
+        workers = [asyncio.ensure_future(self.worker(queue))
+                   for i in range(self.concurrency)]
+
+        lines = iter(lines)
+        try:
+            while True:
+                # Reading may block (e.g. on a pipe), so read in a thread,
+                # a chunk at a time
+                chunk = await loop.run_in_executor(
+                    None, list, itertools.islice(lines, READ_LINES))
+                if not chunk:
+                    break
+
+                for line in chunk:
+                    resource = line.strip()
+                    if not resource or resource.startswith("#"):
+                        continue
+
+                    if resource in self.skip:
+                        self.counts["skipped"] += 1
+                        continue
+
+                    await queue.put(resource)
+
+            for worker in workers:
+                await queue.put(None)
+
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        return self.counts
+
+
+def create_parser():
+    """Create the argument parser of the command."""
+    parser = argparse.ArgumentParser(
+        prog="python -m webfinger",
+        description="Look up WebFinger resources in bulk, writing the "
+                    "results as JSON lines.")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="file of resources, one per line (default is "
+                             "stdin)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="file to write results to (default is stdout)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip resources already in the output file, "
+                             "and append to it")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="with --resume, look up resources whose "
+                             "lookups failed again")
+    parser.add_argument("-c", "--concurrency", type=int, default=32,
+                        help="lookups to run at once (default %(default)s)")
+    parser.add_argument("--rel", help="relation to request")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds each request may take "
+                             "(default %(default)s)")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="retries of transient failures "
+                             "(default %(default)s)")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="requests per second to each host, 0 for no "
+                             "limit (default %(default)s)")
+    parser.add_argument("--burst", type=int, default=10,
+                        help="requests to each host at once, after a lull "
+                             "(default %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="results to keep for repeated resources, 0 to "
+                             "look them up again (default %(default)s)")
+    parser.add_argument("--max-response-bytes", type=int, default=1048576,
+                        help="largest response to accept "
+                             "(default %(default)s)")
+    parser.add_argument("--scheme", default="https",
+                        help="scheme of the endpoints (default "
+                             "%(default)s)")
+    parser.add_argument("--port", type=int,
+                        help="port of the endpoints (default is the "
+                             "scheme's)")
+    return parser
+
+
+def create_client(args):
+    """Create the client for the parsed arguments."""
+    from webfinger.client.aiohttp import WebFingerClient
+    from webfinger.client.ratelimit import RateLimiter
+    from webfinger.client.retry import RetryPolicy
+
+    rate_limit = None
+    if args.rate > 0:
+        rate_limit = RateLimiter(rate=args.rate, burst=args.burst)
+
+    return WebFingerClient(timeout=args.timeout, scheme=args.scheme,
+                           port=args.port, limit=args.concurrency,
+                           retry=RetryPolicy(retries=args.retries),
+                           rate_limit=rate_limit,
+                           max_response_bytes=args.max_response_bytes)
+
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("concurrency must be at least 1")
+
+    if args.resume and args.output == "-":
+        parser.error("--resume needs an output file")
+
+    try:
+        client = create_client(args)
+    except ImportError as e:
+        parser.error("the aiohttp client is not available: {}".format(e))
+
+    if args.retry_failed and not args.resume:
+        parser.error("--retry-failed needs --resume")
+
+    skip = read_done(args.output, args.retry_failed) if args.resume else ()
+
+    if args.input == "-":
+        infile = sys.stdin
+    else:
+        infile = open(args.input, encoding="utf-8")
+
+    if args.output == "-":
+        outfile = sys.stdout
+    else:
+        outfile = open(args.output, "a" if args.resume else "w",
+                       encoding="utf-8")
+
+    async def run():
+        async with client:
+            bulk = BulkLookup(client, outfile, args.concurrency, args.rel,
+                              args.cache_size, skip)
+            return await bulk.run(infile)
+
+    start = time.perf_counter()
+    try:
+        counts = asyncio.run(run())
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    elapsed = time.perf_counter() - start
+    done = counts["ok"] + counts["error"]
+    print("{} lookups ({} ok, {} failed, {} cached, {} skipped) in {:.1f}s, "
+          "{:.1f}/s".format(done, counts["ok"], counts["error"],
+                            counts["cached"], counts["skipped"], elapsed,
+                            done / elapsed if elapsed else 0.0),
+          file=sys.stderr)
+    return 0
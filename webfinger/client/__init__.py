@@ -5,10 +5,123 @@ for other implementations.
 """
 
 import abc
+import logging
+import time
 
 from webfinger import __version__ as version
 from webfinger.objects.jrd import WebFingerJRD
-from webfinger.exceptions import WebFingerContentError
+from webfinger.exceptions import WebFingerContentError, \
+    WebFingerResponseTooLargeError
+
+
+logger = logging.getLogger("webfinger.client")
+
+
+CHUNK_SIZE = 16384
+"""Size of the chunks bodies are read in, when their size is limited."""
+
+
+def check_size(size, limit):
+    """Raise WebFingerResponseTooLargeError if size bytes is over limit.
+
+    args:
+    size - size of the body read so far, or its Content-Length (as a string;
+           it is ignored if it isn't a number)
+    limit - maximum size of the body, or None for no limit
+    """
+    if limit is None or size is None:
+        return
+
+    if isinstance(size, str):
+        if not size.strip().isdigit():
+            return
+
+        length = int(size)
+        if length > limit:
+            raise WebFingerResponseTooLargeError(
+                "Content-Length is too large", length, limit=limit,
+                size=length)
+    elif size > limit:
+        raise WebFingerResponseTooLargeError(
+            "Response body is too large", limit=limit)
+
+
+class LookupEvent:
+    """Timing and outcome of a single WebFinger lookup.
+
+    Listeners registered with BaseWebFingerClient.add_listener() receive one
+    of these after every lookup, whether it succeeded or not.
+
+    Besides resource, host, and url, it has these attributes (None if not
+    known):
+        status - HTTP status of the response
+        content_type - Content-Type of the response
+        bytes - size of the response body
+        cache - cache outcome ("hit" or "miss"), if a cache was used
+        error - exception raised by the lookup
+        duration - total seconds taken by the lookup
+
+    attempts is the number of requests made (more than 1 if the lookup was
+    retried); the phases of all attempts are added up. hedged is True if a
+    hedged request was sent (see webfinger.client.hedge), whose phases are
+    not recorded.
+
+    phases maps phase names to seconds. The phases don't overlap, and only
+    phases that happened are present (e.g. there is no connect phase when a
+    connection was reused). The phases are:
+        ratelimit - waiting for the client's rate limiter
+        backoff - waiting between the attempts of a retried lookup
+        dns - resolving the host (only reported by some clients)
+        connect - establishing the TCP connection (including DNS, if it is
+                  not reported separately)
+        tls - the TLS handshake
+        ttfb - sending the request and waiting for the response headers
+        download - reading the response body
+        parse - parsing the JRD
+    """
+
+    __slots__ = ("resource", "host", "url", "status", "content_type",
+                 "bytes", "cache", "error", "phases", "start", "duration",
+                 "attempts", "hedged")
+
+    def __init__(self, resource, host=None, url=None):
+        """Initialise the LookupEvent object.
+
+        args:
+        resource - resource being looked up
+        host - host the lookup is sent to
+        url - WebFinger endpoint URL
+        """
+        self.resource = resource
+        self.host = host
+        self.url = url
+        self.status = None
+        self.content_type = None
+        self.bytes = None
+        self.cache = None
+        self.error = None
+        self.phases = {}
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attempts = 1
+        self.hedged = False
+
+    def add_phase(self, name, seconds):
+        """Add seconds to the given phase."""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        """Seconds since the lookup started not accounted for by phases."""
+        return time.perf_counter() - self.start - sum(self.phases.values())
+
+    def finish(self):
+        """Mark the lookup as finished."""
+        self.duration = time.perf_counter() - self.start
+
+    def __repr__(self):
+        return "LookupEvent(resource={!r}, status={!r}, duration={!r}, " \
+            "phases={!r})".format(self.resource, self.status, self.duration,
+                                  self.phases)
 
 
 class BaseWebFingerClient(abc.ABC):
@@ -23,15 +136,82 @@ class BaseWebFingerClient(abc.ABC):
                        "application/xml": (0.4, "xml")}
     """Webfinger MIME types, mapped to q values and parser type."""
 
-    WEBFINGER_URL = "https://{host}/.well-known/webfinger"
+    WEBFINGER_URL = "{scheme}://{host}/.well-known/webfinger"
     """Format of WebFinger endpoint."""
 
+    scheme = "https"
+    """Scheme to use for the WebFinger endpoint (e.g. http for testing)."""
+
+    port = None
+    """Port to use for the WebFinger endpoint (default is the scheme's)."""
+
     USER_AGENT = "Python-Webfinger/{version}".format(version=version)
     """User agent to use."""
 
     JRD_OBJECT = WebFingerJRD
     """JRD object to use for parsing and emitting (default is WebFingerJRD)."""
 
+    listeners = ()
+    """Callables receiving a LookupEvent after each lookup."""
+
+    retry = None
+    """RetryPolicy for failed lookups (default is not to retry)."""
+
+    rate_limit = None
+    """RateLimiter pacing requests to each host (default is no limit)."""
+
+    max_response_bytes = None
+    """Largest response body to read, in bytes (default is no limit)."""
+
+    def add_listener(self, listener):
+        """Register a listener for lookup events.
+
+        The listener is called with a LookupEvent after every lookup. When no
+        listeners are registered, no events are created at all.
+
+        If the listener also has a lookup_started method, it is called with
+        the LookupEvent when the lookup starts.
+
+        args:
+        listener - callable taking a LookupEvent
+        """
+        self.listeners = list(self.listeners) + [listener]
+
+    def remove_listener(self, listener):
+        """Unregister a listener added with add_listener()."""
+        listeners = list(self.listeners)
+        listeners.remove(listener)
+        self.listeners = listeners
+
+    def emit_start(self, event):
+        """Notify listeners that a lookup has started.
+
+        Listeners with a lookup_started method have it called with the new
+        LookupEvent (e.g. to track requests in flight). Exceptions raised by
+        listeners are logged and otherwise ignored.
+        """
+        for listener in self.listeners:
+            started = getattr(listener, "lookup_started", None)
+            if started is None:
+                continue
+
+            try:
+                started(event)
+            except Exception:
+                logger.exception("error in lookup listener %r", listener)
+
+    def emit(self, event):
+        """Send a finished LookupEvent to all listeners.
+
+        Exceptions raised by listeners are logged and otherwise ignored.
+        """
+        event.finish()
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception("error in lookup listener %r", listener)
+
     def generate_accept_header(self):
         """Generate an accept header."""
         return '; '.join("q={}, {}".format(v[0], k) for k, v in
@@ -43,6 +223,50 @@ class BaseWebFingerClient(abc.ABC):
         host = resource.split("@")[-1]
         return host
 
+    def build_url(self, host):
+        """Build the WebFinger endpoint URL for the given host."""
+        if self.port is not None:
+            host = "{}:{}".format(host, self.port)
+
+        return self.WEBFINGER_URL.format(scheme=self.scheme, host=host)
+
+    def throttle(self, host, event=None, timeout=None):
+        """Wait until rate_limit allows a request to host.
+
+        If event is not None, the wait is recorded in it. timeout is seconds
+        left until the lookup's deadline, if any; it is returned less the
+        time waited.
+        """
+        if self.rate_limit is None:
+            return timeout
+
+        waited = self.rate_limit.acquire(host, timeout)
+        if waited:
+            if event is not None:
+                event.add_phase("ratelimit", waited)
+
+            if timeout is not None:
+                timeout = max(0.0, timeout - waited)
+
+        return timeout
+
+    async def athrottle(self, host, event=None):
+        """Wait until rate_limit allows a request to host.
+
+        This method is a coroutine, for asynchronous clients; see throttle().
+        """
+        if self.rate_limit is None:
+            return
+
+        waited = await self.rate_limit.aacquire(host)
+        if waited and event is not None:
+            event.add_phase("ratelimit", waited)
+
+    def update_rate_limit(self, host, status, headers):
+        """Adapt rate_limit to a response from host (if rate limiting)."""
+        if self.rate_limit is not None:
+            self.rate_limit.update(host, status, headers)
+
     def parse_response(self, response, parser):
         """Parse WebFinger response using the given parser."""
         parser_name = "from_{}".format(parser)
@@ -1,15 +1,21 @@
 """WebFinger client based around the aiohttp library.
 
-This module requires Python 3.4 or later and aiohttp.
+This module requires Python 3.7 or later and aiohttp 3.
 """
 
 
 import asyncio
+import contextvars
+import functools
 import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
 
-from webfinger.client import BaseWebFingerClient
+from webfinger.client import BaseWebFingerClient, LookupEvent, CHUNK_SIZE, \
+    check_size
 from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
     WebFingerJRDError, WebFingerContentError
 
@@ -17,54 +23,280 @@ from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
 logger = logging.getLogger("webfinger.client.aiohttp")
 
 
+# LookupEvent of the lookup running in this task, if anyone is listening
+_event = contextvars.ContextVar("webfinger_lookup_event", default=None)
+
+
+async def _on_dns_start(session, ctx, params):
+    ctx.dns_start = time.perf_counter()
+
+
+async def _on_dns_end(session, ctx, params):
+    event = ctx.trace_request_ctx
+    if isinstance(event, LookupEvent):
+        ctx.dns = time.perf_counter() - ctx.dns_start
+        event.add_phase("dns", ctx.dns)
+
+
+async def _on_connection_create_start(session, ctx, params):
+    ctx.connect_start = time.perf_counter()
+    ctx.dns = 0.0
+
+
+async def _on_connection_create_end(session, ctx, params):
+    event = ctx.trace_request_ctx
+    if isinstance(event, LookupEvent):
+        # aiohttp resolves the host (and does TLS) while connecting
+        event.add_phase("connect",
+                        time.perf_counter() - ctx.connect_start - ctx.dns)
+
+
+def parse_body(jrd_object, parser, body, charset=None):
+    """Parse a response body into a JRD object.
+
+    This is a module level function, so it can be run in a process pool.
+
+    args:
+    jrd_object - JRD class to parse into (e.g. WebFingerJRD)
+    parser - parser to use ("json" or "xml")
+    body - response body, as bytes
+    charset - charset of the body, if the response named one
+    """
+    if charset is not None and charset.lower() not in ("utf-8", "utf8"):
+        try:
+            body = body.decode(charset)
+        except (LookupError, UnicodeDecodeError) as e:
+            raise WebFingerContentError("Could not decode response") from e
+
+    # json and ElementTree detect the encoding of bytes themselves
+    return getattr(jrd_object, "from_" + parser)(body)
+
+
+def create_trace_config():
+    """Create an aiohttp TraceConfig that reports DNS and connect phases.
+
+    WebFingerClient adds this to sessions it creates itself. Add it to your
+    own session's trace_configs to get these phases for it too.
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(_on_dns_start)
+    trace_config.on_dns_resolvehost_end.append(_on_dns_end)
+    trace_config.on_connection_create_start.append(
+        _on_connection_create_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    return trace_config
+
+
 class WebFingerClient(BaseWebFingerClient):
     """An implementation of BaseWebFingerClient using aiohttp.
 
+    All lookups share one session, and so one TCPConnector, which keeps
+    connections alive and caches DNS lookups. The client can be used as an
+    async context manager, which closes the session on exit:
+
+        >>> async with WebFingerClient() as client:
+        ...     response = await client.finger("acct:user@example.com")
+
     You can subclass this for your own needs.
     """
 
-    def __init__(self, timeout=None, session=None):
+    def __init__(self, timeout=None, session=None, scheme="https", port=None,
+                 connector=None, limit=100, limit_per_host=0, dns_ttl=300,
+                 keepalive_timeout=15.0, connect_timeout=None, retry=None,
+                 hedge=None, rate_limit=None, parse_threshold=16384,
+                 executor=None, max_response_bytes=None):
         """Create a WebFingerClient instance.
 
         args:
-        timeout - timeout to use (default None)
+        timeout - total time budget of each request, including reading the
+                  body, in seconds, or an aiohttp ClientTimeout (default is
+                  the session's timeout)
         session - aiohttp ClientSession to use (default is to create our own
-                  with the default event loop)
+                  on first use, in the running event loop)
+        scheme - scheme of the WebFinger endpoint (default https)
+        port - port of the WebFinger endpoint (default is the scheme's)
+        connector - aiohttp connector for our session, e.g. to share it
+                    between clients (default is to create a TCPConnector with
+                    the options below; it is not closed by close())
+        connect_timeout - time budget for connecting, in seconds
+        retry - RetryPolicy for failed lookups (default is not to retry); its
+                deadline bounds the whole lookup
+        hedge - HedgePolicy to send a second request for slow lookups with
+                (default is not to hedge)
+        rate_limit - RateLimiter pacing requests to each host (default is no
+                     limit); it can be shared with other clients
+        parse_threshold - size in bytes from which responses are parsed in
+                          executor rather than on the event loop (default
+                          16 KiB, None always parses on the event loop)
+        executor - concurrent.futures executor for parsing large responses,
+                   e.g. a ProcessPoolExecutor (default is to create a thread
+                   pool with create_executor(); it is not shut down by
+                   close())
+        max_response_bytes - largest response body to read, in bytes
+                             (default is no limit); larger ones raise
+                             WebFingerResponseTooLargeError
+
+        The following only apply to the TCPConnector we create:
+        limit - maximum number of connections (default 100, 0 is no limit)
+        limit_per_host - maximum number of connections per host (default 0,
+                         no limit)
+        dns_ttl - seconds to cache DNS lookups for (default 300, None caches
+                  them forever)
+        keepalive_timeout - seconds to keep idle connections open (default
+                            15, None or 0 disables keep-alive)
         """
+        if timeout is not None or connect_timeout is not None:
+            if not isinstance(timeout, aiohttp.ClientTimeout):
+                timeout = aiohttp.ClientTimeout(total=timeout,
+                                                sock_connect=connect_timeout)
+
         self.timeout = timeout
         self.session = session
+        self.scheme = scheme
+        self.port = port
+        self.connector = connector
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.retry = retry
+        self.hedge = hedge
+        self.rate_limit = rate_limit
+        self.parse_threshold = parse_threshold
+        self.executor = executor
+        self._executor = None
+        self.max_response_bytes = max_response_bytes
+
+    async def __aenter__(self):
+        if self.session is None:
+            self.session = self.create_session()
+
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def create_connector(self):
+        """Create the connector of the session, when none was passed in."""
+        kwargs = {}
+        if self.keepalive_timeout:
+            kwargs["keepalive_timeout"] = self.keepalive_timeout
+        else:
+            kwargs["force_close"] = True
+
+        return aiohttp.TCPConnector(limit=self.limit,
+                                    limit_per_host=self.limit_per_host,
+                                    ttl_dns_cache=self.dns_ttl,
+                                    use_dns_cache=True, **kwargs)
+
+    def create_executor(self):
+        """Create the executor for parsing, when none was passed in.
+
+        Parsing mostly holds the GIL, so more threads wouldn't parse any
+        faster; they would only take the GIL from the event loop more often.
+        """
+        return ThreadPoolExecutor(max_workers=1,
+                                  thread_name_prefix="webfinger-parse")
+
+    def create_session(self):
+        """Create the session used when none was passed in.
+
+        This must be called with an event loop running.
+        """
+        connector = self.connector
+        if connector is None:
+            connector = self.create_connector()
 
-    @asyncio.coroutine
-    def get(self, url, params, headers):
+        return aiohttp.ClientSession(connector=connector,
+                                     connector_owner=self.connector is None,
+                                     trace_configs=[create_trace_config()])
+
+    async def get(self, url, params, headers):
         """Perform HTTP request."""
         if self.session is None:
-            # Create transient session (done here and not __init__ to avoid
-            # ResourceWarning)
-            self.session = aiohttp.ClientSession()
+            # Created here and not in __init__, as it needs a running loop
+            self.session = self.create_session()
+
+        event = _event.get()
+
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
+
+        response = await self.session.get(url, params=params,
+                                          headers=headers,
+                                          trace_request_ctx=event, **kwargs)
+
+        limit = self.max_response_bytes
+        if event is not None:
+            event.add_phase("ttfb", event.elapsed())
+            event.status = response.status
+            event.content_type = response.headers.get("Content-Type")
 
-        with aiohttp.Timeout(self.timeout):
-            response = yield from self.session.get(url, params=params,
-                                                   headers=headers)
-            response.raise_for_status()
+        if event is not None or limit is not None:
+            start = time.perf_counter()
+            if limit is None:
+                body = await response.read()
+            else:
+                body = await self.read_limited(response, limit)
 
+            if event is not None:
+                event.bytes = len(body)
+                event.add_phase("download", time.perf_counter() - start)
+
+        response.raise_for_status()
         return response
 
-    @asyncio.coroutine
-    def close(self):
+    @staticmethod
+    async def read_limited(response, limit):
+        """Read the body of a response, up to limit bytes.
+
+        The body of error responses is not read. Raises
+        WebFingerResponseTooLargeError (and closes the response) if the body
+        is larger than limit.
+        """
+        if response.status >= 400:
+            return b""
+
+        try:
+            check_size(response.headers.get("Content-Length"), limit)
+
+            chunks = []
+            size = 0
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                check_size(size, limit)
+                chunks.append(chunk)
+        except WebFingerContentError:
+            response.close()
+            raise
+
+        # Where aiohttp keeps the body once it has been read
+        response._body = b"".join(chunks)
+        return response._body
+
+    async def close(self):
         """Close HTTP session and perform any cleanup actions"""
         if self.session:
-            yield from self.session.close()
+            await self.session.close()
 
-    @asyncio.coroutine
-    def parse_response(self, response):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def parse_response(self, response):
         """Parse the response.
 
-        This is specially optimised for JSON parsing.
+        Bodies of at least parse_threshold bytes are parsed in executor, so
+        that large (or malicious) documents don't stall the event loop.
 
         This function is given a response object from aiohttp. The parser
         parameter is not allowed with this method; it will be deduced.
         """
-        content_type = response.headers["Content-Type"]
+        content_type = response.headers.get("Content-Type")
+        if content_type is None:
+            raise WebFingerContentError("No Content-Type from server")
+
         content_type = content_type.split(";", 1)[0].strip()
         logger.debug("response content type: %s" % content_type)
 
@@ -72,16 +304,30 @@ class WebFingerClient(BaseWebFingerClient):
             raise WebFingerContentError("Unacceptable content type")
 
         parser = self.WEBFINGER_TYPES[content_type][1]
-        if parser == "json":
-            json = yield from response.json(content_type=None)
-            return self.JRD_OBJECT(json)
-        else:
-            text = yield from response.text()
-            return super().parse_response(text, parser)
+        try:
+            body = await response.read()
+        except aiohttp.ClientError as e:
+            raise WebFingerNetworkError("Could not read response",
+                                        str(e)) from e
+
+        if self.parse_threshold is None or len(body) < self.parse_threshold:
+            return parse_body(self.JRD_OBJECT, parser, body, response.charset)
+
+        executor = self.executor
+        if executor is None:
+            if self._executor is None:
+                self._executor = self.create_executor()
+
+            executor = self._executor
 
-    @asyncio.coroutine
-    def finger(self, resource, host=None, rel=None, raw=False, params=dict(),
-               headers=dict()):
+        logger.debug("parsing %d byte response in executor" % len(body))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, parse_body,
+                                          self.JRD_OBJECT, parser, body,
+                                          response.charset)
+
+    async def finger(self, resource, host=None, rel=None, raw=False,
+                     params=None, headers=None):
         """Perform a WebFinger lookup.
 
         This method is a coroutine.
@@ -95,29 +341,105 @@ class WebFingerClient(BaseWebFingerClient):
                  overwritten)
         headers - HTTP headers to send with the request
         """
+        if not self.listeners:
+            return await self._retrying(resource, host, rel, raw, params,
+                                        headers)
+
+        event = LookupEvent(resource)
+        self.emit_start(event)
+        token = _event.set(event)
+        try:
+            return await self._retrying(resource, host, rel, raw, params,
+                                        headers, event)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            _event.reset(token)
+            self.emit(event)
+
+    async def _retrying(self, resource, host, rel, raw, params, headers,
+                        event=None):
+        """Perform a WebFinger lookup, retrying it according to retry."""
+        if self.retry is None:
+            return await self._hedging(resource, host, rel, raw, params,
+                                       headers, event)
+
+        return await self.retry.acall(functools.partial(
+            self._hedging, resource, host, rel, raw, params, headers, event),
+            event)
+
+    async def _hedging(self, resource, host, rel, raw, params, headers,
+                       event=None):
+        """Perform a WebFinger lookup, hedging it according to hedge."""
+        if self.hedge is None:
+            return await self._finger(resource, host, rel, raw, params,
+                                      headers, event)
+
+        async def hedge():
+            # Only the first request is recorded in the event; this runs in
+            # its own task, so the lookup's event is left alone
+            _event.set(None)
+            if event is not None:
+                event.hedged = True
+
+            return await self._finger(resource, host, rel, raw, params,
+                                      headers)
+
+        return await self.hedge.run(
+            host or self.parse_host(resource),
+            functools.partial(self._finger, resource, host, rel, raw, params,
+                              headers, event), hedge)
+
+    async def _finger(self, resource, host, rel, raw, params, headers,
+                      event=None):
+        """Perform a WebFinger lookup (see finger()).
+
+        If event is not None, the lookup is recorded in it.
+        """
         if not host:
             host = self.parse_host(resource)
 
-        url = self.WEBFINGER_URL.format(host=host)
+        url = self.build_url(host)
 
+        if event is not None:
+            event.host = host
+            event.url = url
+
+        # Never modify the caller's dicts; they may be shared between tasks
+        params = dict(params or ())
         params["resource"] = resource
         if rel:
             params["rel"] = rel
 
+        headers = dict(headers or ())
         headers["User-Agent"] = self.USER_AGENT
         headers["Accept"] = self.generate_accept_header()
 
+        await self.athrottle(host, event)
+
         logger.debug("fetching JRD from %s" % url)
         try:
-            response = yield from self.get(url, params, headers)
+            response = await self.get(url, params, headers)
         except aiohttp.ClientResponseError as e:
-            raise WebFingerHTTPError("Error with request", str(e)) from e
+            self.update_rate_limit(host, e.status, e.headers or {})
+            raise WebFingerHTTPError("Error with request", str(e),
+                                     status=e.status, headers=e.headers) from e
+        except WebFingerContentError:
+            raise
         except Exception as e:
             raise WebFingerNetworkError("Could not connect", str(e)) from e
 
+        self.update_rate_limit(host, response.status, response.headers)
+
         if raw:
-            response = yield from response.text()
-            return response
+            return await response.text()
 
-        response = yield from self.parse_response(response)
-        return response
+        if event is None:
+            return await self.parse_response(response)
+
+        start = time.perf_counter()
+        try:
+            return await self.parse_response(response)
+        finally:
+            event.add_phase("parse", time.perf_counter() - start)
@@ -0,0 +1,175 @@
+"""Hedged requests for asynchronous WebFinger clients.
+
+A HedgePolicy cuts tail latency: when a lookup has been running for longer
+than a percentile (by default the 95th) of recent lookups to the same host, a
+second, identical request is sent. Whichever request succeeds first is used,
+and the other is cancelled; the lookup only fails if both requests fail.
+
+Hedges are extra load on servers, so they are rationed by a budget: each lookup
+earns budget tokens (up to burst of them), and each hedge spends one. With the
+default budget of 0.05, at most 5% more requests are sent however slow hosts
+get.
+
+Pass one to the aiohttp client to use it:
+
+    >>> client = WebFingerClient(hedge=HedgePolicy(percentile=0.95))
+    >>> client.hedge.stats()
+    {'lookups': 0, 'hedged': 0, 'won': 0, 'skipped': 0, 'tokens': 10.0}
+"""
+
+import collections
+import logging
+import time
+
+
+logger = logging.getLogger("webfinger.client.hedge")
+
+
+class HedgePolicy:
+    """When to hedge a slow lookup, and how many hedges to allow.
+
+    The counters lookups, hedged (hedges sent), won (hedges that succeeded
+    before the first request), and skipped (hedges not sent for lack of
+    budget) are returned by stats().
+    """
+
+    def __init__(self, percentile=0.95, window=100, min_samples=20,
+                 min_delay=0.0, budget=0.05, burst=10.0):
+        """Initialise the HedgePolicy object.
+
+        args:
+        percentile - fraction of recent lookups to a host which should finish
+                     before a lookup is hedged (default 0.95)
+        window - number of recent lookups per host to keep latencies of
+                 (default 100)
+        min_samples - lookups to a host needed before its lookups are hedged
+                      (default 20)
+        min_delay - minimum seconds to wait before hedging (default 0)
+        budget - hedges earned per lookup, i.e. the largest fraction of
+                 extra requests (default 0.05)
+        burst - most hedges that can be saved up (default 10)
+        """
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self.tokens = burst
+        self.latencies = {}
+        self.lookups = 0
+        self.hedged = 0
+        self.won = 0
+        self.skipped = 0
+
+    def record(self, host, seconds):
+        """Record the latency of a successful request to host."""
+        latencies = self.latencies.get(host)
+        if latencies is None:
+            latencies = self.latencies[host] = collections.deque(
+                maxlen=self.window)
+
+        latencies.append(seconds)
+
+    def delay(self, host):
+        """Return seconds to wait before hedging a lookup to host.
+
+        Returns None if too few lookups to host have been recorded.
+        """
+        latencies = self.latencies.get(host)
+        if latencies is None or len(latencies) < self.min_samples:
+            return None
+
+        latencies = sorted(latencies)
+        index = min(len(latencies) - 1, int(self.percentile * len(latencies)))
+        return max(self.min_delay, latencies[index])
+
+    def spend(self):
+        """Take a hedge from the budget; return False if there is none."""
+        if self.tokens < 1:
+            self.skipped += 1
+            return False
+
+        self.tokens -= 1
+        self.hedged += 1
+        return True
+
+    def stats(self):
+        """Return the counters, and the hedges left in the budget."""
+        return {"lookups": self.lookups, "hedged": self.hedged,
+                "won": self.won, "skipped": self.skipped,
+                "tokens": self.tokens}
+
+    async def run(self, host, attempt, hedge=None):
+        """Await attempt(), hedging it if it is slow.
+
+        args:
+        host - host the lookup is sent to
+        attempt - coroutine function performing the request
+        hedge - coroutine function performing the hedged request (default
+                attempt)
+
+        Returns the result of whichever request succeeds first. If both fail,
+        the first request's error is raised.
+        """
+        import asyncio
+
+        self.lookups += 1
+        self.tokens = min(self.burst, self.tokens + self.budget)
+
+        delay = self.delay(host)
+        start = time.monotonic()
+        first = asyncio.ensure_future(attempt())
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait((first,), timeout=delay)
+                if not done and self.spend():
+                    logger.debug("hedging lookup to %s after %.3fs", host,
+                                 delay)
+                    return await self._race(host, start, first,
+                                            hedge or attempt)
+
+            result = await first
+        finally:
+            if not first.done():
+                first.cancel()
+
+        self.record(host, time.monotonic() - start)
+        return result
+
+    async def _race(self, host, start, first, hedge):
+        import asyncio
+
+        hedge_start = time.monotonic()
+        second = asyncio.ensure_future(hedge())
+        task = None
+        try:
+            pending = (first, second)
+            # A request that fails doesn't end the race; wait for the other
+            while task is None and pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                # Check both (so asyncio doesn't log errors as never
+                # retrieved), preferring the first if both succeeded together
+                for finished in (second, first):
+                    if finished in done and not finished.cancelled() and \
+                            finished.exception() is None:
+                        task = finished
+        finally:
+            for finished in (first, second):
+                if not finished.done():
+                    finished.cancel()
+
+        if task is None:
+            # Both failed
+            return first.result()
+
+        result = task.result()
+
+        if task is second:
+            self.won += 1
+            self.record(host, time.monotonic() - hedge_start)
+        else:
+            self.record(host, time.monotonic() - start)
+
+        return result
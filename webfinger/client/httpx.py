@@ -0,0 +1,541 @@
+"""WebFinger clients based around the httpx library.
+
+This module requires httpx, with the h2 package for HTTP/2 (install
+"httpx[http2]"). It contains a synchronous and an asynchronous client, which
+both speak HTTP/2 where the server supports it. Concurrent lookups to the same
+host (from threads, or tasks) are then multiplexed over one connection,
+rather than each needing a connection of their own.
+"""
+
+
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+import httpx
+
+from webfinger.client import BaseWebFingerClient, LookupEvent, CHUNK_SIZE, \
+    check_size
+from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
+    WebFingerContentError
+
+
+logger = logging.getLogger("webfinger.client.httpx")
+
+
+# LookupEvent of the lookup running in this thread or task, if anyone is
+# listening
+_event = contextvars.ContextVar("webfinger_httpx_lookup_event", default=None)
+
+
+TRACE_PHASES = {
+    "connection.connect_tcp": "connect",
+    "connection.start_tls": "tls",
+}
+"""httpcore trace events recorded as lookup phases."""
+
+
+class _Tracer:
+    """httpcore trace callback recording phases in a LookupEvent."""
+
+    __slots__ = ("event", "started")
+
+    def __init__(self, event):
+        self.event = event
+        self.started = {}
+
+    def __call__(self, name, info):
+        name, _, stage = name.rpartition(".")
+        phase = TRACE_PHASES.get(name)
+        if phase is None:
+            return
+
+        if stage == "started":
+            self.started[name] = time.perf_counter()
+        elif name in self.started:
+            self.event.add_phase(phase,
+                                 time.perf_counter() - self.started.pop(name))
+
+    async def trace(self, name, info):
+        # The async interface wants a coroutine function
+        self(name, info)
+
+
+def _parse_response(client, response):
+    content_type = response.headers.get("Content-Type")
+    if content_type is None:
+        raise WebFingerContentError("No Content-Type from server")
+
+    content_type = content_type.split(";", 1)[0].strip()
+    logger.debug("response content type: %s" % content_type)
+
+    if content_type not in client.WEBFINGER_TYPES:
+        raise WebFingerContentError("Unacceptable content type")
+
+    parser = client.WEBFINGER_TYPES[content_type][1]
+    return BaseWebFingerClient.parse_response(client, response.text, parser)
+
+
+def _prepare(client, resource, host, rel, params, headers, event):
+    # Returns the host, URL, params, and headers of a lookup
+    if not host:
+        host = client.parse_host(resource)
+
+    url = client.build_url(host)
+
+    if event is not None:
+        event.host = host
+        event.url = url
+
+    # Never modify the caller's dicts; they may be shared between threads
+    params = dict(params or ())
+    params["resource"] = resource
+    if rel:
+        params["rel"] = rel
+
+    headers = dict(headers or ())
+    headers["User-Agent"] = client.USER_AGENT
+    headers["Accept"] = client.generate_accept_header()
+
+    logger.debug("fetching JRD from %s" % url)
+    return host, url, params, headers
+
+
+def _read_limited(response, limit):
+    # Read a streamed response's body, up to limit bytes (see
+    # WebFingerClient.read_limited() in the requests client)
+    if response.is_error:
+        return b""
+
+    check_size(response.headers.get("Content-Length"), limit)
+
+    chunks = []
+    size = 0
+    for chunk in response.iter_bytes(CHUNK_SIZE):
+        size += len(chunk)
+        check_size(size, limit)
+        chunks.append(chunk)
+
+    # Where httpx keeps the body once it has been read
+    response._content = b"".join(chunks)
+    return response._content
+
+
+async def _aread_limited(response, limit):
+    # _read_limited() for async responses
+    if response.is_error:
+        return b""
+
+    check_size(response.headers.get("Content-Length"), limit)
+
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+        size += len(chunk)
+        check_size(size, limit)
+        chunks.append(chunk)
+
+    response._content = b"".join(chunks)
+    return response._content
+
+
+def _record_response(event, response):
+    event.add_phase("ttfb", event.elapsed())
+    event.status = response.status_code
+    event.content_type = response.headers.get("Content-Type")
+
+
+class _HTTPXClientMixin:
+    def __init__(self, timeout=None, client=None, scheme="https", port=None,
+                 http1=True, http2=True, limits=None, retry=None,
+                 rate_limit=None, max_response_bytes=None):
+        """Create a WebFingerClient instance.
+
+        args:
+        timeout - timeout to use, in seconds or as an httpx.Timeout (default
+                  is the httpx client's)
+        client - httpx client to use (default is to create our own)
+        scheme - scheme of the WebFinger endpoint (default https)
+        port - port of the WebFinger endpoint (default is the scheme's)
+        retry - RetryPolicy for failed lookups (default is not to retry)
+        rate_limit - RateLimiter pacing requests to each host (default is no
+                     limit); it can be shared with other clients
+        max_response_bytes - largest response body to read, in bytes
+                             (default is no limit); larger ones raise
+                             WebFingerResponseTooLargeError
+
+        The following only apply to the httpx client we create:
+        http1 - allow HTTP/1.1 (default True); set this to False to use
+                HTTP/2 without TLS (with "prior knowledge")
+        http2 - allow HTTP/2 (default True)
+        limits - httpx.Limits for the connection pool (default is httpx's)
+        """
+        self.timeout = timeout
+        self.client = client
+        self.scheme = scheme
+        self.port = port
+        self.http1 = http1
+        self.http2 = http2
+        self.limits = limits
+        self.retry = retry
+        self.rate_limit = rate_limit
+        self.max_response_bytes = max_response_bytes
+        self._lock = threading.Lock()
+
+    def client_options(self):
+        """Return the keyword arguments our httpx client is created with."""
+        # Follow redirects, as the requests and aiohttp clients do
+        options = {"http1": self.http1, "http2": self.http2, "verify": True,
+                   "follow_redirects": True}
+        if self.limits is not None:
+            options["limits"] = self.limits
+
+        return options
+
+    def request_timeout(self, deadline=None):
+        """Return the timeout to pass to httpx for a request.
+
+        Without a timeout of our own, the httpx client's is used. deadline is
+        seconds left until the lookup's deadline, if any; it shortens the
+        timeout.
+        """
+        timeout = self.timeout
+        if timeout is None:
+            if deadline is None:
+                # None would turn the httpx client's timeout off
+                return httpx.USE_CLIENT_DEFAULT
+
+            timeout = self.client.timeout
+
+        if deadline is None:
+            return timeout
+
+        if isinstance(timeout, httpx.Timeout):
+            return httpx.Timeout(**{
+                phase: deadline if t is None else min(t, deadline)
+                for phase, t in timeout.as_dict().items()})
+
+        return min(timeout, deadline)
+
+
+class WebFingerClient(_HTTPXClientMixin, BaseWebFingerClient):
+    """An implementation of BaseWebFingerClient using httpx.
+
+    One httpx.Client is shared by all threads, so concurrent lookups to a host
+    that speaks HTTP/2 share one connection.
+
+    You can subclass this for your own needs.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def create_client(self):
+        """Create the httpx client used when none was passed in."""
+        return httpx.Client(**self.client_options())
+
+    def get(self, url, params, headers, timeout=None):
+        """Perform HTTP request.
+
+        If timeout is given, it is seconds left until the lookup's deadline,
+        and it shortens the client's timeout.
+        """
+        if self.client is None:
+            with self._lock:
+                if self.client is None:
+                    self.client = self.create_client()
+
+        timeout = self.request_timeout(timeout)
+        limit = self.max_response_bytes
+        event = _event.get()
+        if event is None and limit is None:
+            response = self.client.get(url, params=params, headers=headers,
+                                       timeout=timeout, follow_redirects=True)
+            response.raise_for_status()
+            return response
+
+        request = self.client.build_request(
+            "GET", url, params=params, headers=headers, timeout=timeout,
+            extensions={} if event is None else {"trace": _Tracer(event)})
+
+        # Stream, so the body download can be timed separately (and limited)
+        response = self.client.send(request, stream=True,
+                                    follow_redirects=True)
+        try:
+            if event is not None:
+                _record_response(event, response)
+
+            start = time.perf_counter()
+            if limit is None:
+                body = response.read()
+            else:
+                body = _read_limited(response, limit)
+
+            if event is not None:
+                event.bytes = len(body)
+                event.add_phase("download", time.perf_counter() - start)
+        finally:
+            response.close()
+
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        """Close the httpx client"""
+        if self.client is not None:
+            self.client.close()
+
+    def parse_response(self, response):
+        """Parse the response.
+
+        This function is given a response object from httpx. The parser
+        parameter is not allowed with this method; it will be deduced.
+        """
+        return _parse_response(self, response)
+
+    def finger(self, resource, host=None, rel=None, raw=False, params=None,
+               headers=None):
+        """Perform a WebFinger lookup.
+
+        args:
+        resource - resource to look up
+        host - host to use for resource lookup
+        rel - relation to request
+        raw - return unparsed JRD
+        params - HTTP parameters to pass (note: resource and rel will be
+                 overwritten)
+        headers - HTTP headers to send with the request
+        """
+        if not self.listeners:
+            return self._retrying(resource, host, rel, raw, params, headers)
+
+        event = LookupEvent(resource)
+        self.emit_start(event)
+        token = _event.set(event)
+        try:
+            return self._retrying(resource, host, rel, raw, params, headers,
+                                  event)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            _event.reset(token)
+            self.emit(event)
+
+    def _retrying(self, resource, host, rel, raw, params, headers,
+                  event=None):
+        """Perform a WebFinger lookup, retrying it according to retry."""
+        if self.retry is None:
+            return self._finger(resource, host, rel, raw, params, headers,
+                                event)
+
+        return self.retry.call(functools.partial(
+            self._finger, resource, host, rel, raw, params, headers, event),
+            event)
+
+    def _finger(self, resource, host, rel, raw, params, headers, event=None,
+                timeout=None):
+        """Perform a WebFinger lookup (see finger()).
+
+        If event is not None, the lookup is recorded in it. If timeout is not
+        None, it is seconds left until the lookup's deadline.
+        """
+        host, url, params, headers = _prepare(self, resource, host, rel,
+                                              params, headers, event)
+        timeout = self.throttle(host, event, timeout)
+
+        try:
+            if timeout is None:
+                response = self.get(url, params, headers)
+            else:
+                response = self.get(url, params, headers, timeout)
+        except httpx.HTTPStatusError as e:
+            self.update_rate_limit(host, e.response.status_code,
+                                   e.response.headers)
+            raise WebFingerHTTPError(
+                "Error with request", str(e), status=e.response.status_code,
+                headers=e.response.headers) from e
+        except WebFingerContentError:
+            raise
+        except Exception as e:
+            raise WebFingerNetworkError("Could not connect", str(e)) from e
+
+        self.update_rate_limit(host, response.status_code, response.headers)
+
+        if raw:
+            return response.text
+
+        if event is None:
+            return self.parse_response(response)
+
+        start = time.perf_counter()
+        try:
+            return self.parse_response(response)
+        finally:
+            event.add_phase("parse", time.perf_counter() - start)
+
+
+class AsyncWebFingerClient(_HTTPXClientMixin, BaseWebFingerClient):
+    """An implementation of BaseWebFingerClient using httpx's async client.
+
+    Concurrent lookups (from any number of tasks) to a host that speaks
+    HTTP/2 share one connection. The client can be used as an async context
+    manager, which closes the httpx client on exit.
+
+    You can subclass this for your own needs.
+    """
+
+    async def __aenter__(self):
+        if self.client is None:
+            self.client = self.create_client()
+
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def create_client(self):
+        """Create the httpx client used when none was passed in."""
+        return httpx.AsyncClient(**self.client_options())
+
+    async def get(self, url, params, headers):
+        """Perform HTTP request."""
+        if self.client is None:
+            self.client = self.create_client()
+
+        timeout = self.request_timeout()
+        limit = self.max_response_bytes
+        event = _event.get()
+        if event is None and limit is None:
+            response = await self.client.get(url, params=params,
+                                             headers=headers,
+                                             timeout=timeout,
+                                             follow_redirects=True)
+            response.raise_for_status()
+            return response
+
+        request = self.client.build_request(
+            "GET", url, params=params, headers=headers, timeout=timeout,
+            extensions={} if event is None else
+            {"trace": _Tracer(event).trace})
+
+        # Stream, so the body download can be timed separately (and limited)
+        response = await self.client.send(request, stream=True,
+                                          follow_redirects=True)
+        try:
+            if event is not None:
+                _record_response(event, response)
+
+            start = time.perf_counter()
+            if limit is None:
+                body = await response.aread()
+            else:
+                body = await _aread_limited(response, limit)
+
+            if event is not None:
+                event.bytes = len(body)
+                event.add_phase("download", time.perf_counter() - start)
+        finally:
+            await response.aclose()
+
+        response.raise_for_status()
+        return response
+
+    async def close(self):
+        """Close the httpx client"""
+        if self.client is not None:
+            await self.client.aclose()
+
+    def parse_response(self, response):
+        """Parse the response.
+
+        This function is given a response object from httpx, whose body has
+        been read. The parser parameter is not allowed with this method; it
+        will be deduced.
+        """
+        return _parse_response(self, response)
+
+    async def finger(self, resource, host=None, rel=None, raw=False,
+                     params=None, headers=None):
+        """Perform a WebFinger lookup.
+
+        This method is a coroutine.
+
+        args:
+        resource - resource to look up
+        host - host to use for resource lookup
+        rel - relation to request
+        raw - return unparsed JRD
+        params - HTTP parameters to pass (note: resource and rel will be
+                 overwritten)
+        headers - HTTP headers to send with the request
+        """
+        if not self.listeners:
+            return await self._retrying(resource, host, rel, raw, params,
+                                        headers)
+
+        event = LookupEvent(resource)
+        self.emit_start(event)
+        token = _event.set(event)
+        try:
+            return await self._retrying(resource, host, rel, raw, params,
+                                        headers, event)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            _event.reset(token)
+            self.emit(event)
+
+    async def _retrying(self, resource, host, rel, raw, params, headers,
+                        event=None):
+        """Perform a WebFinger lookup, retrying it according to retry."""
+        if self.retry is None:
+            return await self._finger(resource, host, rel, raw, params,
+                                      headers, event)
+
+        return await self.retry.acall(functools.partial(
+            self._finger, resource, host, rel, raw, params, headers, event),
+            event)
+
+    async def _finger(self, resource, host, rel, raw, params, headers,
+                      event=None):
+        """Perform a WebFinger lookup (see finger()).
+
+        If event is not None, the lookup is recorded in it.
+        """
+        host, url, params, headers = _prepare(self, resource, host, rel,
+                                              params, headers, event)
+        await self.athrottle(host, event)
+
+        try:
+            response = await self.get(url, params, headers)
+        except httpx.HTTPStatusError as e:
+            self.update_rate_limit(host, e.response.status_code,
+                                   e.response.headers)
+            raise WebFingerHTTPError(
+                "Error with request", str(e), status=e.response.status_code,
+                headers=e.response.headers) from e
+        except WebFingerContentError:
+            raise
+        except Exception as e:
+            raise WebFingerNetworkError("Could not connect", str(e)) from e
+
+        self.update_rate_limit(host, response.status_code, response.headers)
+
+        if raw:
+            return response.text
+
+        if event is None:
+            return self.parse_response(response)
+
+        start = time.perf_counter()
+        try:
+            return self.parse_response(response)
+        finally:
+            event.add_phase("parse", time.perf_counter() - start)
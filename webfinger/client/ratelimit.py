@@ -0,0 +1,306 @@
+"""Per-host rate limiting for WebFinger clients.
+
+A RateLimiter paces lookups to each host with a token bucket: a host's bucket
+holds up to burst tokens, refilled at rate tokens per second, and each request
+takes one (waiting for it if need be). One limiter can be shared by any number
+of threads, tasks, and clients.
+
+Each host's rate adapts to what its server says:
+    - a 429 response halves the rate, and pauses requests to the host for its
+      Retry-After (or until its rate limit resets)
+    - a 503 response with Retry-After pauses requests for that long
+    - RateLimit-Limit, RateLimit-Remaining, and RateLimit-Reset headers (or
+      the X-RateLimit-* headers sent by e.g. Mastodon) spread the remaining
+      requests over the time left until the reset, and pause requests until
+      the reset once none remain
+    - other successful responses raise the rate back towards rate
+
+Pass one to a client to use it:
+
+    >>> client = WebFingerClient(rate_limit=RateLimiter(rate=5, burst=10))
+    >>> client.rate_limit.state()
+"""
+
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from webfinger.client.retry import parse_retry_after
+from webfinger.exceptions import WebFingerTimeoutError
+
+
+logger = logging.getLogger("webfinger.client.ratelimit")
+
+
+def _first(value):
+    # Structured header values like "100, 100;w=60" start with the number
+    return value.split(",", 1)[0].split(";", 1)[0].strip()
+
+
+def _header(headers, name):
+    value = headers.get(name)
+    if value is None:
+        value = headers.get("X-" + name)
+
+    return value
+
+
+def parse_reset(value, now=None):
+    """Parse a RateLimit-Reset header value into seconds until the reset.
+
+    args:
+    value - header value; seconds, a UNIX timestamp, an ISO 8601 date (as
+            sent by Mastodon), or an HTTP date
+    now - current time as a UNIX timestamp (default is the current time)
+
+    Returns None if the value can't be parsed.
+    """
+    if value is None:
+        return None
+
+    if now is None:
+        now = time.time()
+
+    value = _first(value)
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        # Nobody waits decades for a reset; this is a timestamp
+        if seconds > 1e9:
+            return max(0.0, seconds - now)
+
+        return max(0.0, seconds)
+
+    try:
+        date = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return parse_retry_after(value, now)
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+
+    return max(0.0, date.timestamp() - now)
+
+
+def parse_rate_limit(headers, now=None):
+    """Parse RateLimit-* (or X-RateLimit-*) headers.
+
+    Returns (limit, remaining, reset), with None for missing or invalid
+    values; reset is in seconds from now.
+    """
+    values = []
+    for name in ("RateLimit-Limit", "RateLimit-Remaining"):
+        value = _header(headers, name)
+        try:
+            values.append(int(_first(value)) if value is not None else None)
+        except ValueError:
+            values.append(None)
+
+    values.append(parse_reset(_header(headers, "RateLimit-Reset"), now))
+    return tuple(values)
+
+
+class _Bucket:
+    __slots__ = ("rate", "tokens", "updated", "blocked_until", "limit",
+                 "remaining", "requests", "limited", "waited")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.tokens = burst
+        self.updated = now
+        self.blocked_until = 0.0
+        self.limit = None
+        self.remaining = None
+        self.requests = 0
+        self.limited = 0
+        self.waited = 0.0
+
+    def refill(self, now, burst):
+        if now > self.updated:
+            self.tokens = min(burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+
+    def block(self, until):
+        if until > self.blocked_until:
+            self.blocked_until = until
+            # Nothing is earned while blocked
+            self.tokens = min(self.tokens, 1.0)
+            self.updated = until
+
+
+class RateLimiter:
+    """Token bucket rate limiter with a bucket per host.
+
+    It is safe to share between threads and tasks; see the module
+    documentation for how each host's rate adapts to its responses.
+    """
+
+    def __init__(self, rate=10.0, burst=10, min_rate=0.1, recovery=0.1,
+                 max_hosts=10000):
+        """Initialise the RateLimiter object.
+
+        args:
+        rate - requests per second allowed to each host (default 10)
+        burst - requests that can be made at once, after a lull (default 10)
+        min_rate - lowest rate a host is slowed down to (default 0.1)
+        recovery - fraction of rate a host's rate is raised by after each
+                   successful response, until it is back to rate (default 0.1)
+        max_hosts - buckets to keep; those of the least recently used hosts
+                    are dropped (default 10000)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.max_hosts = max_hosts
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, host, now):
+        # Must be called with the lock held
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = _Bucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_hosts:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(host)
+
+        bucket.refill(now, self.burst)
+        return bucket
+
+    def take(self, host, waited=0.0):
+        """Try to take a token for a request to host.
+
+        Returns 0 if one was taken, and the request can be sent now; else
+        the seconds to wait before trying again. waited is the seconds just
+        spent waiting, to be counted in the host's state.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(host, now)
+            bucket.waited += waited
+
+            if bucket.blocked_until > now:
+                return bucket.blocked_until - now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                bucket.requests += 1
+                return 0.0
+
+            # The rate may change before then, so the caller tries again
+            return (1 - bucket.tokens) / bucket.rate
+
+    def acquire(self, host, timeout=None):
+        """Wait until a request may be sent to host.
+
+        Returns the seconds waited. Raises WebFingerTimeoutError (without
+        waiting further) if it would take longer than timeout seconds.
+        """
+        waited = wait = 0.0
+        while True:
+            wait = self.take(host, wait)
+            if not wait:
+                return waited
+
+            if timeout is not None and waited + wait > timeout:
+                raise WebFingerTimeoutError("Rate limit wait for {} exceeds "
+                                            "deadline".format(host))
+
+            logger.debug("waiting %.3fs for rate limit of %s", wait, host)
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, host):
+        """Wait until a request may be sent to host.
+
+        This is acquire() for coroutines; a deadline cancels it instead.
+        """
+        import asyncio
+
+        waited = wait = 0.0
+        while True:
+            wait = self.take(host, wait)
+            if not wait:
+                return waited
+
+            logger.debug("waiting %.3fs for rate limit of %s", wait, host)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def update(self, host, status, headers):
+        """Adapt the rate of host to a response.
+
+        args:
+        host - host the response came from
+        status - HTTP status of the response
+        headers - headers of the response
+        """
+        limit, remaining, reset = parse_rate_limit(headers)
+        retry_after = None
+        if status in (429, 503):
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(host, now)
+            if limit is not None:
+                bucket.limit = limit
+            if remaining is not None:
+                bucket.remaining = remaining
+
+            if status == 429:
+                bucket.limited += 1
+                bucket.rate = max(self.min_rate, bucket.rate / 2)
+                if retry_after is None:
+                    retry_after = reset if remaining == 0 and \
+                        reset is not None else 1 / bucket.rate
+            elif remaining is not None and reset is not None:
+                if remaining > 0:
+                    # Spread what is left of the quota until the reset
+                    bucket.rate = min(self.rate, max(self.min_rate,
+                                                     remaining / reset
+                                                     if reset else self.rate))
+                    bucket.tokens = min(bucket.tokens, remaining)
+                else:
+                    retry_after = reset
+            elif status < 400:
+                bucket.rate = min(self.rate,
+                                  bucket.rate + self.rate * self.recovery)
+
+            if retry_after is not None:
+                logger.debug("pausing requests to %s for %.3fs", host,
+                             retry_after)
+                bucket.block(now + retry_after)
+
+    def state(self, host=None):
+        """Return the state of the limiter.
+
+        Returns a dict mapping hosts to dicts of their current rate, tokens
+        left, seconds requests are paused for, the last limit and remaining
+        quota the server reported, requests made, 429 responses, and seconds
+        spent waiting. If host is given, only its dict is returned (None if
+        it has no bucket).
+        """
+        now = time.monotonic()
+        with self._lock:
+            if host is not None:
+                bucket = self._buckets.get(host)
+                return None if bucket is None else self._state(bucket, now)
+
+            return {host: self._state(bucket, now)
+                    for host, bucket in self._buckets.items()}
+
+    def _state(self, bucket, now):
+        bucket.refill(now, self.burst)
+        return {"rate": bucket.rate, "tokens": bucket.tokens,
+                "blocked_for": max(0.0, bucket.blocked_until - now),
+                "limit": bucket.limit, "remaining": bucket.remaining,
+                "requests": bucket.requests, "limited": bucket.limited,
+                "waited": bucket.waited}
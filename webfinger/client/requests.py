@@ -7,8 +7,17 @@ client.
 
 import requests
 import logging
+import functools
+import threading
+import time
+import weakref
 
-from webfinger.client import BaseWebFingerClient
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from webfinger.client import BaseWebFingerClient, LookupEvent, CHUNK_SIZE, \
+    check_size
 from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
     WebFingerJRDError, WebFingerContentError
 
@@ -16,41 +25,348 @@ from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
 logger = logging.getLogger("webfinger.client.requests")
 
 
+# LookupEvent of the lookup running in this thread, if anyone is listening
+_local = threading.local()
+
+
+class _TimedConnectionMixin:
+    # When the connection was last returned to its pool
+    idle_since = None
+
+    def _new_conn(self):
+        event = getattr(_local, "event", None)
+        if event is None:
+            return super()._new_conn()
+
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            event.add_phase("connect", time.perf_counter() - start)
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        event = getattr(_local, "event", None)
+        if event is None:
+            return super().connect()
+
+        start = time.perf_counter()
+        before = event.phases.get("connect", 0.0)
+        try:
+            return super().connect()
+        finally:
+            # Whatever _new_conn didn't account for is the TLS handshake
+            connect = event.phases.get("connect", 0.0) - before
+            event.add_phase("tls", time.perf_counter() - start - connect)
+
+
+class _PoolMixin:
+    def __init__(self, *args, adapter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.adapter = adapter
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        adapter = self.adapter
+        if adapter is None:
+            return conn
+
+        if conn.sock is not None and adapter.idle_timeout is not None and \
+                conn.idle_since is not None and \
+                time.monotonic() - conn.idle_since > adapter.idle_timeout:
+            # Idle for too long; the server may be about to drop it anyway
+            conn.close()
+            adapter._count(self.host, "evicted")
+
+        adapter._count(self.host, "opened" if conn.sock is None else "reused")
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            if self.adapter is not None and not self.adapter.keepalive:
+                conn.close()
+            else:
+                conn.idle_since = time.monotonic()
+
+        super()._put_conn(conn)
+
+
+class _TimedHTTPConnectionPool(_PoolMixin, HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(_PoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """HTTPAdapter that reports connect and TLS times to lookup listeners.
+
+    It also counts connections opened, reused, and evicted per host (see
+    pool_stats()), and can disable keep-alive or evict idle connections.
+
+    WebFingerClient mounts this on sessions it creates itself. Mount it on
+    your own session to get connect and TLS phases for it too.
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ["keepalive", "idle_timeout"]
+
+    def __init__(self, *args, keepalive=True, idle_timeout=None, **kwargs):
+        """Create a TimingAdapter instance.
+
+        args:
+        keepalive - keep connections open for reuse (default True)
+        idle_timeout - seconds after which idle connections are closed
+                       instead of reused (default is never)
+
+        Other arguments are passed to HTTPAdapter (pool_connections,
+        pool_maxsize, max_retries, and pool_block).
+        """
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def __setstate__(self, state):
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        super().__setstate__(state)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": functools.partial(_TimedHTTPConnectionPool, adapter=self),
+            "https": functools.partial(_TimedHTTPSConnectionPool,
+                                       adapter=self),
+        }
+
+    def _count(self, host, stat):
+        with self._stats_lock:
+            stats = self._stats.get(host)
+            if stats is None:
+                stats = self._stats[host] = {"opened": 0, "reused": 0,
+                                             "evicted": 0}
+
+            stats[stat] += 1
+
+    def pool_stats(self):
+        """Return connection statistics.
+
+        Returns a dict mapping hosts to dicts of the number of connections
+        opened, connections reused, and idle connections evicted.
+        """
+        with self._stats_lock:
+            return {host: dict(stats) for host, stats in self._stats.items()}
+
+
 class WebFingerClient(BaseWebFingerClient):
     """An implementation of BaseWebFingerClient using requests..
 
+    Unless a session is passed in, each thread gets its own session, and all
+    of them share one connection pool, so a client can be used from many
+    threads at once.
+
     You can subclass this for your own needs.
     """
 
-    def __init__(self, timeout=None, session=None):
+    POOL_SIZE = 64
+    """Default number of connections kept alive per host."""
+
+    def __init__(self, timeout=None, session=None, scheme="https", port=None,
+                 pool_connections=10, pool_size=None, pool_block=False,
+                 keepalive=True, idle_timeout=None, retry=None,
+                 rate_limit=None, max_response_bytes=None):
         """Create a WebFingerClient instance.
 
         args:
         timeout - default timeout to use (default None)
-        session - requests session to use (default is to create our own)
+        session - requests session to use for every thread (default is to
+                  create one per thread)
+        scheme - scheme of the WebFinger endpoint (default https)
+        port - port of the WebFinger endpoint (default is the scheme's)
+        retry - RetryPolicy for failed lookups (default is not to retry);
+                its deadline bounds each connect and read, and is checked
+                between attempts
+        rate_limit - RateLimiter pacing requests to each host (default is no
+                     limit); it can be shared with other clients
+        max_response_bytes - largest response body to read, in bytes
+                             (default is no limit); larger ones raise
+                             WebFingerResponseTooLargeError
+
+        The following only apply if no session is passed in:
+        pool_connections - number of hosts to keep connection pools for
+                           (default 10)
+        pool_size - connections to keep alive per host (default POOL_SIZE)
+        pool_block - wait for a free connection when pool_size connections to
+                     the host are in use, rather than opening (and then
+                     discarding) another one (default False)
+        keepalive - keep connections open for reuse (default True)
+        idle_timeout - seconds after which idle connections are closed
+                       instead of reused (default is never)
         """
         self.timeout = timeout
         self.session = session
+        self.scheme = scheme
+        self.port = port
+        self.pool_connections = pool_connections
+        self.pool_size = pool_size or self.POOL_SIZE
+        self.pool_block = pool_block
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.retry = retry
+        self.rate_limit = rate_limit
+        self.max_response_bytes = max_response_bytes
+        self.adapter = None
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+        # Sessions of threads that have exited are dropped along with them
+        self._sessions = weakref.WeakSet()
 
     def __del__(self):
         self.close()
 
-    def get(self, url, params, headers):
-        """Perform HTTP request."""
-        if self.session is None:
+    def create_adapter(self):
+        """Create the adapter (and connection pool) shared by our sessions."""
+        return TimingAdapter(pool_connections=self.pool_connections,
+                             pool_maxsize=self.pool_size,
+                             pool_block=self.pool_block,
+                             keepalive=self.keepalive,
+                             idle_timeout=self.idle_timeout)
+
+    def create_session(self):
+        """Create a session, for a thread, when none was passed in."""
+        if self.adapter is None:
+            with self._lock:
+                if self.adapter is None:
+                    self.adapter = self.create_adapter()
+
+        session = requests.Session()
+        session.mount("http://", self.adapter)
+        session.mount("https://", self.adapter)
+        return session
+
+    def thread_session(self):
+        """Return the session for the current thread."""
+        if self.session is not None:
+            return self.session
+
+        session = getattr(self._thread, "session", None)
+        if session is None:
             # Lazily create session
-            self.session = requests.Session()
+            session = self._thread.session = self.create_session()
+            with self._lock:
+                self._sessions.add(session)
+
+        return session
+
+    def pool_stats(self):
+        """Return connection statistics of the client's connection pool.
+
+        See TimingAdapter.pool_stats(); this is empty if a session without a
+        TimingAdapter was passed in.
+        """
+        if self.session is None:
+            adapter = self.adapter
+        else:
+            adapter = self.session.get_adapter(
+                "{}://".format(self.scheme))
+
+        if not isinstance(adapter, TimingAdapter):
+            return {}
+
+        return adapter.pool_stats()
+
+    def get(self, url, params, headers, timeout=None):
+        """Perform HTTP request.
+
+        If timeout is given, it is seconds left until the lookup's deadline,
+        and it shortens the client's timeout.
+        """
+        session = self.thread_session()
+
+        if timeout is None:
+            timeout = self.timeout
+        elif isinstance(self.timeout, tuple):
+            timeout = tuple(timeout if t is None else min(t, timeout)
+                            for t in self.timeout)
+        elif self.timeout is not None:
+            timeout = min(self.timeout, timeout)
+
+        limit = self.max_response_bytes
+        event = getattr(_local, "event", None)
+        if event is None and limit is None:
+            response = session.get(url, params=params, headers=headers,
+                                   timeout=timeout, verify=True)
+            response.raise_for_status()
+            return response
+
+        # Stream, so the body download can be timed separately (and limited)
+        response = session.get(url, params=params, headers=headers,
+                               timeout=timeout, verify=True, stream=True)
+        if event is not None:
+            event.add_phase("ttfb", event.elapsed())
+            event.status = response.status_code
+            event.content_type = response.headers.get("Content-Type")
+
+        start = time.perf_counter()
+        if limit is None:
+            body = response.content
+        else:
+            body = self.read_limited(response, limit)
+
+        if event is not None:
+            event.bytes = len(body)
+            event.add_phase("download", time.perf_counter() - start)
 
-        response = self.session.get(url, params=params, headers=headers,
-                                    timeout=self.timeout, verify=True)
         response.raise_for_status()
         return response
 
+    @staticmethod
+    def read_limited(response, limit):
+        """Read the body of a streamed response, up to limit bytes.
+
+        The body of error responses is not read. Raises
+        WebFingerResponseTooLargeError (and closes the response) if the body
+        is larger than limit.
+        """
+        if response.status_code >= 400:
+            response.close()
+            return b""
+
+        try:
+            check_size(response.headers.get("Content-Length"), limit)
+
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                check_size(size, limit)
+                chunks.append(chunk)
+        except WebFingerContentError:
+            response.close()
+            raise
+
+        # Where requests keeps the body once it has been read
+        response._content = b"".join(chunks)
+        return response._content
+
     def close(self):
-        """Close HTTP session"""
+        """Close HTTP sessions"""
         if self.session:
             self.session.close()
 
+        with self._lock:
+            sessions = list(self._sessions)
+
+        for session in sessions:
+            session.close()
+
     def parse_response(self, response):
         """Parse the response.
 
@@ -72,8 +388,8 @@ class WebFingerClient(BaseWebFingerClient):
         parser = self.WEBFINGER_TYPES[content_type][1]
         return super().parse_response(response.text, parser)
 
-    def finger(self, resource, host=None, rel=None, raw=False, params=dict(),
-               headers=dict()):
+    def finger(self, resource, host=None, rel=None, raw=False, params=None,
+               headers=None):
         """Perform a WebFinger lookup.
 
         args:
@@ -85,29 +401,89 @@ class WebFingerClient(BaseWebFingerClient):
                  overwritten)
         headers - HTTP headers to send with the request
         """
+        if not self.listeners:
+            return self._retrying(resource, host, rel, raw, params, headers)
+
+        event = _local.event = LookupEvent(resource)
+        self.emit_start(event)
+        try:
+            return self._retrying(resource, host, rel, raw, params, headers,
+                                  event)
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            _local.event = None
+            self.emit(event)
+
+    def _retrying(self, resource, host, rel, raw, params, headers,
+                  event=None):
+        """Perform a WebFinger lookup, retrying it according to retry."""
+        if self.retry is None:
+            return self._finger(resource, host, rel, raw, params, headers,
+                                event)
+
+        return self.retry.call(functools.partial(
+            self._finger, resource, host, rel, raw, params, headers, event),
+            event)
+
+    def _finger(self, resource, host, rel, raw, params, headers, event=None,
+                timeout=None):
+        """Perform a WebFinger lookup (see finger()).
+
+        If event is not None, the lookup is recorded in it. If timeout is not
+        None, it is seconds left until the lookup's deadline.
+        """
         if not host:
             host = self.parse_host(resource)
 
-        url = self.WEBFINGER_URL.format(host=host)
+        url = self.build_url(host)
 
+        if event is not None:
+            event.host = host
+            event.url = url
+
+        # Never modify the caller's dicts; they may be shared between threads
+        params = dict(params or ())
         params["resource"] = resource
         if rel:
             params["rel"] = rel
 
+        headers = dict(headers or ())
         headers["User-Agent"] = self.USER_AGENT
         headers["Accept"] = self.generate_accept_header()
 
+        timeout = self.throttle(host, event, timeout)
+
         logger.debug("fetching JRD from %s" % url)
         try:
-            response = self.get(url, params, headers)
+            if timeout is None:
+                response = self.get(url, params, headers)
+            else:
+                response = self.get(url, params, headers, timeout)
         except requests.exceptions.HTTPError as e:
-            raise WebFingerHTTPError("Error with request", str(e)) from e
+            self.update_rate_limit(host, e.response.status_code,
+                                   e.response.headers)
+            raise WebFingerHTTPError(
+                "Error with request", str(e), status=e.response.status_code,
+                headers=e.response.headers) from e
         except requests.exceptions.SSLError as e:
             raise WebFingerNetworkError("SSL error", str(e)) from e
+        except WebFingerContentError:
+            raise
         except Exception as e:
             raise WebFingerNetworkError("Could not connect", str(e)) from e
 
+        self.update_rate_limit(host, response.status_code, response.headers)
+
         if raw:
             return response.text
 
-        return self.parse_response(response)
+        if event is None:
+            return self.parse_response(response)
+
+        start = time.perf_counter()
+        try:
+            return self.parse_response(response)
+        finally:
+            event.add_phase("parse", time.perf_counter() - start)
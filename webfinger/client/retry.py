@@ -0,0 +1,217 @@
+"""Retry policy for WebFinger clients.
+
+A RetryPolicy retries lookups that failed with a transient error (chosen HTTP
+statuses, and network errors), waiting between attempts with exponential
+backoff and full jitter, or as long as the server asked for with Retry-After.
+An optional deadline bounds the lookup. With the asynchronous clients, it
+bounds all of it: every attempt (including redirects and parsing) and the
+waits between them. The synchronous clients can't interrupt a request, so
+there it bounds the waits, and each attempt's connect and read timeouts are
+cut to the time left; a slow body download or parse can still overrun it.
+
+Pass one to a client to use it:
+
+    >>> client = WebFingerClient(retry=RetryPolicy(retries=3, deadline=10))
+
+Only lookups are retried, which are idempotent GET requests.
+"""
+
+import email.utils
+import logging
+import random
+import time
+
+from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
+    WebFingerTimeoutError
+
+
+logger = logging.getLogger("webfinger.client.retry")
+
+
+def parse_retry_after(value, now=None):
+    """Parse a Retry-After header value into seconds to wait.
+
+    args:
+    value - header value; either seconds or an HTTP date
+    now - current time as a UNIX timestamp (default is the current time)
+
+    Returns None if the value can't be parsed.
+    """
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+    if date is None:
+        return None
+
+    if now is None:
+        now = time.time()
+
+    return max(0.0, date.timestamp() - now)
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying a failed lookup."""
+
+    STATUSES = frozenset((429, 500, 502, 503, 504))
+    """HTTP statuses retried by default."""
+
+    def __init__(self, retries=2, statuses=STATUSES,
+                 exceptions=(WebFingerNetworkError,), backoff=0.1,
+                 max_backoff=10.0, max_retry_after=60.0, deadline=None,
+                 random=random.random):
+        """Initialise the RetryPolicy object.
+
+        args:
+        retries - number of retries after the first attempt (default 2)
+        statuses - HTTP statuses to retry (default STATUSES)
+        exceptions - exception classes to retry; WebFingerHTTPError is only
+                     retried for the given statuses (default
+                     WebFingerNetworkError)
+        backoff - base of the exponential backoff, in seconds (default 0.1)
+        max_backoff - maximum backoff, in seconds (default 10)
+        max_retry_after - longest Retry-After to honour, in seconds; lookups
+                          asked to wait longer are not retried (default 60)
+        deadline - seconds the lookup may take (default is no limit); the
+                   synchronous clients only enforce it loosely (see above)
+        random - function returning a random float in [0, 1)
+        """
+        self.retries = retries
+        self.statuses = frozenset(statuses)
+        self.exceptions = tuple(exceptions)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.deadline = deadline
+        self.random = random
+
+    def retryable(self, error):
+        """Return True if a lookup failing with error may be retried."""
+        if isinstance(error, WebFingerHTTPError):
+            return error.status in self.statuses
+
+        return isinstance(error, self.exceptions)
+
+    def delay(self, error, attempt, deadline=None):
+        """Return seconds to wait before retrying, or None to give up.
+
+        args:
+        error - exception the attempt failed with
+        attempt - number of the failed attempt (0 for the first)
+        deadline - time.monotonic() deadline of the lookup, if any
+        """
+        if attempt >= self.retries or not self.retryable(error):
+            return None
+
+        headers = getattr(error, "headers", None)
+        retry_after = parse_retry_after(headers.get("Retry-After")) \
+            if headers is not None else None
+
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+
+            delay = retry_after
+        else:
+            # "Full jitter": anywhere between 0 and the exponential backoff
+            delay = self.random() * min(self.max_backoff,
+                                        self.backoff * 2 ** attempt)
+
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+
+        return delay
+
+    def deadline_at(self):
+        """Return the time.monotonic() deadline of a lookup starting now."""
+        if self.deadline is None:
+            return None
+
+        return time.monotonic() + self.deadline
+
+    @staticmethod
+    def remaining(deadline):
+        """Return seconds left until deadline (None if there is none)."""
+        if deadline is None:
+            return None
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WebFingerTimeoutError("Lookup deadline exceeded")
+
+        return remaining
+
+    def call(self, attempt, event=None):
+        """Call attempt until it succeeds or may no longer be retried.
+
+        attempt is called with the seconds left until the deadline (or None),
+        which it should use as its timeout. If event is not None, its
+        attempts are counted, and the waits between them are recorded as its
+        backoff phase.
+        """
+        deadline = self.deadline_at()
+        number = 0
+        while True:
+            try:
+                return attempt(self.remaining(deadline))
+            except WebFingerTimeoutError:
+                raise
+            except Exception as e:
+                delay = self.delay(e, number, deadline)
+                if delay is None:
+                    raise
+
+                logger.debug("retrying in %.3fs after: %r", delay, e)
+
+            start = time.perf_counter()
+            time.sleep(delay)
+            number += 1
+            if event is not None:
+                event.add_phase("backoff", time.perf_counter() - start)
+                event.attempts += 1
+
+    async def acall(self, attempt, event=None):
+        """Await attempt until it succeeds or may no longer be retried.
+
+        This is call() for coroutine functions, except that attempt is called
+        without arguments: instead, each attempt is cancelled when the deadline
+        passes.
+        """
+        import asyncio
+
+        deadline = self.deadline_at()
+        number = 0
+        while True:
+            timeout = self.remaining(deadline)
+            try:
+                if timeout is None:
+                    return await attempt()
+
+                try:
+                    return await asyncio.wait_for(attempt(), timeout)
+                except asyncio.TimeoutError as e:
+                    raise WebFingerTimeoutError(
+                        "Lookup deadline exceeded") from e
+            except WebFingerTimeoutError:
+                raise
+            except Exception as e:
+                delay = self.delay(e, number, deadline)
+                if delay is None:
+                    raise
+
+                logger.debug("retrying in %.3fs after: %r", delay, e)
+
+            start = time.perf_counter()
+            await asyncio.sleep(delay)
+            number += 1
+            if event is not None:
+                event.add_phase("backoff", time.perf_counter() - start)
+                event.attempts += 1
@@ -0,0 +1,279 @@
+"""Breadth-first crawling of WebFinger resources.
+
+A Crawler walks the graph of accounts from seed resources: the aliases and
+link hrefs of each JRD that are acct: URIs (or have another scheme in schemes)
+are looked up in turn, in breadth-first order, up to max_depth hops from the
+seeds and max_resources lookups in all. Each resource is looked up once; the
+subject of each JRD is counted as visited too.
+
+It is polite to the hosts it crawls: at most per_host lookups to a host run at
+once, and a RateLimiter (the client's, or else one of the crawler's own) paces
+them and backs off when hosts answer 429. The client is not modified.
+
+With a checkpoint file, the crawl can be interrupted and resumed: every
+resource queued and visited is appended (and flushed) to it as a JSON line,
+and a new Crawler with the same file carries on with the resources that were
+queued but not visited. A resource counts as visited once the caller has asked
+for the result after its own, so no result is lost to an interruption.
+
+When stopping a crawl early (e.g. with break), close the generator, so that
+its lookups are cancelled and the checkpoint is closed straight away:
+contextlib.aclosing() does this on Python 3.10 and later.
+
+    >>> async with WebFingerClient() as client:
+    ...     crawler = Crawler(client, max_depth=2, checkpoint="crawl.jsonl")
+    ...     async for result in crawler.crawl(["acct:user@example.com"]):
+    ...         print(result.resource, result.depth, result.error)
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+
+from urllib.parse import urlsplit
+
+from webfinger.client.ratelimit import RateLimiter
+from webfinger.exceptions import WebFingerHTTPError
+from webfinger.utils import read_json_lines
+
+
+logger = logging.getLogger("webfinger.crawler")
+
+
+def neighbours(jrd, schemes=("acct",)):
+    """Return the resources a JRD leads to, in order and without duplicates.
+
+    These are its aliases and link hrefs whose scheme is in schemes.
+    """
+    resources = list(jrd.aliases)
+    resources.extend(link.get("href") for link in jrd.links)
+
+    found = collections.OrderedDict()
+    for resource in resources:
+        if not isinstance(resource, str) or ":" not in resource:
+            continue
+
+        if resource.split(":", 1)[0].lower() in schemes and \
+                resource != jrd.subject:
+            found[resource] = None
+
+    return list(found)
+
+
+def resource_host(resource):
+    """Return the host a resource is looked up on."""
+    if resource.lower().startswith(("http:", "https:")):
+        return urlsplit(resource).hostname
+
+    return resource.split("@")[-1]
+
+
+class CrawlResult:
+    """Outcome of looking up one resource in a crawl.
+
+    jrd is the WebFingerJRD found (None if the lookup failed), and error the
+    exception raised (None if it succeeded). depth is the number of hops from
+    the seeds, and found the number of new resources queued from the JRD.
+    """
+
+    __slots__ = ("resource", "depth", "jrd", "error", "found")
+
+    def __init__(self, resource, depth, jrd=None, error=None, found=0):
+        self.resource = resource
+        self.depth = depth
+        self.jrd = jrd
+        self.error = error
+        self.found = found
+
+    def __repr__(self):
+        return "<CrawlResult {!r} depth={} error={!r}>".format(
+            self.resource, self.depth, self.error)
+
+
+class Crawler:
+    """Bounded-concurrency breadth-first crawler over an asynchronous client.
+
+    The counters queued and visited (including those of a resumed
+    checkpoint) are kept as attributes.
+    """
+
+    def __init__(self, client, max_depth=2, max_resources=10000,
+                 concurrency=32, per_host=2, rate=2.0, schemes=("acct",),
+                 checkpoint=None):
+        """Initialise the Crawler object.
+
+        args:
+        client - asynchronous WebFinger client (e.g. the aiohttp one)
+        max_depth - hops from the seeds to follow (default 2)
+        max_resources - most resources to queue in all (default 10000)
+        concurrency - lookups to run at once (default 32)
+        per_host - lookups to run at once per host (default 2)
+        rate - lookups per second per host, if the client has no rate_limit
+               of its own (default 2)
+        schemes - URI schemes of aliases and hrefs to follow (default acct)
+        checkpoint - path of a file to record progress in, and to resume
+                     from if it exists
+        """
+        self.client = client
+        # Without a limiter of the client's, pace lookups with our own
+        self.rate_limit = None
+        if client.rate_limit is None:
+            self.rate_limit = RateLimiter(rate=rate, burst=per_host)
+
+        self.max_depth = max_depth
+        self.max_resources = max_resources
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.schemes = tuple(scheme.lower() for scheme in schemes)
+        self.checkpoint = checkpoint
+
+        self.seen = set()
+        self.queued = 0
+        self.visited = 0
+        # Queued but not yet visited resources, with their depth
+        self._pending = collections.OrderedDict()
+        self._hosts = {}
+        self._log = None
+        self._queue = None
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._load()
+
+    def _load(self):
+        for entry in read_json_lines(self.checkpoint):
+            if not isinstance(entry, dict):
+                continue
+
+            if "queued" in entry:
+                self.seen.add(entry["queued"])
+                self._pending[entry["queued"]] = entry.get("depth", 0)
+                self.queued += 1
+            elif "visited" in entry:
+                self.seen.add(entry["visited"])
+                if self._pending.pop(entry["visited"], None) is not None:
+                    self.visited += 1
+
+        logger.debug("resuming crawl with %d of %d resources visited",
+                     self.visited, self.queued)
+
+    def _record(self, **entry):
+        if self._log is not None:
+            self._log.write(json.dumps(entry) + "\n")
+            self._log.flush()
+
+    def _enqueue(self, resource, depth):
+        if resource in self.seen or self.queued >= self.max_resources:
+            return False
+
+        self.seen.add(resource)
+        self.queued += 1
+        self._pending[resource] = depth
+        self._record(queued=resource, depth=depth)
+        self._queue.put_nowait((resource, depth))
+        return True
+
+    async def _lookup(self, resource, host):
+        # Waiting for a busy host holds up the worker; that is the point
+        slot = self._hosts.get(host)
+        if slot is None:
+            slot = self._hosts[host] = [asyncio.Semaphore(self.per_host), 0]
+
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                if self.rate_limit is None:
+                    return await self.client.finger(resource, host=host)
+
+                await self.rate_limit.aacquire(host)
+                try:
+                    jrd = await self.client.finger(resource, host=host)
+                except WebFingerHTTPError as e:
+                    if e.status is not None:
+                        self.rate_limit.update(host, e.status,
+                                               e.headers or {})
+                    raise
+
+                self.rate_limit.update(host, 200, {})
+                return jrd
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._hosts[host]
+
+    async def _visit(self, resource, depth):
+        result = CrawlResult(resource, depth)
+        try:
+            result.jrd = await self._lookup(resource,
+                                            resource_host(resource))
+        except Exception as e:
+            logger.debug("lookup of %s failed: %r", resource, e)
+            result.error = e
+        else:
+            subject = result.jrd.subject
+            if subject != resource and subject not in self.seen:
+                self.seen.add(subject)
+                self._record(visited=subject)
+
+            if depth < self.max_depth:
+                for found in neighbours(result.jrd, self.schemes):
+                    result.found += self._enqueue(found, depth + 1)
+
+        return result
+
+    def _done(self, result):
+        del self._pending[result.resource]
+        self.visited += 1
+        self._record(visited=result.resource)
+
+    async def _worker(self, results):
+        while True:
+            resource, depth = await self._queue.get()
+            try:
+                await results.put(await self._visit(resource, depth))
+            finally:
+                self._queue.task_done()
+
+    async def crawl(self, seeds=()):
+        """Crawl from seeds (and any resumed resources).
+
+        This is an asynchronous generator of a CrawlResult for each resource
+        looked up, in the order they finish. If you stop iterating before the
+        end, call its aclose() method (or use contextlib.aclosing()).
+        """
+        self._queue = asyncio.Queue()
+        results = asyncio.Queue(self.concurrency)
+        if self.checkpoint is not None:
+            self._log = open(self.checkpoint, "a", encoding="utf-8")
+
+        for resource, depth in self._pending.items():
+            self._queue.put_nowait((resource, depth))
+
+        for seed in seeds:
+            self._enqueue(seed, 0)
+
+        async def finish():
+            await self._queue.join()
+            await results.put(None)
+
+        tasks = [asyncio.ensure_future(self._worker(results))
+                 for i in range(self.concurrency)]
+        tasks.append(asyncio.ensure_future(finish()))
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+
+                yield result
+                # Only now has the caller dealt with it
+                self._done(result)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self._log is not None:
+                self._log.close()
+                self._log = None
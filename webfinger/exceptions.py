@@ -51,6 +51,29 @@ class WebFingerXRDError(WebFingerRDError):
     """
 
 
+class WebFingerBinaryError(WebFingerRDError):
+    """Error decoding a binary JRD.
+
+    This could be due to corrupt data, or data encoded with a different
+    version of the binary format (e.g. a stale cache entry). Such data should
+    be discarded and fetched again.
+    """
+
+
+class WebFingerResponseTooLargeError(WebFingerContentError):
+    """The response body is larger than the client allows.
+
+    The limit attribute is the maximum size in bytes, and size the size of
+    the body as given by Content-Length (None if the body was cut off while
+    reading it).
+    """
+
+    def __init__(self, *args, limit=None, size=None):
+        super().__init__(*args)
+        self.limit = limit
+        self.size = size
+
+
 class WebFingerNetworkError(WebFingerException):
     """An error occured on the network.
 
@@ -61,8 +84,23 @@ class WebFingerNetworkError(WebFingerException):
     """
 
 
+class WebFingerTimeoutError(WebFingerNetworkError):
+    """The lookup did not finish within its deadline.
+
+    This is raised when a retry policy's deadline runs out during an attempt.
+    """
+
+
 class WebFingerHTTPError(WebFingerNetworkError):
     """A bad HTTP response was received.
 
     Any HTTP code except 200 OK will cause this.
+
+    The status attribute is the HTTP status, and headers the response headers
+    (both None if not known).
     """
+
+    def __init__(self, *args, status=None, headers=None):
+        super().__init__(*args)
+        self.status = status
+        self.headers = headers
@@ -0,0 +1,266 @@
+"""WebFinger metrics.
+
+This contains the MetricsCollector object, which collects standard lookup
+metrics and renders them in the Prometheus (or OpenMetrics) text format:
+    - lookups by host and outcome (a counter)
+    - lookup latency and response size by host (histograms)
+    - lookups in flight and cache size (gauges)
+
+A collector is a lookup listener, so it can be attached to any client:
+
+    >>> metrics = MetricsCollector()
+    >>> client.add_listener(metrics)
+    >>> print(metrics.exposition())
+
+Servers and other code can record lookups directly with record().
+
+Each thread records into its own shard, so recording only ever takes an
+uncontended lock; the shards are merged when the metrics are rendered.
+"""
+
+import bisect
+import threading
+
+from webfinger.exceptions import WebFingerHTTPError, WebFingerNetworkError, \
+    WebFingerContentError
+
+
+OUTCOMES = (WebFingerHTTPError, WebFingerNetworkError, WebFingerContentError)
+"""Exception classes lookups are counted by (most specific first)."""
+
+
+def outcome(error):
+    """Return the outcome label for a lookup that raised error (or None)."""
+    if error is None:
+        return "success"
+
+    for cls in OUTCOMES:
+        if isinstance(error, cls):
+            return cls.__name__
+
+    return "other"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"") \
+        .replace("\n", "\\n")
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Shard:
+    """Metrics recorded by one thread."""
+
+    __slots__ = ("lock", "lookups", "latency", "size", "inflight")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lookups = {}
+        self.latency = {}
+        self.size = {}
+        self.inflight = 0
+
+
+class MetricsCollector:
+    """Collector of WebFinger lookup metrics.
+
+    Hosts are used as label values as they are seen, up to max_hosts of them;
+    lookups for any further hosts are counted under the "other" host, so the
+    number of series stays bounded.
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0)
+    """Upper bounds of the latency histogram buckets, in seconds."""
+
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+    """Upper bounds of the response size histogram buckets, in bytes."""
+
+    def __init__(self, prefix="webfinger", max_hosts=100):
+        """Initialise the MetricsCollector object.
+
+        args:
+        prefix - prefix of the metric names (default webfinger)
+        max_hosts - number of hosts to label individually (default 100)
+        """
+        self.prefix = prefix
+        self.max_hosts = max_hosts
+        self.cache_size = None
+        self._hosts = {}
+        self._shards = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+
+        return shard
+
+    def _host(self, host):
+        label = self._hosts.get(host)
+        if label is None:
+            with self._lock:
+                if host in self._hosts:
+                    label = self._hosts[host]
+                elif host is not None and len(self._hosts) < self.max_hosts:
+                    label = self._hosts[host] = host
+                else:
+                    label = "other"
+
+        return label
+
+    @staticmethod
+    def _observe(histograms, host, buckets, value):
+        histogram = histograms.get(host)
+        if histogram is None:
+            # Bucket counts (the last is +Inf), then the sum
+            histogram = histograms[host] = [0] * (len(buckets) + 1) + [0]
+
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def record(self, host, outcome="success", duration=None, size=None):
+        """Record a finished lookup.
+
+        args:
+        host - host the lookup was for
+        outcome - outcome label (see the outcome() function)
+        duration - seconds the lookup took, if known
+        size - size of the response body in bytes, if known
+        """
+        host = self._host(host)
+        shard = self._shard()
+        with shard.lock:
+            key = (host, outcome)
+            shard.lookups[key] = shard.lookups.get(key, 0) + 1
+
+            if duration is not None:
+                self._observe(shard.latency, host, self.LATENCY_BUCKETS,
+                              duration)
+
+            if size is not None:
+                self._observe(shard.size, host, self.SIZE_BUCKETS, size)
+
+    def started(self):
+        """Record that a lookup has started (for the in-flight gauge)."""
+        shard = self._shard()
+        with shard.lock:
+            shard.inflight += 1
+
+    def finished(self):
+        """Record that a lookup has finished (for the in-flight gauge)."""
+        shard = self._shard()
+        with shard.lock:
+            shard.inflight -= 1
+
+    def set_cache_size(self, size):
+        """Set the cache size gauge."""
+        self.cache_size = size
+
+    def lookup_started(self, event):
+        """Lookup listener hook; see BaseWebFingerClient.add_listener()."""
+        self.started()
+
+    def __call__(self, event):
+        """Record a LookupEvent; this makes the collector a listener."""
+        self.finished()
+        self.record(event.host, outcome(event.error), event.duration,
+                    event.bytes)
+
+    def collect(self):
+        """Merge the shards.
+
+        Returns (lookups, latency, size, inflight), where lookups maps
+        (host, outcome) to counts, and latency and size map hosts to
+        non-cumulative bucket counts followed by the sum.
+        """
+        lookups = {}
+        latency = {}
+        size = {}
+        inflight = 0
+
+        with self._lock:
+            shards = list(self._shards)
+
+        for shard in shards:
+            with shard.lock:
+                for key, count in shard.lookups.items():
+                    lookups[key] = lookups.get(key, 0) + count
+
+                for merged, histograms in ((latency, shard.latency),
+                                           (size, shard.size)):
+                    for host, histogram in histograms.items():
+                        total = merged.get(host)
+                        if total is None:
+                            merged[host] = list(histogram)
+                        else:
+                            for i, value in enumerate(histogram):
+                                total[i] += value
+
+                inflight += shard.inflight
+
+        return lookups, latency, size, inflight
+
+    def exposition(self, openmetrics=False):
+        """Render the metrics in the Prometheus text format.
+
+        args:
+        openmetrics - render the OpenMetrics text format instead
+        """
+        lookups, latency, size, inflight = self.collect()
+        prefix = self.prefix
+        lines = []
+
+        def header(name, type, help):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, type))
+
+        name = prefix + "_lookups"
+        header(name if openmetrics else name + "_total", "counter",
+               "WebFinger lookups by host and outcome.")
+        for (host, result), count in sorted(lookups.items()):
+            lines.append('{}_total{{host="{}",outcome="{}"}} {}'.format(
+                name, _escape(host), result, count))
+
+        for name, buckets, histograms, help in (
+                (prefix + "_lookup_duration_seconds", self.LATENCY_BUCKETS,
+                 latency, "WebFinger lookup latency by host."),
+                (prefix + "_response_size_bytes", self.SIZE_BUCKETS, size,
+                 "WebFinger response body size by host.")):
+            header(name, "histogram", help)
+            for host, histogram in sorted(histograms.items()):
+                host = _escape(host)
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),),
+                                        histogram):
+                    cumulative += count
+                    lines.append('{}_bucket{{host="{}",le="{}"}} {}'.format(
+                        name, host, _format(bound), cumulative))
+
+                lines.append('{}_sum{{host="{}"}} {}'.format(
+                    name, host, _format(histogram[-1])))
+                lines.append('{}_count{{host="{}"}} {}'.format(
+                    name, host, cumulative))
+
+        name = prefix + "_inflight_requests"
+        header(name, "gauge", "WebFinger lookups in flight.")
+        lines.append("{} {}".format(name, inflight))
+
+        if self.cache_size is not None:
+            name = prefix + "_cache_size"
+            header(name, "gauge", "Entries in the WebFinger cache.")
+            lines.append("{} {}".format(name, self.cache_size))
+
+        if openmetrics:
+            lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
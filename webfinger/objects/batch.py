@@ -0,0 +1,321 @@
+"""Columnar batches of JRD links.
+
+This contains the JRDBatch object, which flattens the links of many JRD's into
+(subject, rel, type, href) columns for bulk analysis, such as federation
+audits.
+
+NumPy is used for the code columns if it is installed, and pyarrow is needed
+to export to Arrow and Parquet. Neither is required otherwise.
+"""
+
+import json
+
+from array import array
+
+from webfinger.exceptions import WebFingerJRDError
+from webfinger.objects import RELS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class _Categories:
+    """Dictionary encoding of a column's values."""
+
+    __slots__ = ("values", "codes")
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return code
+
+
+class JRDBatch:
+    """Columnar view of the links of many JRD's.
+
+    Each row is one link: (subject, rel, type, href). The subject, rel, and
+    type columns are dictionary-encoded (stored as integer codes into a list
+    of distinct values), so filtering compares integers rather than strings.
+    JRD's without links contribute no rows.
+
+    Use from_json(), from_dicts(), or from_jrds() to create a batch.
+    """
+
+    COLUMNS = ("subject", "rel", "type", "href")
+    """Names of the columns."""
+
+    def __init__(self, subjects, rels, types, subject_codes, rel_codes,
+                 type_codes, hrefs, backend=None):
+        """Initialise the JRDBatch object.
+
+        This is not normally called directly; use one of the from_* class
+        methods instead.
+
+        args:
+        subjects, rels, types - lists of distinct values for each column
+        subject_codes, rel_codes, type_codes - per-row indices into the above
+        hrefs - per-row hrefs (None if a link has no href)
+        backend - "numpy" or "python" (default is numpy if it is installed)
+        """
+        if backend is None:
+            backend = "numpy" if numpy is not None else "python"
+
+        if backend == "numpy":
+            if numpy is None:
+                raise ImportError("numpy is required for the numpy backend")
+
+            def convert(codes):
+                return numpy.asarray(codes, dtype=numpy.int32)
+        elif backend == "python":
+            def convert(codes):
+                if isinstance(codes, array):
+                    return codes
+                return array("i", codes)
+        else:
+            raise ValueError("unknown backend", backend)
+
+        self.backend = backend
+        self.subjects = subjects
+        self.rels = rels
+        self.types = types
+        self.subject_codes = convert(subject_codes)
+        self.rel_codes = convert(rel_codes)
+        self.type_codes = convert(type_codes)
+        self.hrefs = hrefs
+
+    @classmethod
+    def from_dicts(cls, jrds, backend=None):
+        """Create a batch from raw JRD mappings (e.g. decoded JSON).
+
+        No WebFingerJRD or WebFingerLink objects are created, and the JRD's
+        are not validated beyond what is needed to build the columns.
+
+        args:
+        jrds - iterable of JRD mappings
+        backend - "numpy" or "python" (default is numpy if it is installed)
+        """
+        subjects = _Categories()
+        rels = _Categories()
+        types = _Categories()
+        subject_codes = []
+        rel_codes = []
+        type_codes = []
+        hrefs = []
+
+        for jrd in jrds:
+            try:
+                subject = subjects.encode(jrd["subject"])
+            except (KeyError, TypeError) as e:
+                raise WebFingerJRDError("subject is required in JRD") from e
+
+            for link in jrd.get("links", ()):
+                subject_codes.append(subject)
+                rel_codes.append(rels.encode(link.get("rel")))
+                type_codes.append(types.encode(link.get("type")))
+                hrefs.append(link.get("href"))
+
+        return cls(subjects.values, rels.values, types.values, subject_codes,
+                   rel_codes, type_codes, hrefs, backend)
+
+    @classmethod
+    def from_json(cls, texts, backend=None):
+        """Create a batch from JRD json plaintexts.
+
+        args:
+        texts - iterable of json strings
+        backend - "numpy" or "python" (default is numpy if it is installed)
+        """
+        def parse(texts):
+            for text in texts:
+                try:
+                    yield json.loads(text)
+                except Exception as e:
+                    raise WebFingerJRDError("error parsing JRD") from e
+
+        return cls.from_dicts(parse(texts), backend)
+
+    @classmethod
+    def from_jrds(cls, jrds, backend=None):
+        """Create a batch from WebFingerJRD (or FrozenWebFingerJRD) objects.
+
+        args:
+        jrds - iterable of JRD objects
+        backend - "numpy" or "python" (default is numpy if it is installed)
+        """
+        return cls.from_dicts(({"subject": jrd.subject, "links": jrd.links}
+                               for jrd in jrds), backend)
+
+    def __len__(self):
+        return len(self.hrefs)
+
+    def column(self, name):
+        """Return the decoded values of the given column as a list."""
+        if name == "href":
+            return list(self.hrefs)
+        elif name == "subject":
+            values, codes = self.subjects, self.subject_codes
+        elif name == "rel":
+            values, codes = self.rels, self.rel_codes
+        elif name == "type":
+            values, codes = self.types, self.type_codes
+        else:
+            raise KeyError(name)
+
+        return [values[code] for code in codes.tolist()]
+
+    def rows(self):
+        """Iterate over (subject, rel, type, href) tuples."""
+        return zip(*(self.column(name) for name in self.COLUMNS))
+
+    def take(self, indices):
+        """Return a new batch containing only the given rows.
+
+        args:
+        indices - sequence of row indices (or a NumPy array of them)
+        """
+        if self.backend == "numpy":
+            indices = numpy.asarray(indices, dtype=numpy.intp)
+            subject_codes = self.subject_codes[indices]
+            rel_codes = self.rel_codes[indices]
+            type_codes = self.type_codes[indices]
+            indices = indices.tolist()
+        else:
+            subject_codes = array("i", (self.subject_codes[i]
+                                        for i in indices))
+            rel_codes = array("i", (self.rel_codes[i] for i in indices))
+            type_codes = array("i", (self.type_codes[i] for i in indices))
+
+        hrefs = [self.hrefs[i] for i in indices]
+        return self.__class__(self.subjects, self.rels, self.types,
+                              subject_codes, rel_codes, type_codes, hrefs,
+                              self.backend)
+
+    def _mask(self, values, codes, value):
+        # Matching rows as an index sequence; the value is compared once, as
+        # a code, rather than once per row
+        try:
+            code = values.index(value)
+        except ValueError:
+            return []
+
+        if self.backend == "numpy":
+            return numpy.flatnonzero(codes == code)
+
+        return [i for i, c in enumerate(codes) if c == code]
+
+    def filter(self, rel=None, type=None):
+        """Return a new batch with only the rows matching rel and type.
+
+        Only the given fields are matched. rel may be a URI or a friendly
+        name.
+
+        args:
+        rel - relation to match
+        type - MIME type to match
+        """
+        indices = None
+
+        if rel is not None:
+            rel = RELS.get(rel, rel)
+            indices = self._mask(self.rels, self.rel_codes, rel)
+
+        if type is not None:
+            type_indices = self._mask(self.types, self.type_codes, type)
+            if indices is None:
+                indices = type_indices
+            elif self.backend == "numpy":
+                indices = numpy.intersect1d(indices, type_indices,
+                                            assume_unique=True)
+            else:
+                type_indices = set(type_indices)
+                indices = [i for i in indices if i in type_indices]
+
+        if indices is None:
+            return self
+
+        return self.take(indices)
+
+    def group_by_host(self):
+        """Split the batch into one batch per subject host.
+
+        The host is the part of the subject after the last "@". A dict mapping
+        hosts to batches is returned.
+        """
+        hosts = _Categories()
+        subject_hosts = [hosts.encode(subject.split("@")[-1])
+                         for subject in self.subjects]
+
+        if self.backend == "numpy":
+            row_hosts = numpy.asarray(subject_hosts,
+                                      dtype=numpy.int32)[self.subject_codes]
+            order = numpy.argsort(row_hosts, kind="stable")
+            codes, starts = numpy.unique(row_hosts[order], return_index=True)
+            groups = zip(codes.tolist(), numpy.split(order, starts[1:]))
+        else:
+            indices = {}
+            for i, code in enumerate(self.subject_codes):
+                indices.setdefault(subject_hosts[code], []).append(i)
+            groups = indices.items()
+
+        return {hosts.values[code]: self.take(group) for code, group in groups}
+
+    def to_arrow(self):
+        """Convert the batch into a pyarrow Table.
+
+        The subject, rel, and type columns are dictionary-encoded.
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for to_arrow()")
+
+        def dictionary(codes, values):
+            if None not in values:
+                indices = pyarrow.array(codes, type=pyarrow.int32())
+            else:
+                # Missing values must be null indices, not a null in the
+                # dictionary, or Parquet can't write them
+                null = values.index(None)
+                values = ["" if v is None else v for v in values]
+                if self.backend == "numpy":
+                    indices = pyarrow.array(codes, mask=(codes == null),
+                                            type=pyarrow.int32())
+                else:
+                    indices = pyarrow.array([None if c == null else c
+                                             for c in codes],
+                                            type=pyarrow.int32())
+
+            return pyarrow.DictionaryArray.from_arrays(
+                indices, pyarrow.array(values, type=pyarrow.string()))
+
+        return pyarrow.table({
+            "subject": dictionary(self.subject_codes, self.subjects),
+            "rel": dictionary(self.rel_codes, self.rels),
+            "type": dictionary(self.type_codes, self.types),
+            "href": pyarrow.array(self.hrefs, type=pyarrow.string()),
+        })
+
+    def to_parquet(self, where, **kwargs):
+        """Write the batch to a Parquet file.
+
+        args:
+        where - path or file object to write to
+        kwargs - passed to pyarrow.parquet.write_table
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for to_parquet()")
+
+        pyarrow.parquet.write_table(self.to_arrow(), where, **kwargs)
@@ -0,0 +1,122 @@
+"""WebFinger link index.
+
+This contains the LinkIndex object, which indexes the links of a JRD by rel,
+type, and href, so that queries don't need to scan the list of links.
+"""
+
+from webfinger.objects import RELS
+
+
+class LinkIndex:
+    """Index of links by rel, type, href, and (rel, type).
+
+    Links are kept in the order they were added, which is the order of the
+    links in the JRD. The index must be updated with add() whenever a link is
+    added to the JRD, and with reindex() whenever an indexed link's rel, type,
+    or href changes or the link is replaced; WebFingerJRD does both.
+    """
+
+    __slots__ = ("_by_rel", "_by_type", "_by_href", "_by_rel_type")
+
+    def __init__(self, links=()):
+        """Initialise the LinkIndex object.
+
+        args:
+        links - iterable of links to index
+        """
+        self._by_rel = {}
+        self._by_type = {}
+        self._by_href = {}
+        self._by_rel_type = {}
+
+        for link in links:
+            self.add(link)
+
+    def add(self, link):
+        """Add a link to the index."""
+        rel = link.get("rel")
+        type = link.get("type")
+        href = link.get("href")
+
+        self._by_rel.setdefault(rel, []).append(link)
+        self._by_rel_type.setdefault((rel, type), []).append(link)
+
+        if type is not None:
+            self._by_type.setdefault(type, []).append(link)
+
+        if href is not None:
+            self._by_href.setdefault(href, []).append(link)
+
+    def reindex(self, links, old, new):
+        """Update the index after a link changed or was replaced.
+
+        Only the entries for the old and new fields are rebuilt.
+
+        args:
+        links - all the indexed links, in order, after the change
+        old - (rel, type, href) of the link before the change
+        new - (rel, type, href) of the link after the change
+        """
+        for rel, type, href in {old, new}:
+            self._rebuild(self._by_rel, rel, links,
+                          lambda x: x.get("rel") == rel)
+            self._rebuild(self._by_rel_type, (rel, type), links,
+                          lambda x: x.get("rel") == rel and
+                          x.get("type") == type)
+
+            if type is not None:
+                self._rebuild(self._by_type, type, links,
+                              lambda x: x.get("type") == type)
+
+            if href is not None:
+                self._rebuild(self._by_href, href, links,
+                              lambda x: x.get("href") == href)
+
+    @staticmethod
+    def _rebuild(index, key, links, match):
+        matching = [x for x in links if match(x)]
+        if matching:
+            index[key] = matching
+        else:
+            index.pop(key, None)
+
+    def _lookup(self, rel, type, href):
+        # Returns the internal list where possible; callers must not modify it
+        if rel is not None:
+            rel = RELS.get(rel, rel)
+
+        if href is not None:
+            # Few links share an href, so filtering these is cheap
+            return [x for x in self._by_href.get(href, ())
+                    if (rel is None or x.get("rel") == rel) and
+                    (type is None or x.get("type") == type)]
+        elif rel is not None:
+            if type is not None:
+                return self._by_rel_type.get((rel, type), ())
+
+            return self._by_rel.get(rel, ())
+        elif type is not None:
+            return self._by_type.get(type, ())
+
+        return ()
+
+    def find(self, rel=None, type=None, href=None):
+        """Find links matching all of the given fields.
+
+        Friendly rel names (e.g. "profile") are accepted for rel. If no fields
+        are given, nothing is returned.
+
+        args:
+        rel - relation of the link
+        type - MIME type of the link
+        href - URI of the link
+        """
+        return tuple(self._lookup(rel, type, href))
+
+    def first(self, rel=None, type=None, href=None):
+        """Return the first link matching the given fields, or None.
+
+        The arguments are the same as for find().
+        """
+        links = self._lookup(rel, type, href)
+        return links[0] if links else None
@@ -0,0 +1,119 @@
+"""Interning of common JRD strings and links.
+
+The same rel URI's, MIME types, and keys appear in almost every JRD. When
+many JRD's are kept around (e.g. in a cache), storing one copy of each saves
+a lot of memory. The tables here are bounded, so a hostile server can't make
+them grow without limit; once a table is full, new values are simply not
+interned.
+"""
+
+from webfinger.objects import REL_NAMES
+
+
+class InternTable:
+    """A bounded table of shared, hashable values.
+
+    Looking up a value returns the copy stored in the table, which is equal
+    but may be a different object. Values are added until maxsize is reached.
+    """
+
+    __slots__ = ("_table", "maxsize")
+
+    def __init__(self, seed=(), maxsize=4096):
+        """Initialise the InternTable object.
+
+        args:
+        seed - values to add to the table initially
+        maxsize - maximum number of values in the table (default 4096)
+        """
+        self._table = {}
+        self.maxsize = maxsize
+
+        for value in seed:
+            self._table[value] = value
+
+    def intern(self, value):
+        """Return the shared copy of value, adding it if there is room."""
+        try:
+            return self._table[value]
+        except KeyError:
+            # Adding is a single dict operation, so this is thread-safe
+            if len(self._table) < self.maxsize:
+                self._table[value] = value
+
+            return value
+        except TypeError:
+            # Unhashable
+            return value
+
+    def clear(self):
+        """Remove all values from the table."""
+        self._table.clear()
+
+    def __contains__(self, value):
+        return value in self._table
+
+    def __len__(self):
+        return len(self._table)
+
+
+COMMON_STRINGS = tuple(REL_NAMES) + (
+    # Link keys
+    "rel", "type", "href", "titles", "properties", "template",
+    # Common rels (ActivityPub, OStatus, Diaspora, etc.)
+    "self",
+    "salmon",
+    "magic-public-key",
+    "http://ostatus.org/schema/1.0/subscribe",
+    "http://schemas.google.com/g/2010#updates-from",
+    "http://joindiaspora.com/seed_location",
+    "http://joindiaspora.com/guid",
+    "http://microformats.org/profile/hcard",
+    "http://nodeinfo.diaspora.software/ns/schema/2.0",
+    "https://webfinger.net/rel/avatar",
+    # Common MIME types
+    "text/html",
+    "image/jpeg",
+    "image/png",
+    "application/atom+xml",
+    "application/activity+json",
+    "application/ld+json",
+    'application/ld+json; profile="https://www.w3.org/ns/activitystreams"',
+    "application/magic-public-key",
+)
+"""Strings the string intern table is seeded with."""
+
+STRINGS = InternTable(COMMON_STRINGS)
+"""Intern table for rel's, types, and keys."""
+
+LINKS = InternTable()
+"""Intern table for frozen links (flyweights), used by freeze(flyweight=True).
+"""
+
+
+def intern_link(link):
+    """Return a copy of a link mapping with its common strings interned.
+
+    The keys, rel and type values, and property keys are interned.
+
+    args:
+    link - the link mapping
+    """
+    intern = STRINGS.intern
+    ret = {}
+    for k, v in link.items():
+        if k == "rel" or k == "type":
+            if isinstance(v, str):
+                v = intern(v)
+        elif k == "properties" and isinstance(v, dict):
+            v = intern_keys(v)
+
+        ret[intern(k)] = v
+
+    return ret
+
+
+def intern_keys(mapping):
+    """Return a copy of a dict with its keys interned."""
+    intern = STRINGS.intern
+    return {intern(k): v for k, v in mapping.items()}
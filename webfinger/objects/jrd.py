@@ -6,17 +6,45 @@ a request, or be used to build a response.
 
 
 import json
+import marshal
+import sys
 
 from xml.etree import ElementTree
 from collections import OrderedDict
 from collections.abc import Mapping
+from types import MappingProxyType
 
-from defusedxml import ElementTree as DefusedElementTree
-
-from webfinger.exceptions import WebFingerJRDError
+from webfinger import profiling
+from webfinger.exceptions import WebFingerJRDError, WebFingerXRDError, \
+    WebFingerBinaryError
 from webfinger.objects import RELS, REL_NAMES
-from webfinger.objects.link import WebFingerLink
-from webfinger.utils import is_uri
+from webfinger.objects.index import LinkIndex
+from webfinger.objects.intern import LINKS, intern_keys
+from webfinger.objects.link import WebFingerLink, FrozenWebFingerLink
+from webfinger.objects.validator import validate_jrd
+from webfinger.utils import is_uri, freeze, thaw, hashable, \
+    json_default
+
+
+BINARY_MAGIC = b"WFJR"
+"""Magic bytes at the start of binary JRD's."""
+
+BINARY_VERSION = 2
+"""Version of the binary JRD format; bump this when the format changes."""
+
+# The payload is marshal data, whose format can change between Python
+# versions, so the header also holds the version of the encoding Python
+_BINARY_HEADER = BINARY_MAGIC + bytes((BINARY_VERSION,) +
+                                      tuple(sys.version_info[:2]))
+
+
+def _unpickle(cls, jrd):
+    # The JRD was valid when it was pickled
+    return cls(jrd, trusted=True)
+
+
+def _unpickle_frozen(jrd):
+    return WebFingerJRD(jrd, trusted=True).freeze()
 
 
 class WebFingerJRD:
@@ -29,48 +57,71 @@ class WebFingerJRD:
     attribute of links as a key (or None for links where rel is ommitted).
     URI's will be mapped to friendly attribute names if known.
 
+    Links are also indexed by rel, type, and href in link_index; use find() and
+    first() to query them, e.g. first(rel="self",
+    type="application/activity+json").
+
     The from_xml() class method can be used to parse an XRD into this object.
     The to_xml() method can be used to turn the JRD into an XRD.
 
     The add_* methods can be used to update the JRD with various attributes.
-    A JSON representation can be retrieved with the to_json() method.
+    A JSON representation can be retrieved with the to_json() method, and a
+    compact binary one (for caching and IPC) with to_bytes().
     """
 
-    def __init__(self, jrd):
+    def __init__(self, jrd, *, trusted=False):
         """Initalise WebFingerJRD object with jrd.
 
         args:
         jrd - the JRD of the WebFinger response.
+        trusted - skip validation of the JRD; only use this for JRD's built by
+                  us or that have already been validated (default False)
         """
-        if not isinstance(jrd, Mapping):
-            raise WebFingerJRDError("JRD must be a Mapping")
+        if not trusted:
+            with profiling.stage("validate"):
+                validate_jrd(jrd)
+
+        if isinstance(jrd, dict):
+            # The aliases, properties, and links are replaced below; don't do
+            # that to the caller's dict, which may be shared
+            jrd = dict(jrd)
+            if isinstance(jrd.get("aliases"), list):
+                jrd["aliases"] = list(jrd["aliases"])
 
         self.jrd = jrd
 
-        try:
-            self.subject = jrd["subject"]
-        except Exception as e:
-            raise WebFingerJRDError("subject is required in JRD") from e
+        self.subject = jrd["subject"]
 
         self.aliases = jrd.get("aliases", [])
 
-        self.properties = jrd.get("properties", {})
-
-        self.links = []
-        for link in jrd.get("links", []):
-            self.links.append(WebFingerLink(**link))
+        if isinstance(jrd, dict) and isinstance(jrd.get("properties"), dict):
+            # Share property key strings between JRD's
+            jrd["properties"] = intern_keys(jrd["properties"])
 
-        # Create rels list
-        self.link_rels = OrderedDict()
-        for link in self.links:
-            rel = REL_NAMES.get(link.rel, link.rel)
-
-            if rel not in self.link_rels:
-                rel_list = self.link_rels[rel] = list()
-            else:
-                rel_list = self.link_rels[rel]
+        self.properties = jrd.get("properties", {})
 
-            rel_list.append(link)
+        with profiling.stage("index"):
+            # The whole JRD was validated above, so don't do it again per
+            # link. Frozen links are immutable, so they are shared rather than
+            # copied.
+            self.links = []
+            for link in jrd.get("links", []):
+                if not isinstance(link, FrozenWebFingerLink):
+                    link = WebFingerLink.trusted(link)
+
+                self.links.append(link)
+
+            if "links" in jrd and isinstance(jrd, dict):
+                # Let the JRD share the (interned) link mappings, rather than
+                # keeping a second copy of every link around
+                jrd["links"] = [link._link if isinstance(link, WebFingerLink)
+                                else link for link in self.links]
+
+            # Create rels list and link index
+            self.link_rels = OrderedDict()
+            self.link_index = LinkIndex()
+            for link in self.links:
+                self._index_link(link)
 
     @classmethod
     def from_json(cls, text):
@@ -80,7 +131,8 @@ class WebFingerJRD:
         text - json text to parse. Must be a string.
         """
         try:
-            jrd = json.loads(text)
+            with profiling.stage("parse"):
+                jrd = json.loads(text)
         except Exception as e:
             raise WebFingerJRDError("error parsing JRD") from e
 
@@ -93,6 +145,9 @@ class WebFingerJRD:
         args:
         text - XML text to parse. Must be a string.
         """
+        # defusedxml is only needed here, so don't import it up front
+        from defusedxml import ElementTree as DefusedElementTree
+
         XMLNSMAP = {"XRD": 'http://docs.oasis-open.org/ns/xri/xrd-1.0'}
 
         def parse_properties(node):
@@ -116,54 +171,55 @@ class WebFingerJRD:
 
             return ret
 
-        try:
-            root = DefusedElementTree.fromstring(text)
-        except Exception as e:
-            raise WebFingerXRDERror("error parsing XRD XML") from e
-
-        subject = root.find("XRD:Subject", XMLNSMAP)
-        if subject is None:
-            raise WebFingerXRDError("subject is required")
-
-        jrd = {"subject": subject.text}
-
-        aliases = root.findall("XRD:Alias", XMLNSMAP)
-        if aliases:
-            aliases_jrd = jrd["aliases"] = []
-            for alias in aliases:
-                if not alias.text:
-                    raise WebFingerXRDError("alias had no content")
-                aliases_jrd.append(alias.text)
-
-        properties = parse_properties(root)
-        if properties:
-            jrd["properties"] = properties
-
-        links = root.findall("XRD:Link", XMLNSMAP)
-        if links:
-            links_jrd = jrd["links"] = []
-            for link in links:
-                link_jrd = {}
-
-                # Retrieve basic attributes
-                for attrib, value in link.attrib.items():
-                    link_jrd[attrib] = value
-
-                # Properties
-                properties = parse_properties(link)
-                if properties:
-                    link_jrd["properties"] = properties
-
-                # Titles
-                titles = link.findall("XRD:Title", XMLNSMAP)
-                if titles:
-                    titles_jrd = jrd["titles"] = {}
-                    for title in titles:
-                        lang = title.attrib.get("xml:lang", "und")
-                        title = title.text
-                        titles_jrd[title] = lang
-
-                links_jrd.append(link_jrd)
+        with profiling.stage("parse"):
+            try:
+                root = DefusedElementTree.fromstring(text)
+            except Exception as e:
+                raise WebFingerXRDError("error parsing XRD XML") from e
+
+            subject = root.find("XRD:Subject", XMLNSMAP)
+            if subject is None:
+                raise WebFingerXRDError("subject is required")
+
+            jrd = {"subject": subject.text}
+
+            aliases = root.findall("XRD:Alias", XMLNSMAP)
+            if aliases:
+                aliases_jrd = jrd["aliases"] = []
+                for alias in aliases:
+                    if not alias.text:
+                        raise WebFingerXRDError("alias had no content")
+                    aliases_jrd.append(alias.text)
+
+            properties = parse_properties(root)
+            if properties:
+                jrd["properties"] = properties
+
+            links = root.findall("XRD:Link", XMLNSMAP)
+            if links:
+                links_jrd = jrd["links"] = []
+                for link in links:
+                    link_jrd = {}
+
+                    # Retrieve basic attributes
+                    for attrib, value in link.attrib.items():
+                        link_jrd[attrib] = value
+
+                    # Properties
+                    properties = parse_properties(link)
+                    if properties:
+                        link_jrd["properties"] = properties
+
+                    # Titles
+                    titles = link.findall("XRD:Title", XMLNSMAP)
+                    if titles:
+                        titles_jrd = jrd["titles"] = {}
+                        for title in titles:
+                            lang = title.attrib.get("xml:lang", "und")
+                            title = title.text
+                            titles_jrd[title] = lang
+
+                    links_jrd.append(link_jrd)
 
         # TODO - any other elements
 
@@ -176,16 +232,16 @@ class WebFingerJRD:
         args:
         subject - subject of the JRD
         """
-        if "@" not in subject:
-            raise WebFingerJRDError("subject must be in user@host format")
-
         if not isinstance(subject, str):
             raise WebFingerJRDError("subject must be a string")
 
+        if "@" not in subject:
+            raise WebFingerJRDError("subject must be in user@host format")
+
         if not subject.startswith("acct:"):
             subject = "acct:" + subject
 
-        return cls({"subject": subject})
+        return cls({"subject": subject}, trusted=True)
 
     def rel(self, relation, attr=None):
         """Return a given relation, with an optional attribute.
@@ -205,6 +261,54 @@ class WebFingerJRD:
 
         return rel
 
+    def find(self, rel=None, type=None, href=None):
+        """Find all links matching the given rel, type, and href.
+
+        Only the given fields are matched. rel may be a URI or a friendly
+        name. A tuple of the matching links is returned.
+        """
+        return self.link_index.find(rel, type, href)
+
+    def first(self, rel=None, type=None, href=None):
+        """Return the first link matching the given rel, type, and href.
+
+        The arguments are the same as for find(). None is returned if no link
+        matches.
+        """
+        return self.link_index.first(rel, type, href)
+
+    def _index_link(self, link):
+        rel = REL_NAMES.get(link.rel, link.rel)
+
+        if rel not in self.link_rels:
+            rel_list = self.link_rels[rel] = list()
+        else:
+            rel_list = self.link_rels[rel]
+
+        rel_list.append(link)
+
+        self.link_index.add(link)
+        if isinstance(link, WebFingerLink):
+            link._owner = self
+
+    def _reindex_link(self, old, new):
+        # Rebuild the rels and index entries of a link's old and new (rel,
+        # type, href); self.links must already be up to date
+        for name in {REL_NAMES.get(old[0], old[0]),
+                     REL_NAMES.get(new[0], new[0])}:
+            rel_list = [x for x in self.links
+                        if REL_NAMES.get(x.get("rel"), x.get("rel")) == name]
+            if rel_list:
+                self.link_rels[name] = rel_list
+            else:
+                self.link_rels.pop(name, None)
+
+        self.link_index.reindex(self.links, old, new)
+
+    def _link_changed(self, link, old):
+        # Called by our WebFingerLinks when their rel, type, or href changes
+        self._reindex_link(old, link.indexed())
+
     # NOTE: all add_* methods must maintain their relevant instance variables,
     # as well as update the JRD object.
 
@@ -214,17 +318,17 @@ class WebFingerJRD:
         args:
         alias - the alias to add to the JRD. Must be a string and a valid URI.
         """
-        if "aliases" not in self.jrd:
-            self.jrd["aliases"] = []
-
         if not isinstance(alias, str):
             raise WebFingerJRDError("alias must be a string")
 
         if not is_uri(alias):
             raise WebFingerJRDError("alias must be a URI")
 
+        if "aliases" not in self.jrd:
+            self.jrd["aliases"] = self.aliases
+
+        # self.aliases is the JRD's own list
         self.aliases.append(alias)
-        self.jrd["aliases"].append(alias)
 
     def add_property(self, uri, value=None):
         """Add a property to the JRD.
@@ -292,17 +396,147 @@ class WebFingerJRD:
         args.update(misc)
         args.update(kwargs)
 
-        self.links.append(WebFingerLink(**args))
-        self.jrd["links"].append(args)
+        link = WebFingerLink(**args)
+        self.links.append(link)
+        self._index_link(link)
+        # Share the link's (interned) mapping, as __init__ does
+        self.jrd["links"].append(link._link)
+
+    def replace_link(self, index, link):
+        """Replace the link at index in the JRD, and return the new link.
+
+        The links, the JRD, the rels, and the link index are all updated.
+
+        args:
+        index - position of the link in links
+        link - the new WebFingerLink or FrozenWebFingerLink
+        """
+        if not isinstance(link, (WebFingerLink, FrozenWebFingerLink)):
+            raise WebFingerJRDError("link must be a WebFingerLink")
+
+        old = self.links[index]
+        if isinstance(old, WebFingerLink) and old is not link:
+            old._owner = None
+
+        self.links[index] = link
+        self.jrd["links"][index] = (link._link if isinstance(link,
+                                    WebFingerLink) else link)
+        if isinstance(link, WebFingerLink):
+            link._owner = self
+
+        self._reindex_link(old.indexed(), link.indexed())
+        return link
+
+    def thaw_link(self, index):
+        """Return the link at index as a WebFingerLink that can be modified.
+
+        A FrozenWebFingerLink (e.g. one shared with the FrozenWebFingerJRD
+        this JRD was thawed from) is replaced with a mutable copy first.
+
+        args:
+        index - position of the link in links
+        """
+        link = self.links[index]
+        if isinstance(link, WebFingerLink):
+            return link
+
+        return self.replace_link(index, link.thaw())
 
     def add_misc(self, key, value):
         """Add an otherwise unknown key and value to the JRD."""
         self.jrd[key] = value
 
+    @classmethod
+    def from_bytes(cls, data):
+        """Initialise JRD from the binary format created by to_bytes().
+
+        The JRD is not validated again, since it was valid when it was
+        encoded. The payload is marshal data, so only load data from trusted
+        sources (such as your own cache) written by the same Python version.
+
+        args:
+        data - bytes to decode
+
+        WebFingerBinaryError is raised if the data is truncated or corrupt, or
+        was encoded with a different version of the format or of Python.
+        """
+        header = bytes(data[:len(_BINARY_HEADER)])
+        if header != _BINARY_HEADER:
+            magic = header[:len(BINARY_MAGIC)]
+            if magic != BINARY_MAGIC[:len(magic)]:
+                raise WebFingerBinaryError("not a binary JRD")
+
+            if len(header) < len(_BINARY_HEADER):
+                raise WebFingerBinaryError("binary JRD is truncated")
+
+            version = header[len(BINARY_MAGIC)]
+            if version != BINARY_VERSION:
+                raise WebFingerBinaryError("unsupported binary JRD version",
+                                           version)
+
+            raise WebFingerBinaryError(
+                "binary JRD was encoded by another Python version",
+                "{}.{}".format(*header[len(BINARY_MAGIC) + 1:]))
+
+        try:
+            with profiling.stage("parse"):
+                jrd = marshal.loads(data[len(_BINARY_HEADER):])
+        except Exception as e:
+            raise WebFingerBinaryError("error decoding binary JRD") from e
+
+        if not isinstance(jrd, dict) or "subject" not in jrd:
+            raise WebFingerBinaryError("binary JRD is malformed")
+
+        return cls(jrd, trusted=True)
+
+    def to_bytes(self):
+        """Convert JRD into a compact binary format.
+
+        The result can be turned back into a JRD with from_bytes(), by the
+        same version of Python. It is intended for caching and IPC, not for
+        exchange with other programs.
+        """
+        with profiling.stage("serialize"):
+            return _BINARY_HEADER + marshal.dumps(self._plain_jrd())
+
+    def _plain_jrd(self):
+        # Plain dicts and lists, with links taken from self.links. Link keys
+        # and rel/type values are interned, so marshal stores them only once.
+        jrd = {k: thaw(v) for k, v in self.jrd.items() if k != "links"}
+        if "links" in self.jrd:
+            links = jrd["links"] = []
+            for link in self.links:
+                plain = {}
+                for k, v in link.items():
+                    if k in ("rel", "type") and isinstance(v, str):
+                        v = sys.intern(v)
+
+                    plain[sys.intern(k)] = thaw(v)
+
+                links.append(plain)
+
+        return jrd
+
+    def __reduce__(self):
+        return (_unpickle, (self.__class__, self._plain_jrd()))
+
+    def freeze(self, flyweight=False):
+        """Return an immutable, hashable FrozenWebFingerJRD snapshot.
+
+        The snapshot can be shared between threads without copying.
+
+        args:
+        flyweight - reuse identical frozen links from other snapshots, to
+                    save memory when many JRD's are cached (default False)
+        """
+        return FrozenWebFingerJRD(self, flyweight)
+
     def to_json(self):
         """Convert JRD into a json string."""
-        return json.dumps(self.jrd)
+        with profiling.stage("serialize"):
+            return json.dumps(self.jrd, default=json_default)
 
+    @profiling.staged("serialize")
     def to_xml(self):
         """Convert JRD into XML."""
         def serialise_property(node, properties):
@@ -338,7 +572,7 @@ class WebFingerJRD:
                     # Serialise as a property
                     if elem.lower() == "titles":
                         # Serialise as titles
-                        for title, language in v.items():
+                        for title, language in attr.items():
                             title_elem = ElementTree.SubElement(link, "Title",
                                 {"xml:lang": language})
                             title_elem.text = title
@@ -358,3 +592,115 @@ class WebFingerJRD:
             return ElementTree.tostring(tree.close(), encoding="unicode")
         except Exception as e:
             raise WebFingerXRDError("Could not serialise into XML", e) from e
+
+
+class FrozenWebFingerJRD:
+    """Immutable, hashable snapshot of a WebFingerJRD.
+
+    All containers are tuples or mapping proxies and links are
+    FrozenWebFingerLink objects, so a snapshot can be shared between threads
+    without defensive copies.
+
+    The read-only API of WebFingerJRD (rel, find, first, to_json, to_bytes,
+    to_xml) is available.
+    Use thaw() to get a mutable WebFingerJRD back.
+    """
+
+    __slots__ = ("jrd", "subject", "aliases", "properties", "links",
+                 "link_rels", "link_index", "_hash")
+
+    def __init__(self, jrd, flyweight=False):
+        """Initialise the FrozenWebFingerJRD object.
+
+        args:
+        jrd - the WebFingerJRD to take a snapshot of
+        flyweight - reuse identical frozen links from other snapshots
+                    (default False)
+        """
+        # Links that are already frozen are shared, not copied
+        links = tuple(link.freeze() for link in jrd.links)
+        if flyweight:
+            links = tuple(LINKS.intern(link) for link in links)
+
+        frozen = {k: freeze(v) for k, v in jrd.jrd.items() if k != "links"}
+        if links or "links" in jrd.jrd:
+            frozen["links"] = links
+
+        link_rels = OrderedDict()
+        for link in links:
+            rel = REL_NAMES.get(link.rel, link.rel)
+            link_rels[rel] = link_rels.get(rel, ()) + (link,)
+
+        # Never modified after this, so it is safe to share
+        link_index = LinkIndex(links)
+
+        set_attr = object.__setattr__
+        set_attr(self, "jrd", MappingProxyType(frozen))
+        set_attr(self, "subject", frozen["subject"])
+        set_attr(self, "aliases", frozen.get("aliases", ()))
+        set_attr(self, "properties",
+                 frozen.get("properties", MappingProxyType({})))
+        set_attr(self, "links", links)
+        set_attr(self, "link_rels", MappingProxyType(link_rels))
+        set_attr(self, "link_index", link_index)
+        set_attr(self, "_hash", None)
+
+    def thaw(self, cls=WebFingerJRD):
+        """Return a mutable copy of this snapshot.
+
+        The copy shares the (immutable) link objects with this snapshot, so
+        only the containers are copied. To modify a shared link, get a mutable
+        copy in its place with thaw_link(), e.g. jrd.thaw_link(0)["href"] = x;
+        this keeps the JRD, rels, and link index in step.
+
+        args:
+        cls - the WebFingerJRD class to create (default WebFingerJRD)
+        """
+        jrd = {k: thaw(v) for k, v in self.jrd.items() if k != "links"}
+        if "links" in self.jrd:
+            jrd["links"] = list(self.links)
+
+        return cls(jrd, trusted=True)
+
+    def freeze(self):
+        """Return this snapshot, as it is already frozen."""
+        return self
+
+    rel = WebFingerJRD.rel
+
+    find = WebFingerJRD.find
+
+    first = WebFingerJRD.first
+
+    to_json = WebFingerJRD.to_json
+
+    to_bytes = WebFingerJRD.to_bytes
+
+    _plain_jrd = WebFingerJRD._plain_jrd
+
+    to_xml = WebFingerJRD.to_xml
+
+    def __reduce__(self):
+        return (_unpickle_frozen, (self._plain_jrd(),))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("FrozenWebFingerJRD is immutable")
+
+    def __delattr__(self, attr):
+        raise AttributeError("FrozenWebFingerJRD is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenWebFingerJRD):
+            return NotImplemented
+
+        return self.jrd == other.jrd
+
+    def __hash__(self):
+        # Racing threads compute the same value, so no lock is needed
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash(hashable(self.jrd)))
+
+        return self._hash
+
+    def __repr__(self):
+        return "FrozenWebFingerJRD(subject={!r})".format(self.subject)
@@ -6,8 +6,14 @@ abstract. The WebFingerLinks object serves this role.
 
 from collections.abc import Mapping, MutableMapping
 
-from webfinger.exceptions import WebFingerJRDError
-from webfinger.utils import is_uri
+from webfinger import profiling
+from webfinger.objects.intern import intern_link
+from webfinger.objects.validator import validate_link
+from webfinger.utils import freeze, thaw, hashable
+
+
+INDEXED_KEYS = ("rel", "type", "href")
+"""Keys a WebFingerJRD indexes its links by."""
 
 
 class WebFingerLink(MutableMapping):
@@ -18,8 +24,14 @@ class WebFingerLink(MutableMapping):
     abstraction to these objects.
 
     This object provides both attr-based access and mapping-based access.
+
+    When the link belongs to a WebFingerJRD, changing its rel, type, or href
+    updates the JRD's rels and link index.
     """
 
+    # The WebFingerJRD whose links include this one, if any
+    _owner = None
+
     def __init__(self, rel, *, type=None, href=None, titles=None,
                  properties=None, **kwargs):
         """Initalise the WebFingerLink object.
@@ -35,68 +47,156 @@ class WebFingerLink(MutableMapping):
 
         All other arguments are set as attrs on this object.
         """
-        self._link = {"rel": rel}
+        link = {"rel": rel}
 
         if type is not None:
-            if not isinstance(type, str):
-                raise WebFingerJRDError("type must be a string")
-
-            self._link["type"] = type
+            link["type"] = type
 
         if href is not None:
-            if not isinstance(href, str):
-                raise WebFingerJRDError("href must be a string")
-
-            if not is_uri(href):
-                raise WebFingerJRDError("href must be a valid URI")
-
-            self._link["href"] = href
+            link["href"] = href
 
         if titles is not None:
-            if not isinstance(titles, Mapping):
-                raise WebFingerJRDError("titles must be a mapping")
+            link["titles"] = titles
 
-            for k, v in titles.items():
-                if not isinstance(k, str):
-                    raise WebFingerJRDError("title must be a string")
+        if properties is not None:
+            link["properties"] = properties
 
-                if not isinstance(v, str):
-                    raise WebFingerJRDError("title language must be a string")
+        # No validation performed on other items
+        link.update(kwargs)
 
-            self._link["titles"] = titles
+        with profiling.stage("validate"):
+            validate_link(link)
 
-        if properties is not None:
-            if not isinstance(properties, Mapping):
-                raise WebFingerJRDError("properties must be a mapping")
+        self._link = intern_link(link)
 
-            for k, v in properties.items():
-                if not is_uri(k):
-                    raise WebFingerJRDError("properties keys must be URI's")
+    @classmethod
+    def trusted(cls, link):
+        """Create a WebFingerLink from an already-validated mapping.
 
-                if not isinstance(v, str) or v is not None:
-                    raise WebFingerJRDError(
-                        "properties values must be strings, or None", v)
+        No validation is performed; use this only for links that have been
+        checked already (e.g. by validate_jrd) or were built by us.
 
-            self._link["properties"] = properties
+        args:
+        link - mapping of the link
+        """
+        self = cls.__new__(cls)
+        self._link = intern_link(link)
+        return self
 
-        for k, v in kwargs.items():
-            # No validation performed on other items
-            self._link[k] = v
+    def freeze(self):
+        """Return an immutable, hashable FrozenWebFingerLink of this link."""
+        return FrozenWebFingerLink(self._link)
 
     def __getattr__(self, attr):
+        if attr.startswith("_"):
+            # Don't recurse if _link isn't set yet (e.g. when unpickling)
+            raise AttributeError(attr)
+
         return self._link[attr]
 
+    def __reduce__(self):
+        return (self.__class__.trusted, (self._link,))
+
     def __getitem__(self, key):
         return self._link[key]
 
     def __setitem__(self, key, value):
+        if self._owner is None or key not in INDEXED_KEYS:
+            self._link[key] = value
+            return
+
+        old = self.indexed()
         self._link[key] = value
+        self._owner._link_changed(self, old)
 
     def __delitem__(self, key):
+        if self._owner is None or key not in INDEXED_KEYS:
+            del self._link[key]
+            return
+
+        old = self.indexed()
         del self._link[key]
+        self._owner._link_changed(self, old)
+
+    def __iter__(self):
+        return iter(self._link)
+
+    def __len__(self):
+        return len(self._link)
+
+    def __repr__(self):
+        return "WebFingerLink({!r})".format(self._link)
+
+    def indexed(self):
+        """Return the (rel, type, href) the link is indexed by."""
+        return tuple(self._link.get(key) for key in INDEXED_KEYS)
+
+
+class FrozenWebFingerLink(Mapping):
+    """Immutable, hashable snapshot of a WebFingerLink.
+
+    Nested mappings are stored as mapping proxies and lists as tuples, so
+    instances can be shared between threads without copying.
+
+    Use thaw() to get a mutable WebFingerLink back.
+    """
+
+    __slots__ = ("_link", "_hash")
+
+    def __init__(self, link):
+        """Initialise the FrozenWebFingerLink object.
+
+        args:
+        link - mapping of the link; it is assumed to be valid
+        """
+        object.__setattr__(self, "_link", freeze(link))
+        object.__setattr__(self, "_hash", None)
+
+    def thaw(self):
+        """Return a mutable WebFingerLink copy of this link."""
+        return WebFingerLink.trusted(thaw(self._link))
+
+    def freeze(self):
+        """Return this link, as it is already frozen."""
+        return self
+
+    def indexed(self):
+        """Return the (rel, type, href) the link is indexed by."""
+        return tuple(self._link.get(key) for key in INDEXED_KEYS)
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+
+        try:
+            return self._link[attr]
+        except KeyError as e:
+            raise AttributeError(attr) from e
+
+    def __reduce__(self):
+        return (self.__class__, (thaw(self._link),))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("FrozenWebFingerLink is immutable")
+
+    def __delattr__(self, attr):
+        raise AttributeError("FrozenWebFingerLink is immutable")
+
+    def __getitem__(self, key):
+        return self._link[key]
 
     def __iter__(self):
         return iter(self._link)
 
     def __len__(self):
         return len(self._link)
+
+    def __hash__(self):
+        # Racing threads compute the same value, so no lock is needed
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash(hashable(self._link)))
+
+        return self._hash
+
+    def __repr__(self):
+        return "FrozenWebFingerLink({!r})".format(dict(self._link))
@@ -0,0 +1,127 @@
+"""WebFinger JRD validator.
+
+This module checks an entire JRD in a single pass. The checks for each known
+field are looked up once from a dispatch table, rather than being re-run in
+every constructor and add_* method.
+
+Errors are raised as WebFingerJRDError, with the path of the offending field
+(e.g. "links[2].href") as the second argument.
+"""
+
+from collections.abc import Mapping
+
+from webfinger.exceptions import WebFingerJRDError
+from webfinger.utils import is_uri
+
+
+def _fail(message, path):
+    raise WebFingerJRDError(message, path)
+
+
+def _check_str(value, path, name):
+    if not isinstance(value, str):
+        _fail("{} must be a string".format(name), path)
+
+
+def _check_uri(value, path, name):
+    if not isinstance(value, str):
+        _fail("{} must be a string".format(name), path)
+
+    if not is_uri(value):
+        _fail("{} must be a valid URI".format(name), path)
+
+
+def _check_titles(value, path, name):
+    if not isinstance(value, Mapping):
+        _fail("titles must be a mapping", path)
+
+    for k, v in value.items():
+        if not isinstance(k, str):
+            _fail("title must be a string", "{}[{!r}]".format(path, k))
+
+        if not isinstance(v, str):
+            _fail("title language must be a string",
+                  "{}[{!r}]".format(path, k))
+
+
+def _check_properties(value, path, name):
+    if not isinstance(value, Mapping):
+        _fail("properties must be a mapping", path)
+
+    for k, v in value.items():
+        if not isinstance(k, str) or not is_uri(k):
+            _fail("properties keys must be URI's", "{}[{!r}]".format(path, k))
+
+        if v is not None and not isinstance(v, str):
+            _fail("properties values must be strings, or None",
+                  "{}[{!r}]".format(path, k))
+
+
+def _check_aliases(value, path, name):
+    if isinstance(value, (str, bytes)) or not isinstance(value, (list, tuple)):
+        _fail("aliases must be a list", path)
+
+    for i, alias in enumerate(value):
+        _check_uri(alias, "{}[{}]".format(path, i), "alias")
+
+
+LINK_FIELDS = {
+    "rel": _check_str,
+    "type": _check_str,
+    "href": _check_uri,
+    "titles": _check_titles,
+    "properties": _check_properties,
+}
+"""Validators for known link fields; other fields are not validated."""
+
+JRD_FIELDS = {
+    "subject": _check_str,
+    "aliases": _check_aliases,
+    "properties": _check_properties,
+}
+"""Validators for known top-level JRD fields, except links."""
+
+
+def validate_link(link, path="link"):
+    """Validate a single link mapping.
+
+    args:
+    link - the link mapping to validate
+    path - path to the link, used in error messages
+    """
+    if not isinstance(link, Mapping):
+        _fail("link must be a mapping", path)
+
+    if link.get("rel") is None:
+        _fail("rel is required in link", path + ".rel")
+
+    for key, value in link.items():
+        check = LINK_FIELDS.get(key)
+        if check is not None and value is not None:
+            check(value, "{}.{}".format(path, key), key)
+
+
+def validate_jrd(jrd):
+    """Validate an entire JRD in one pass.
+
+    args:
+    jrd - the JRD mapping to validate
+    """
+    if not isinstance(jrd, Mapping):
+        _fail("JRD must be a Mapping", "")
+
+    if "subject" not in jrd:
+        _fail("subject is required in JRD", "subject")
+
+    for key, value in jrd.items():
+        if key == "links":
+            if isinstance(value, (str, bytes)) or \
+                    not isinstance(value, (list, tuple)):
+                _fail("links must be a list", "links")
+
+            for i, link in enumerate(value):
+                validate_link(link, "links[{}]".format(i))
+        else:
+            check = JRD_FIELDS.get(key)
+            if check is not None:
+                check(value, key, key)
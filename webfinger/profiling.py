@@ -0,0 +1,263 @@
+"""Opt-in profiling of JRD parsing and serialisation.
+
+When profiling is enabled, the hot paths of WebFingerJRD and WebFingerLink
+record the cumulative time and net allocated memory blocks of each stage:
+    parse - decoding JSON, XML, or the binary format into a JRD mapping
+    validate - validating the JRD and its links
+    index - creating link objects and indexing them
+    serialize - encoding the JRD as JSON, XML, or the binary format
+
+Only a sampled fraction of stage calls is measured, and a (usually smaller)
+fraction can also be run under cProfile, to be dumped as a pstats file.
+
+Enable it for a block of code with the profile() context manager:
+
+    >>> with profile(sample_rate=0.1) as profiler:
+    ...     WebFingerJRD.from_json(text)
+    >>> print(profiler.report())
+
+or for a whole process by setting WEBFINGER_PROFILE to the sample rate (e.g.
+"1" or "0.1"). The report is then written to stderr at exit, and if
+WEBFINGER_PROFILE_PSTATS is set to a path, a pstats file is written there for
+a WEBFINGER_PROFILE_PSTATS_RATE fraction of calls (default 0.01).
+
+When profiling is disabled, each stage costs a global lookup and an empty
+with statement.
+"""
+
+import atexit
+import contextlib
+import functools
+import os
+import random
+import sys
+import threading
+import time
+
+
+active = None
+"""The Profiler in use, or None if profiling is disabled."""
+
+_NULL = contextlib.nullcontext()
+
+
+def stage(name):
+    """Return a context manager measuring the given stage, if profiling.
+
+    args:
+    name - name of the stage (parse, validate, index, or serialize)
+    """
+    profiler = active
+    if profiler is None:
+        return _NULL
+
+    return profiler.stage(name)
+
+
+def staged(name):
+    """Decorator measuring every call of a function as the given stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start", "blocks", "cprofile")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.cprofile = None
+
+    def __enter__(self):
+        profiler = self.profiler
+        local = profiler._local
+        if profiler.pstats_rate and getattr(local, "cprofile", None) is None \
+                and profiler.random() < profiler.pstats_rate:
+            # Only the outermost sampled stage in a thread runs cProfile
+            cprofile = profiler._cprofile()
+            try:
+                cprofile.enable()
+            except ValueError:
+                # Another profiler is active (e.g. in another thread)
+                pass
+            else:
+                self.cprofile = local.cprofile = cprofile
+
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        blocks = sys.getallocatedblocks() - self.blocks
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.profiler._local.cprofile = None
+
+        self.profiler._add(self.name, elapsed, blocks)
+
+
+class Profiler:
+    """Collector of per-stage timings and allocations.
+
+    stats maps stage names to [calls, seconds, net allocated blocks], counting
+    only sampled calls.
+    """
+
+    def __init__(self, sample_rate=1.0, pstats_rate=0.0, seed=None):
+        """Initialise the Profiler object.
+
+        args:
+        sample_rate - fraction of stage calls to measure (default 1.0)
+        pstats_rate - fraction of stage calls to run under cProfile
+                      (default 0.0)
+        seed - seed for the sampling random number generator
+        """
+        self.sample_rate = sample_rate
+        self.pstats_rate = pstats_rate
+        self.random = random.Random(seed).random
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cprofiles = []
+
+    def stage(self, name):
+        """Return a context manager measuring the given stage (if sampled)."""
+        if self.sample_rate < 1.0 and self.random() >= self.sample_rate:
+            return _NULL
+
+        return _Stage(self, name)
+
+    def _add(self, name, elapsed, blocks):
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                self.stats[name] = [1, elapsed, blocks]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += blocks
+
+    def _cprofile(self):
+        # cProfile.Profile objects can only be used by one thread
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            import cProfile
+
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._cprofiles.append(profile)
+
+        return profile
+
+    def enable(self):
+        """Make this the active profiler."""
+        global active
+        active = self
+
+    def disable(self):
+        """Stop profiling, if this is the active profiler."""
+        global active
+        if active is self:
+            active = None
+
+    def report(self):
+        """Return a text report of the stage statistics."""
+        lines = ["{:<10} {:>10} {:>12} {:>12} {:>12}".format(
+            "stage", "calls", "total ms", "mean us", "blocks/call")]
+
+        with self._lock:
+            stats = sorted(self.stats.items())
+
+        for name, (calls, seconds, blocks) in stats:
+            lines.append("{:<10} {:>10} {:>12.3f} {:>12.3f} {:>12.1f}".format(
+                name, calls, seconds * 1e3, seconds / calls * 1e6,
+                blocks / calls))
+
+        return "\n".join(lines)
+
+    def dump_stats(self, path):
+        """Write the cProfile statistics of sampled calls to a pstats file.
+
+        Returns False (and writes nothing) if no calls were profiled.
+        """
+        import pstats
+
+        with self._lock:
+            profiles = list(self._cprofiles)
+
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # Nothing was recorded by this profile
+                continue
+
+        if stats is None:
+            return False
+
+        stats.dump_stats(path)
+        return True
+
+
+@contextlib.contextmanager
+def profile(sample_rate=1.0, pstats_rate=0.0, seed=None):
+    """Enable profiling for the duration of a with block.
+
+    The Profiler is returned by the context manager. See Profiler for the
+    arguments.
+    """
+    profiler = Profiler(sample_rate, pstats_rate, seed)
+    previous = active
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if previous is not None:
+            previous.enable()
+
+
+def _enable_from_environment():
+    rate = os.environ.get("WEBFINGER_PROFILE")
+    if not rate:
+        return
+
+    path = os.environ.get("WEBFINGER_PROFILE_PSTATS")
+    try:
+        rate = float(rate)
+        pstats_rate = 0.0
+        if path:
+            pstats_rate = float(os.environ.get(
+                "WEBFINGER_PROFILE_PSTATS_RATE", "0.01"))
+    except ValueError as e:
+        # Only needed here, so that importing the JRD objects stays cheap
+        import logging
+
+        logging.getLogger("webfinger.profiling").warning(
+            "not profiling, invalid sample rate in the environment: %s", e)
+        return
+
+    profiler = Profiler(rate, pstats_rate)
+    profiler.enable()
+
+    def finish():
+        print(profiler.report(), file=sys.stderr)
+        if path:
+            profiler.dump_stats(path)
+
+    atexit.register(finish)
+
+
+_enable_from_environment()
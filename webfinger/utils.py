@@ -3,6 +3,78 @@
 Everthing in this module should be considered a private API.
 """
 
+import json
+
+from collections.abc import Mapping
+from types import MappingProxyType
+
+
 def is_uri(string):
     """Validate if the given string is a URI."""
     return ":" in string
+
+
+def freeze(value):
+    """Recursively convert mappings and lists into immutable equivalents.
+
+    Mappings become read-only mapping proxies, and lists become tuples.
+    """
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+
+    return value
+
+
+def thaw(value):
+    """Recursively convert frozen values back into dicts and lists."""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+
+    return value
+
+
+def hashable(value):
+    """Return a hashable key for a (possibly nested) frozen value."""
+    if isinstance(value, Mapping):
+        return frozenset((k, hashable(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(hashable(v) for v in value)
+
+    return value
+
+
+def json_default(obj):
+    """JSON encoder default function for frozen JRD parts.
+
+    Frozen links and mapping proxies aren't dicts, so json can't encode them.
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(obj).__name__))
+
+
+def read_json_lines(path):
+    """Yield the JSON objects in a file of JSON lines, for resuming.
+
+    A partly written last line (from an interrupted run) is cut off, so that
+    new lines can be appended after it. Lines that aren't JSON are skipped.
+    """
+    with open(path, "rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+
+            end += len(line)
+            try:
+                yield json.loads(line)
+            except ValueError:
+                pass
+
+        f.truncate(end)